@@ -0,0 +1,74 @@
+"""
+In-process stand-in for the lxc module, for the benchmarks - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+# Only the part of python3-lxc used by ottolib. Containers change state as
+# soon as they are asked to, without running the hooks, so what is measured
+# is the overhead of otto itself.
+
+import os
+import shutil
+
+# directory of the containers, like the one of python3-lxc
+default_config_path = "/var/lib/lxc"
+
+
+class Container(object):
+    """ Fake lxc.Container, its state is kept in memory """
+
+    # state of all the containers, so Container(name) finds a started one
+    _states = {}
+
+    def __init__(self, name, config_path=None):
+        self.name = name
+        self.config_path = config_path or default_config_path
+
+    @property
+    def state(self):
+        return self._states.get(self.name, "STOPPED")
+
+    @property
+    def running(self):
+        return self.state == "RUNNING"
+
+    @property
+    def defined(self):
+        return True
+
+    def load_config(self, path=None):
+        return True
+
+    def start(self, *args, **kwargs):
+        self._states[self.name] = "RUNNING"
+        return True
+
+    def stop(self):
+        self._states[self.name] = "STOPPED"
+        return True
+
+    def wait(self, state, timeout=-1):
+        return self.state == state
+
+    def destroy(self):
+        if self.running:
+            return False
+        self._states.pop(self.name, None)
+        shutil.rmtree(os.path.join(self.config_path, self.name), ignore_errors=True)
+        return True
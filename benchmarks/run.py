@@ -0,0 +1,312 @@
+#!/usr/bin/python3
+"""
+Benchmarks of the overhead of otto on the host - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# Usage:
+#   benchmarks/run.py [-o FILE] [-n REPEAT] [-s SIZES] [--compare OLD.json]
+#
+# The results are written as JSON with the commit they were measured on, so
+# two runs on the same host can be compared with --compare.
+
+import argparse
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHDIR = os.path.abspath(sys.path[0])
+# the fake lxc module comes before python3-lxc, if it is installed
+sys.path.insert(1, os.path.join(BENCHDIR, "fakelxc"))
+sys.path.insert(2, os.path.dirname(BENCHDIR))
+
+from ottolib import archive, configgenerator, container, utils
+from stubs import DeltaGenerator, Sandbox
+
+FORMAT = 1
+DEFAULT_SIZES = "10M,100M,1G"
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+# Deltas from this size are archived only once
+LARGE_DELTA = 1024 ** 3
+CONFIG_WRITES = 1000
+
+
+def parse_size(value):
+    """ Return the number of bytes of a size like 100M """
+    value = value.strip().upper()
+    if value[-1:] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+def format_size(size):
+    for unit in ("G", "M", "K"):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return "{}{}".format(size // UNITS[unit], unit)
+    return str(size)
+
+
+def git_commit():
+    """ Return the commit of the tree being measured """
+    try:
+        return subprocess.check_output(
+            ["git", "-C", os.path.dirname(BENCHDIR), "rev-parse", "HEAD"],
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(durations, size=None, operations=None):
+    """ Return the result of a benchmark from the duration of its runs
+
+    @size: bytes processed by a run, for the throughput
+    @operations: operations done by a run, for the rate
+    """
+    median = statistics.median(durations)
+    result = {"runs": [round(d, 6) for d in durations],
+              "min": round(min(durations), 6),
+              "median": round(median, 6),
+              "mean": round(statistics.mean(durations), 6)}
+    if size is not None:
+        result["bytes"] = size
+        result["mb_per_s"] = round(size / 1024 ** 2 / median, 2) if median else None
+    if operations is not None:
+        result["operations"] = operations
+        result["ops_per_s"] = round(operations / median, 1) if median else None
+    return result
+
+
+def measure(func, repeat, setup=None):
+    """ Return the durations of repeat runs of func, setup isn't measured """
+    durations = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+class Benchmarks(object):
+    """ Benchmarks run in a sandbox with a fake lxc """
+
+    def __init__(self, sandbox, repeat, sizes):
+        self.sandbox = sandbox
+        self.repeat = repeat
+        self.sizes = sizes
+        self.results = {}
+
+    def record(self, name, result):
+        self.results[name] = result
+        rate = ""
+        if "mb_per_s" in result:
+            rate = " {} MB/s".format(result["mb_per_s"])
+        elif "ops_per_s" in result:
+            rate = " {} ops/s".format(result["ops_per_s"])
+        logger.info("{:<32} median {:.6f}s{}".format(name, result["median"], rate))
+
+    def run(self):
+        self.bench_container()
+        self.bench_config()
+        self.bench_copy_otto_files()
+        for size in self.sizes:
+            self.bench_archive(size)
+        return self.results
+
+    def bench_container(self):
+        """ Overhead of create, start and stop with a fake lxc """
+        names = iter("create{}".format(i) for i in range(self.repeat))
+        created = []
+
+        def create():
+            name = next(names)
+            container.Container(name, create=True).create(self.sandbox.image)
+            created.append(name)
+
+        self.record("container.create", summarize(measure(create, self.repeat)))
+        for name in created[1:]:
+            container.Container(name).destroy()
+
+        bench = container.Container(created[0])
+
+        def stopped():
+            if bench.running:
+                bench.stop()
+            bench.reset_timings()
+
+        self.record("container.start", summarize(
+            measure(bench.start, self.repeat, setup=stopped)))
+        bench.stop()
+        self.record("container.stop", summarize(
+            measure(bench.stop, self.repeat, setup=bench.start)))
+        self.container = bench
+
+    def bench_config(self):
+        """ Writes of the configuration of a run """
+        path = self.sandbox.path("config.bench")
+
+        def unbatched():
+            config = configgenerator.ConfigGenerator(path)
+            for i in range(CONFIG_WRITES):
+                setattr(config, "key{}".format(i % 50), i)
+
+        def batched():
+            config = configgenerator.ConfigGenerator(path)
+            with config.batch():
+                for i in range(CONFIG_WRITES):
+                    setattr(config, "key{}".format(i % 50), i)
+
+        def remove():
+            with utils.ignored(FileNotFoundError):
+                os.remove(path)
+
+        self.record("config.write", summarize(
+            measure(unbatched, self.repeat, setup=remove), operations=CONFIG_WRITES))
+        self.record("config.write-batch", summarize(
+            measure(batched, self.repeat, setup=remove), operations=CONFIG_WRITES))
+
+    def bench_copy_otto_files(self):
+        """ Refresh of the tools of a container, from scratch and unchanged """
+        bench = self.container
+
+        def clean():
+            shutil.rmtree(os.path.join(bench.containerpath, "tools"), ignore_errors=True)
+            for name in ("config", "fstab"):
+                with utils.ignored(FileNotFoundError):
+                    os.remove(os.path.join(bench.containerpath, name))
+
+        self.record("copy_otto_files.cold", summarize(
+            measure(bench._copy_otto_files, self.repeat, setup=clean)))
+        self.record("copy_otto_files.warm", summarize(
+            measure(bench._copy_otto_files, self.repeat)))
+
+    def bench_archive(self, size):
+        """ Archive and restore of a synthetic delta, compressed and deduplicated """
+        bench = self.container
+        label = format_size(size)
+        free = shutil.disk_usage(self.sandbox.root).free
+        # the delta, its archive and the chunk store
+        if free < size * 3:
+            logger.warning("Skipping the {} delta, only {} bytes free".format(label, free))
+            self.results["archive.create." + label] = {"skipped": "not enough disk space"}
+            return
+        repeat = 1 if size >= LARGE_DELTA else self.repeat
+        bench.remove_delta()
+        (files, written) = DeltaGenerator().write(os.path.join(bench.rundir, "delta"), size)
+        logger.debug("Delta of {} files and {} bytes".format(files, written))
+
+        paths = []
+
+        def create(dedup):
+            paths.append(bench.archive(dedup=dedup))
+
+        def restore():
+            bench.restore(paths[-1])
+
+        def clear_store():
+            shutil.rmtree(bench.storepath, ignore_errors=True)
+
+        self.record("archive.create." + label, summarize(
+            measure(lambda: create(False), repeat), size=written))
+        self.record("archive.restore." + label, summarize(
+            measure(restore, repeat), size=written))
+        os.remove(paths.pop())
+        self.record("dedup.archive." + label, summarize(
+            measure(lambda: create(True), repeat, setup=clear_store), size=written))
+        self.record("dedup.restore." + label, summarize(
+            measure(restore, repeat), size=written))
+        os.remove(paths.pop())
+        clear_store()
+        bench.remove_delta()
+
+
+def compare(results, baseline):
+    """ Log the ratio of the medians of results to the ones of baseline """
+    logger.info("Compared to {} ({})".format(baseline.get("commit"), baseline.get("date")))
+    for (name, result) in sorted(results["results"].items()):
+        old = baseline["results"].get(name, {}).get("median")
+        if "median" not in result or not old:
+            continue
+        logger.info("{:<32} {:>10.6f}s -> {:>10.6f}s {:>+7.1%}".format(
+            name, old, result["median"], result["median"] / old - 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the overhead of otto")
+    parser.add_argument("-o", "--output",
+                        help="JSON file of the results (default: bench-COMMIT.json)")
+    parser.add_argument("-n", "--repeat", type=int, default=5,
+                        help="runs of each benchmark (default: 5)")
+    parser.add_argument("-s", "--sizes", default=DEFAULT_SIZES,
+                        help="sizes of the synthetic deltas, from 10M to 10G "
+                             "(default: {})".format(DEFAULT_SIZES))
+    parser.add_argument("-w", "--workdir",
+                        help="directory of the sandbox (default: $TMPDIR)")
+    parser.add_argument("--compare", metavar="OLD.json",
+                        help="compare the results to a previous run")
+    parser.add_argument("-d", "--debug", action="store_true",
+                        help="log the messages of otto")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    # ottolib is verbose at the info level
+    logging.getLogger("ottolib").setLevel(logging.DEBUG if args.debug else logging.WARNING)
+
+    sizes = [parse_size(size) for size in args.sizes.split(",") if size.strip()]
+    commit = git_commit()
+    output = args.output or "bench-{}.json".format((commit or "unknown")[:12])
+
+    with Sandbox(args.workdir) as sandbox:
+        try:
+            compression = archive.default_compression()
+        except archive.ArchiveError as exc:
+            logger.error(exc)
+            return 1
+        results = Benchmarks(sandbox, args.repeat, sizes).run()
+
+    document = {"format": FORMAT,
+                "commit": commit,
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "host": {"kernel": platform.release(),
+                         "cpus": os.cpu_count(),
+                         "memory": utils.host_memory()},
+                "compression": compression,
+                "repeat": args.repeat,
+                "results": results}
+    with open(output, "w") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+    logger.info("Results written to {}".format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(document, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
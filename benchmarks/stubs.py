@@ -0,0 +1,189 @@
+"""
+Sandbox and synthetic data of the benchmarks - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from contextlib import ExitStack
+import logging
+logger = logging.getLogger(__name__)
+import os
+import random
+import shutil
+import tempfile
+from unittest import mock
+
+import lxc
+from ottolib import const, mounts, utils
+
+# Stand-ins of the commands run by ottolib, they are executed like the real
+# ones so the cost of spawning them is part of the measures. The ISO is
+# "mounted" by copying a small tree with the layout of an Ubuntu image, in
+# process like the loop mount of ottolib.mounts or by the mount fallback.
+COMMANDS = {
+    "mount": 'for last; do :; done\ncp -a "$OTTO_BENCH_ISO"/. "$last"',
+    "umount": "exit 0",
+    "losetup": "exit 0",
+    "modprobe": "exit 0",
+    "lspci": "exit 0",
+    "dpkg": "echo amd64",
+}
+
+ISO_FILES = {
+    ".disk/info": 'Ubuntu 13.10 "Saucy Salamander" - Alpha amd64 (20130901)',
+    "dists/saucy/Release": "",
+    "README.diskdefines": "#define DISKNAME  Ubuntu 13.10\n#define ARCH  amd64\n",
+    "casper/filesystem.squashfs": "",
+}
+
+# Sizes of the files of a synthetic delta and their share of its size: many
+# small configuration and cache files, some libraries and a few large files
+FILE_SIZES = ((4 * 1024, 0.10), (64 * 1024, 0.20), (1024 ** 2, 0.30),
+              (16 * 1024 ** 2, 0.40))
+# Data the files are cut from, half random and half text
+POOL_SIZE = 64 * 1024 ** 2
+POOL_BLOCK = 64 * 1024
+# Share of the files which are a copy of another one
+DUPLICATES = 0.1
+
+
+class Sandbox(object):
+    """ Run ottolib without root, python3-lxc or an ISO image
+
+    The lxc module is replaced by benchmarks/fakelxc, the paths of otto
+    point to a temporary directory and the external commands are found
+    first in its bin directory.
+    """
+
+    def __init__(self, workdir=None):
+        self.workdir = workdir
+        self.root = None
+        self._stack = None
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def _write_commands(self):
+        os.makedirs(self.path("bin"))
+        for (name, body) in COMMANDS.items():
+            path = self.path("bin", name)
+            with open(path, "w") as f:
+                f.write("#!/bin/sh\n{}\n".format(body))
+            utils.set_executable(path)
+
+    def _write_iso(self):
+        for (name, content) in ISO_FILES.items():
+            path = self.path("isotree", name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write(content)
+        # only its path and its inode matter to otto
+        self.image = self.path("ubuntu-13.10-desktop-amd64.iso")
+        with open(self.image, "wb") as f:
+            f.write(b"\0" * 32768 + b"\1CD001")
+
+    def __enter__(self):
+        self.root = tempfile.mkdtemp(prefix="otto-bench.", dir=self.workdir)
+        self._stack = ExitStack()
+        try:
+            self._write_commands()
+            self._write_iso()
+            for name in ("lxc", "cache", "iso"):
+                os.makedirs(self.path(name))
+            env = {"PATH": self.path("bin") + os.pathsep + os.environ.get("PATH", ""),
+                   "OTTO_BENCH_ISO": self.path("isotree")}
+            self._stack.enter_context(mock.patch.dict(os.environ, env))
+            self._stack.enter_context(mock.patch.object(const, "LXCBASE", self.path("lxc")))
+            self._stack.enter_context(mock.patch.object(lxc, "default_config_path",
+                                                        self.path("lxc")))
+            self._stack.enter_context(mock.patch.object(const, "CACHEDIR", self.path("cache")))
+            self._stack.enter_context(mock.patch.object(const, "APT_CACHE_DIR",
+                                                        self.path("cache", "apt")))
+            self._stack.enter_context(mock.patch.object(
+                utils, "iso_mount_path",
+                lambda image: self.path("iso", image.replace("/", "_"))))
+            self._stack.enter_context(mock.patch.object(
+                mounts, "is_mountpoint",
+                lambda path, mounted=None: os.path.exists(os.path.join(path, ".disk", "info"))))
+            self._stack.enter_context(mock.patch.object(
+                mounts, "loop_mount",
+                lambda image, target, fstype: shutil.copytree(
+                    self.path("isotree"), target, dirs_exist_ok=True)))
+            self._stack.enter_context(mock.patch("os.getuid", return_value=0))
+        except BaseException:
+            self.__exit__(None, None, None)
+            raise
+        return self
+
+    def __exit__(self, *args):
+        self._stack.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class DeltaGenerator(object):
+    """ Write synthetic deltas of a given size
+
+    The content is deterministic for a seed so the deltas are the same from
+    one commit to the other.
+    """
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        blocks = []
+        text = b"".join(b"Setting up package-%06d (1.0-0ubuntu%d) ...\n" % (i, i % 7)
+                        for i in range(POOL_BLOCK // 40))[:POOL_BLOCK]
+        for i in range(POOL_SIZE // POOL_BLOCK):
+            blocks.append(self.random.randbytes(POOL_BLOCK) if i % 2 else text)
+        self.pool = b"".join(blocks)
+
+    def _sizes(self, size):
+        """ Return the sizes of the files of a delta of size bytes """
+        sizes = []
+        for (filesize, share) in FILE_SIZES:
+            count = max(1, int(size * share) // filesize)
+            sizes.extend([filesize] * count)
+        self.random.shuffle(sizes)
+        return sizes
+
+    def write(self, destdir, size):
+        """ Write a delta of about size bytes in destdir
+
+        @return: (number of files, number of bytes) written
+        """
+        files = written = 0
+        previous = []
+        for filesize in self._sizes(size):
+            dirpath = os.path.join(destdir, "usr", "share", "bench{:03d}".format(files // 256))
+            if files % 256 == 0:
+                os.makedirs(dirpath, exist_ok=True)
+            path = os.path.join(dirpath, "file{:06d}".format(files))
+            if previous and self.random.random() < DUPLICATES:
+                shutil.copyfile(self.random.choice(previous), path)
+            else:
+                with open(path, "wb") as f:
+                    remaining = filesize
+                    while remaining:
+                        chunk = min(remaining, POOL_SIZE // 2)
+                        offset = self.random.randrange(0, POOL_SIZE - chunk + 1)
+                        f.write(self.pool[offset:offset + chunk])
+                        remaining -= chunk
+                if filesize <= 64 * 1024:
+                    previous.append(path)
+            files += 1
+            written += filesize
+        return (files, written)
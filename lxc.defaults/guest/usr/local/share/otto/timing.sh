@@ -0,0 +1,64 @@
+# Timing spans of the phases of a run
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+#
+# This file is sourced by otto-setup in the guest and by the hooks and
+# otto-run on the host. Each span is appended as a JSON line to $TIMINGS,
+# otto merges them in timings.json with the results.
+#
+# Usage:
+#   span_begin apt-update
+#   apt-get update
+#   span_end apt-update $?
+
+TIMINGS=${TIMINGS:-/var/local/otto/timings.jsonl}
+TIMING_SOURCE=${TIMING_SOURCE:-$(basename $0)}
+
+_span_var() {
+    # Name of the variable holding the start time of span $1
+    echo "_span_$(echo "$1" | tr -c 'a-zA-Z0-9\n' '_')"
+}
+
+_span_json() {
+    # $1 as the content of a JSON string: quotes and backslashes escaped,
+    # control characters dropped
+    printf '%s' "$1" | tr -d '\000-\037' | sed 's/[\\"]/\\&/g'
+}
+
+span_begin() {
+    # Starts the span $1
+    eval "$(_span_var "$1")=$(date +%s.%N)"
+}
+
+span_end() {
+    # Ends the span $1 and records it
+    #
+    # $1: name of the span
+    # $2: optional exit status of the phase
+    _span_name=$(_span_var "$1")
+    eval "_span_start=\${$_span_name:-}"
+    [ -z "$_span_start" ] && return 0
+    _span_end=$(date +%s.%N)
+    mkdir -p "$(dirname "$TIMINGS")" 2>/dev/null || true
+    printf '{"name": "%s", "source": "%s", "start": %s, "end": %s, "duration": %s, "status": %s}\n' \
+        "$(_span_json "$1")" "$(_span_json "$TIMING_SOURCE")" "$_span_start" "$_span_end" \
+        "$(awk "BEGIN {printf \"%.3f\", $_span_end - $_span_start}")" \
+        "${2:-0}" >> "$TIMINGS" 2>/dev/null || true
+    unset $_span_name
+    return 0
+}
@@ -25,6 +25,10 @@
 BASEDIR=$(dirname $LXC_CONFIG_FILE)
 RUNDIR=$BASEDIR/run
 ARCHIVE=""
+COMMAND=""
+ARCHIVE_COMPRESSION=""
+ARCHIVE_BACKEND=""
+OTTODIR=""
 COMPRESSPROG="$(which pigz 2>/dev/null)" || true
 [ -z "$COMPRESSPROG" ] && echo "W: pigz is not installed, falling back to gzip" && COMPRESSPROG=gzip
 POSTSTOP_FLAG=$BASEDIR/.post-stop.done
@@ -43,26 +47,57 @@ if [ -r "$LOCAL_CONFIG" ]; then
     . $LOCAL_CONFIG
 fi
 
+# timing spans of the phases of the run, merged by otto with the results
+TIMINGS=$RUNDIR/timings.jsonl
+TIMING_SOURCE=post-stop
+. $BASEDIR/tools/guest/usr/local/share/otto/timing.sh
+
 archive() {
+    # otto streams the run directory to a multi-threaded compressor, tar is
+    # only used if otto isn't available
+    if [ -x "$OTTODIR/bin/otto" ]; then
+        # make room for the archive within the disk budgets
+        "$OTTODIR/bin/otto" gc --post-stop $LXC_NAME || echo "W: otto gc failed"
+        compression=""
+        [ -n "$ARCHIVE_COMPRESSION" ] && compression="-c $ARCHIVE_COMPRESSION"
+        # ARCHIVE_BACKEND=dedup stores the files once across runs
+        [ "$ARCHIVE_BACKEND" = "dedup" ] && compression="$compression --dedup"
+        if "$OTTODIR/bin/otto" archive create $compression $LXC_NAME; then
+            return
+        fi
+        echo "W: otto failed to archive the run, falling back to tar"
+    fi
+
     ARCHIVEDIR="$BASEDIR/$ARCHIVEDIR"
     mkdir -p "$ARCHIVEDIR"
     previous_dir=$(pwd)
     cd $RUNDIR
-    tar cf "$ARCHIVEDIR/$ISOID.$RUNID.otto" -I $COMPRESSPROG --exclude="delta/tmp/rMD*" .
+    tar cf "$ARCHIVEDIR/$ISOID.$RUNID.otto" -I $COMPRESSPROG --xattrs --xattrs-include='trusted.*' --exclude="delta/tmp/rMD*" --exclude="./.work" .
     cd $previous_dir
 }
 
 unmount_fs() {
-    squashfs_dir="$BASEDIR/squashfs"
-
-    umount.aufs $LXC_ROOTFS_PATH || true
-    umount $squashfs_dir || true
+    # otto knows the mounts and loop devices of the rootfs, the runs started
+    # by older versions of otto only used aufs
+    if [ ! -x "$OTTODIR/bin/otto" ] || ! "$OTTODIR/bin/otto" rootfs umount $LXC_NAME; then
+        squashfs_dir="$BASEDIR/squashfs"
+        if which umount.aufs >/dev/null 2>&1; then
+            umount.aufs $LXC_ROOTFS_PATH || true
+        fi
+        umount $LXC_ROOTFS_PATH || true
+        umount $squashfs_dir || true
+    fi
     umount $ISOMOUNT || true
 }
 
-unmount_fs $SQUASHFS
+span_begin post-stop.unmount
+unmount_fs
+span_end post-stop.unmount
 
-if [ "$ARCHIVE" = "True" ] ; then
+# the build of a package layer isn't a run
+if [ "$ARCHIVE" = "True" -a "$COMMAND" != "layer" ] ; then
+    span_begin post-stop.archive
     archive
+    span_end post-stop.archive
 fi
 touch "$POSTSTOP_FLAG"
@@ -27,6 +27,8 @@ rootfs=$LXC_ROOTFS_PATH
 TESTUSER=ubuntu
 
 APT_ARCHIVE=""
+COMMAND=""
+WARM=""
 DISABLE_NETWORK_MANAGER=""
 PROXY=""
 
@@ -43,6 +45,11 @@ if [ -r "$LOCAL_CONFIG" ]; then
     . $LOCAL_CONFIG
 fi
 
+# timing spans of the phases of the run, merged by otto with the results
+TIMINGS=$RUNDIR/timings.jsonl
+TIMING_SOURCE=pre-mount
+. $BASEDIR/tools/guest/usr/local/share/otto/timing.sh
+
 
 prepare_user() {
     # Creates the user in the container and set its privileges
@@ -152,6 +159,20 @@ EOF
         fi
     fi
 
+    # The packages downloaded by the containers are kept in the shared apt
+    # cache, the lists stay in each container
+    aptcacheconf=$rootfs/etc/apt/apt.conf.d/99otto-cache
+    if [ -n "${APTCACHE:-}" ]; then
+        # mount point of the shared archives, apt keeps its own
+        mkdir -p $rootfs/var/cache/otto/apt-archives
+        cat <<EOF > $aptcacheconf
+APT::Keep-Downloaded-Packages "true";
+Binary::apt::APT::Keep-Downloaded-Packages "true";
+EOF
+    else
+        rm -f $aptcacheconf
+    fi
+
     # Disable Whoopsie
     # Apport doesn't work in LXC containers because it does not have access to
     # /proc
@@ -188,8 +209,28 @@ test_setup() {
         rsync -avH $BASEDIR/tools/guest/ $rootfs/
     fi
 
-    # rsync custom-installation directory to rootfs
-    if [ -d "$RUNDIR/target-override" ]; then
+    # Warm containers get the custom installation of their job from otto
+    # once booted, otto-setup waits for it
+    ottobase=$rootfs/var/local/otto
+    rm -f $ottobase/.warm $ottobase/.ready $ottobase/.release
+    if [ "$WARM" = "True" ]; then
+        mkdir -p $ottobase
+        touch $ottobase/.warm
+        return
+    fi
+
+    # Skip the custom installation if the rootfs already has this one, like
+    # when the delta is kept between runs
+    digest=$RUNDIR/.custom-installation.digest
+    installed_digest=$rootfs/var/local/otto/.custom-installation.digest
+    if [ -f "$digest" ] && cmp -s "$digest" "$installed_digest"; then
+        echo "I: Custom installation already installed in the rootfs"
+        return
+    fi
+
+    # rsync custom-installation directory to rootfs, package layers only
+    # contain the packages
+    if [ -d "$RUNDIR/target-override" -a "$COMMAND" != "layer" ]; then
         rsync -avH $RUNDIR/target-override/ $rootfs/
     fi
 
@@ -203,6 +244,9 @@ test_setup() {
         fi
     fi
 
+    if [ -f "$digest" -a "$COMMAND" != "layer" ]; then
+        cp "$digest" "$installed_digest"
+    fi
 }
 
 user_exists() {
@@ -215,6 +259,12 @@ user_exists() {
     fi
 }
 
+span_begin pre-mount.prepare-user
 prepare_user $TESTUSER
+span_end pre-mount.prepare-user
+span_begin pre-mount.configure-system
 configure_system $TESTUSER
+span_end pre-mount.configure-system
+span_begin pre-mount.test-setup
 test_setup $TESTUSER
+span_end pre-mount.test-setup
@@ -26,8 +26,7 @@ BASEDIR=$(dirname $LXC_CONFIG_FILE)
 RUNDIR=$BASEDIR/run
 rootfs=$LXC_ROOTFS_PATH
 TESTUSER=ubuntu
-BASEDELTADIR=""
-COMMAND=""
+OTTODIR=""
 
 # source run specific configuration
 CONFIG=$RUNDIR/config
@@ -42,61 +41,31 @@ if [ -r "$LOCAL_CONFIG" ]; then
     . $LOCAL_CONFIG
 fi
 
+# timing spans of the phases of the run, merged by otto with the results
+TIMINGS=$RUNDIR/timings.jsonl
+TIMING_SOURCE=pre-start
+. $BASEDIR/tools/guest/usr/local/share/otto/timing.sh
+
 prepare_fs() {
     # This function prepares the container with the directories required to
-    # expose hardware from the host to the container, mounts the ISO and
-    # extracts the squashfs and prepares the overlay used to store the delta
-    #
-    # $1: Path to squashfs file
-
-    IMAGE="$BASEDIR/$IMAGE"
-    if ! mountpoint -q $ISOMOUNT; then
-        echo "I: $ISOMOUNT not mounted yet, creating and mounting"
-        mkdir -p $ISOMOUNT
-        mount -n -o loop $IMAGE $ISOMOUNT
-    fi
-    squashfs_path=$(readlink -f $1)
-
-    if [ ! -r "$squashfs_path" ]; then
-        echo "E: File doesn't exist '$squashfs_path'. Exiting!"
+    # expose hardware from the host to the container, mounts the squashfs of
+    # the ISO and the union filesystem used to store the delta. otto picks
+    # the branches of the run and the union filesystem of the container.
+
+    span_begin pre-start.mount
+    if ! "$OTTODIR/bin/otto" rootfs mount $LXC_NAME $LXC_ROOTFS_PATH; then
+        span_end pre-start.mount 1
+        echo "E: Failed to mount the rootfs. Exiting!"
         exit 1
     fi
-
-    modprobe aufs
-
-    # base delta is an optional base delta parameter from which to upgrade the base system
-    # or mount a previous base delta
-
-    # delta_dir is the overlay and will contain all the files that have been
-    # changed in the container
-    delta_dir="$RUNDIR/delta"
-    mkdir -p $delta_dir
-
-    # Mount the squashfs
-    squashfs_dir="$(dirname $LXC_CONFIG_FILE)/squashfs"
-    mkdir -p $squashfs_dir
-    mount -n -o loop,ro $squashfs_path $squashfs_dir
-
-    # FIXME: Overlayfs leaks loop devices
-    #mount -n -t overlayfs -o upperdir=$delta_dir,lowerdir=$SQUASHFS_DIR overlayfs $LXC_ROOTFS_PATH
-    if [ -z "$BASEDELTADIR" ] ; then
-        mount -n -t aufs -o br=$delta_dir=rw:$squashfs_dir=ro aufs $LXC_ROOTFS_PATH
-    elif [ "$COMMAND" = "upgrade" ]; then
-        BASEDELTADIR="$BASEDIR/$BASEDELTADIR"
-        mount -n -t aufs -o br=$BASEDELTADIR=rw:$squashfs_dir=ro aufs $LXC_ROOTFS_PATH
-        touch $LXC_ROOTFS_PATH/.upgrade
-    else
-        BASEDELTADIR="$BASEDIR/$BASEDELTADIR"
-        mount -n -t aufs -o br=$delta_dir=rw:$BASEDELTADIR=ro:$squashfs_dir=ro aufs $LXC_ROOTFS_PATH
-    fi
-    umount -l $squashfs_dir
+    span_end pre-start.mount
 
     # Create hardware devices
     mkdir -p $LXC_ROOTFS_PATH/dev/dri $LXC_ROOTFS_PATH/dev/snd $LXC_ROOTFS_PATH/dev/input
     mkdir -p $LXC_ROOTFS_PATH/var/lxc/udev
 }
 
-prepare_fs $SQUASHFS
+prepare_fs
 
 # TODO: Apply this change on host boot; via setting /sys/fs/cgroup/memory/memory.use_hierarchy
 ## Enable memory limits
@@ -0,0 +1,111 @@
+"""
+Asyncio interface to manage LXC - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import asyncio
+import logging
+logger = logging.getLogger(__name__)
+
+from . import const
+from .container import Container, ContainerError
+
+
+class AsyncContainer(object):
+    """ Awaitable lifecycle of a container
+
+    This wraps a Container so a single event loop can drive many of them.
+    The state of the container is polled without blocking the loop instead
+    of blocking a thread in lxc.Container.wait(). The preparation of a run
+    (mounts, copy of the tools) is short and runs in the default executor.
+
+    Cancelling start() or upgrade() while waiting for the container stops
+    it before propagating the cancellation.
+    """
+
+    def __init__(self, container, poll_interval=const.STATE_POLL_INTERVAL):
+        if not isinstance(container, Container):
+            container = Container(container)
+        self.container = container
+        self.poll_interval = poll_interval
+
+    @property
+    def name(self):
+        return self.container.name
+
+    @property
+    def running(self):
+        return self.container.running
+
+    async def _call(self, func, *args):
+        """ Run a blocking method of the container in the default executor """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    async def wait_state(self, state, timeout=None):
+        """ Wait until the container reaches state
+
+        @state: LXC state like 'RUNNING' or 'STOPPED'
+        @timeout: seconds to wait, forever if None
+
+        @return: True if the state was reached, False on timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self.container.state != state:
+            if deadline is not None and loop.time() >= deadline:
+                return False
+            await asyncio.sleep(self.poll_interval)
+        return True
+
+    async def _stop_on_cancel(self, coro):
+        """ Await coro and stop the container if it is cancelled """
+        try:
+            return await coro
+        except asyncio.CancelledError:
+            logger.info("Cancelled, stopping container '{}'".format(self.name))
+            try:
+                if self.running:
+                    await self._call(self.container._request_stop)
+            except ContainerError as exc:
+                logger.warning("Can't stop container '{}': {}".format(
+                    self.name, exc))
+            raise
+
+    async def start(self, with_delta=False, timeout=const.START_TIMEOUT,
+                    apt_cache=True, warm=False):
+        """ Start the container and wait until it runs """
+        await self._call(self.container._launch, with_delta, apt_cache, warm)
+        if not await self._stop_on_cancel(self.wait_state('RUNNING', timeout)):
+            raise ContainerError("The container didn't start successfully")
+        logger.info("Container '{}' started".format(self.name))
+
+    async def stop(self, timeout=const.STOP_TIMEOUT):
+        """ Stop the container and wait until it is stopped """
+        await self._call(self.container._request_stop)
+        if not await self.wait_state('STOPPED', timeout):
+            raise ContainerError("The container didn't stop successfully")
+        logger.info("Container '{}' stopped".format(self.name))
+
+    async def upgrade(self, timeout=const.UPGRADE_TIMEOUT):
+        """ Run and store a dist-upgrade in the container """
+        basedelta = await self._call(self.container._prepare_upgrade)
+        await self.start()
+        await self._stop_on_cancel(self.wait_state('STOPPED', timeout))
+        self.container._finish_upgrade(basedelta)
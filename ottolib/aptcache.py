@@ -0,0 +1,139 @@
+"""
+Shared cache of the packages installed in the containers - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import contextlib
+import fcntl
+import logging
+logger = logging.getLogger(__name__)
+import os
+
+from . import const, errors, utils
+
+
+class AptCacheError(errors.OttoError):
+    pass
+
+
+class AptCache(object):
+    """ Host side cache of apt, shared by all the containers
+
+    The archives directory is bind-mounted in the containers on
+    GUEST_ARCHIVES so a package is downloaded once for all the runs. apt
+    keeps a private cache of archives in each container: the guests
+    download to the shared one and copy the packages they install, and
+    serialize their downloads with a flock() on LOCK_FILE, which also
+    protects the cache from the eviction done on the host. The lists stay
+    private: apt-get update removes the lists of the sources it doesn't
+    know, which other containers use.
+    """
+
+    LOCK_FILE = "otto.lock"
+    # mount point of the shared archives in the containers
+    GUEST_ARCHIVES = "var/cache/otto/apt-archives"
+
+    def __init__(self, path=const.APT_CACHE_DIR, max_size=const.APT_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.archivesdir = os.path.join(path, "archives")
+        self.lockfile = os.path.join(self.archivesdir, self.LOCK_FILE)
+
+    def prepare(self):
+        """ Create the cache directory and the lock used by the guests """
+        try:
+            os.makedirs(os.path.join(self.archivesdir, "partial"), exist_ok=True)
+            if not os.path.exists(self.lockfile):
+                open(self.lockfile, "a").close()
+        except OSError as exc:
+            raise AptCacheError("Can't create the apt cache {}: {}".format(self.path, exc))
+
+    def fstab_entries(self):
+        """ Return the fstab lines mounting the cache in a container """
+        return ["{} {} none bind 0 0\n".format(self.archivesdir, self.GUEST_ARCHIVES)]
+
+    @contextlib.contextmanager
+    def locked(self):
+        """ Lock the cache against the guests and any apt using it
+
+        The lock of otto is taken first, then the lock apt itself takes on
+        the archives.
+        """
+        with contextlib.ExitStack() as stack:
+            for path in (self.lockfile, os.path.join(self.archivesdir, "lock")):
+                f = stack.enter_context(open(path, "a"))
+                if path == self.lockfile:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                else:
+                    # apt uses fcntl() locks
+                    fcntl.lockf(f, fcntl.LOCK_EX)
+            yield
+
+    def _entries(self):
+        """ Return the (last use, size, path) of the files of the cache """
+        entries = []
+        with utils.ignored(FileNotFoundError):
+            for entry in os.scandir(self.archivesdir):
+                if entry.name in ("lock", self.LOCK_FILE) or \
+                        not entry.is_file(follow_symlinks=False):
+                    continue
+                stt = entry.stat(follow_symlinks=False)
+                # atime isn't updated on relatime mounts until mtime is
+                # older, take the most recent of both
+                entries.append((max(stt.st_atime, stt.st_mtime),
+                                stt.st_size, entry.path))
+        return entries
+
+    def usage(self):
+        """ Return the size of the cache in bytes """
+        return sum(size for (_, size, _) in self._entries())
+
+    def evict(self, max_size=None, dry_run=False):
+        """ Remove the least recently used files until the cache fits
+
+        @max_size: size of the cache in bytes, self.max_size if None
+        @dry_run: only report what would be removed
+
+        @return: (number of files, bytes) removed
+        """
+        if max_size is None:
+            max_size = self.max_size
+        count = removed = 0
+        if not os.path.isdir(self.archivesdir):
+            return (count, removed)
+        try:
+            with self.locked():
+                entries = sorted(self._entries())
+                size = sum(size for (_, size, _) in entries)
+                for (_, filesize, path) in entries:
+                    if size <= max_size:
+                        break
+                    if not dry_run:
+                        with utils.ignored(FileNotFoundError):
+                            os.remove(path)
+                    size -= filesize
+                    removed += filesize
+                    count += 1
+        except OSError as exc:
+            raise AptCacheError("Can't evict files from the apt cache {}: {}".format(
+                self.path, exc))
+        if count:
+            logger.info("Evicted {} files ({} bytes) from the apt cache".format(
+                count, removed))
+        return (count, removed)
@@ -0,0 +1,764 @@
+"""
+Archiving of container runs - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Didier Roche <didier.roche@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import bisect
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import fnmatch
+import gzip
+import hashlib
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import errors
+from .utils import ignored
+
+# compression -> (compress command, decompress command)
+# All of them write to stdout and read from stdin, zstd and pigz use all the
+# cores of the host.
+COMPRESSORS = {
+    "zstd": (["zstd", "-q", "-T0", "-3", "-c"], ["zstd", "-q", "-d", "-c"]),
+    "pigz": (["pigz", "-c"], ["pigz", "-d", "-c"]),
+    "gzip": (["gzip", "-c"], ["gzip", "-d", "-c"]),
+}
+
+# Files of the run directory which are never archived: temporary files of
+# aufs and the work directory of overlayfs
+EXCLUDES = ("./delta/tmp/rMD*", "./.work")
+
+# Extended attributes kept in the archives: overlayfs marks the opaque
+# directories and the renamed directories of the delta with them. They are
+# stored like GNU tar --xattrs does, in pax headers.
+XATTR_PREFIXES = ("trusted.overlay.",)
+PAX_XATTR = "SCHILY.xattr."
+
+BUFSIZE = 1024 * 1024
+# Files up to this size are written by the pool of workers on extraction
+THREADED_FILE_SIZE = 4 * 1024 * 1024
+
+# Header of the manifests of the chunk store
+MANIFEST_MAGIC = b"OTTOMANIFEST1\n"
+
+# Seekable archives are a sequence of independent gzip members or zstd
+# frames, each holding FRAME_SIZE bytes of the tar stream. gzip and zstd
+# read them like any other archive, and the sidecar index written next to
+# them gives where the content of each member is.
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+FRAME_SIZE = 1024 * 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# type of a tar member -> type of the entries of the index, the same as in
+# the manifests of the chunk store
+MEMBER_TYPES = {
+    tarfile.REGTYPE: "file",
+    tarfile.AREGTYPE: "file",
+    tarfile.DIRTYPE: "dir",
+    tarfile.SYMTYPE: "symlink",
+    tarfile.LNKTYPE: "hardlink",
+    tarfile.CHRTYPE: "char",
+    tarfile.BLKTYPE: "block",
+    tarfile.FIFOTYPE: "fifo",
+}
+
+
+class ArchiveError(errors.OttoError):
+    pass
+
+
+def seekable_compressions():
+    """ Return the compressions otto writes itself, with an index
+
+    gzip only needs zlib, zstd needs the zstandard module.
+    """
+    if zstandard is not None:
+        return ("zstd", "gzip")
+    return ("gzip",)
+
+
+def default_compression():
+    """ Return the best compression available on this host
+
+    A seekable compression is preferred, so single files can be read from
+    the archive without decompressing all of it.
+    """
+    return seekable_compressions()[0]
+
+
+def detect_format(path):
+    """ Return the compression of an archive from its magic number
+
+    @path: Path to the archive
+
+    @return: "zstd", "gzip" or "manifest" for a deduplicated archive
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(MANIFEST_MAGIC))
+    if magic == MANIFEST_MAGIC:
+        return "manifest"
+    elif magic[:4] == b"\x28\xb5\x2f\xfd":
+        return "zstd"
+    elif magic[:2] == b"\x1f\x8b":
+        return "gzip"
+    raise ArchiveError("Unknown archive format for {}".format(path))
+
+
+def _decompressor(compression):
+    """ Return the command to decompress an archive of this format """
+    if compression == "gzip" and shutil.which("pigz"):
+        # pigz decompresses faster and reads gzip archives
+        compression = "pigz"
+    cmd = COMPRESSORS[compression][1]
+    if not shutil.which(cmd[0]):
+        raise ArchiveError("{} is missing to read a {} archive".format(
+            cmd[0], compression))
+    return cmd
+
+
+def _compress_frame(compression, data):
+    """ Return a frame as an independent gzip member or zstd frame """
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _decompress_frame(compression, data):
+    if compression == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data, 31)
+
+
+class _FramedWriter(object):
+    """ Write-only file object compressing its content in independent frames
+
+    The frames are compressed by a pool of workers, zlib and zstandard
+    release the GIL, and written in order.
+    """
+
+    def __init__(self, fout, compression, executor, workers):
+        self.fout = fout
+        self.compression = compression
+        self.executor = executor
+        # bounds the memory used by the frames being compressed
+        self.max_pending = workers * 2
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        # [compressed offset, compressed size, offset, size] of each frame
+        self.frames = []
+        self.offset = 0
+        self.compressed_offset = 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= FRAME_SIZE:
+            self._submit(bytes(self.buffer[:FRAME_SIZE]))
+            del self.buffer[:FRAME_SIZE]
+        return len(data)
+
+    def _submit(self, frame):
+        future = self.executor.submit(_compress_frame, self.compression, frame)
+        self.pending.append((len(frame), future))
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        (size, future) = self.pending.popleft()
+        data = future.result()
+        self.fout.write(data)
+        self.frames.append([self.compressed_offset, len(data), self.offset, size])
+        self.compressed_offset += len(data)
+        self.offset += size
+
+    def finish(self):
+        """ Compress and write what is left """
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_next()
+
+
+def read_xattrs(path):
+    """ Return the extended attributes of a file which are archived
+
+    Listing the trusted attributes requires CAP_SYS_ADMIN, nothing is
+    returned without it. Symbolic links are not followed.
+
+    @return: dict of the names and the values, as bytes, of the attributes
+    """
+    xattrs = {}
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+    except OSError:
+        # the filesystem doesn't support extended attributes
+        return xattrs
+    for name in names:
+        if name.startswith(XATTR_PREFIXES):
+            with ignored(OSError):
+                xattrs[name] = os.getxattr(path, name, follow_symlinks=False)
+    return xattrs
+
+
+def write_xattrs(path, xattrs):
+    """ Set the extended attributes returned by read_xattrs() on a file """
+    for (name, value) in sorted(xattrs.items()):
+        try:
+            os.setxattr(path, name, value, follow_symlinks=False)
+        except OSError as exc:
+            logger.warning("Can't restore attribute {} of {}: {}".format(name, path, exc))
+
+
+def member_xattrs(tarinfo):
+    """ Return the extended attributes of a member of an archive """
+    return {key[len(PAX_XATTR):]: value.encode("utf-8", "surrogateescape")
+            for (key, value) in tarinfo.pax_headers.items()
+            if key.startswith(PAX_XATTR)}
+
+
+class _XattrTarFile(tarfile.TarFile):
+    """ TarFile archiving the extended attributes of the files it adds """
+
+    format = tarfile.PAX_FORMAT
+
+    def gettarinfo(self, name=None, arcname=None, fileobj=None):
+        tarinfo = super().gettarinfo(name, arcname, fileobj)
+        if tarinfo is not None and name is not None:
+            for (key, value) in read_xattrs(name).items():
+                # binary values are written as is with hdrcharset=BINARY
+                tarinfo.pax_headers[PAX_XATTR + key] = value.decode(
+                    "utf-8", "surrogateescape")
+        return tarinfo
+
+
+class _HashingReader(object):
+    """ Compute the sha256 of what is read from a file object """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        return data
+
+
+class _IndexingTarFile(_XattrTarFile):
+    """ TarFile recording the entries of the index of what it writes """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.entries = []
+
+    def addfile(self, tarinfo, fileobj=None):
+        if fileobj is not None:
+            fileobj = _HashingReader(fileobj)
+        super().addfile(tarinfo, fileobj)
+        entry = {"path": tarinfo.name, "type": MEMBER_TYPES.get(tarinfo.type, "other"),
+                 "mode": tarinfo.mode, "uid": tarinfo.uid, "gid": tarinfo.gid,
+                 "mtime": int(tarinfo.mtime * 10 ** 9)}
+        if tarinfo.isreg():
+            # the content is just before the padding to the next block
+            blocks = -(-tarinfo.size // tarfile.BLOCKSIZE)
+            entry["offset"] = self.offset - blocks * tarfile.BLOCKSIZE
+            entry["size"] = tarinfo.size
+            entry["sha256"] = (fileobj or _HashingReader(None)).sha256.hexdigest()
+        elif tarinfo.issym() or tarinfo.islnk():
+            entry["target"] = tarinfo.linkname
+        self.entries.append(entry)
+
+
+def _exclude_filter(excludes):
+    def exclude_filter(tarinfo):
+        for pattern in excludes:
+            if fnmatch.fnmatch(tarinfo.name, pattern):
+                return None
+        return tarinfo
+    return exclude_filter
+
+
+def _write_index(path, header, entries):
+    """ Write the index of an archive, a header and one line per member """
+    tmppath = path + ".partial"
+    try:
+        with gzip.open(tmppath, "wt") as f:
+            f.write(json.dumps(header, sort_keys=True) + "\n")
+            for entry in entries:
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+        os.replace(tmppath, path)
+    except BaseException:
+        with ignored(OSError):
+            os.remove(tmppath)
+        raise
+
+
+def _create_seekable(srcdir, tmpdest, compression, excludes, workers):
+    """ Write a seekable archive and return its index """
+    with open(tmpdest, "wb") as fout, ThreadPoolExecutor(workers) as executor:
+        writer = _FramedWriter(fout, compression, executor, workers)
+        with _IndexingTarFile.open(fileobj=writer, mode="w|",
+                                   bufsize=BUFSIZE) as tar:
+            tar.add(srcdir, arcname=".", filter=_exclude_filter(excludes))
+        writer.finish()
+    header = {"version": INDEX_VERSION, "compression": compression,
+              "archive_size": writer.compressed_offset, "frames": writer.frames}
+    return (header, tar.entries)
+
+
+def create_archive(srcdir, dest, compression=None, excludes=EXCLUDES,
+                   workers=None):
+    """ Archive a directory into a compressed tarball
+
+    The tar stream is generated in-process and compressed by a pool of
+    workers, or piped to a multi-threaded compressor for the compressions
+    which aren't seekable. Nothing is written to disk except the final
+    archive and its index, the archive is only moved to its final path once
+    complete.
+
+    @srcdir: directory to archive
+    @dest: path to the archive
+    @compression: one of COMPRESSORS, the best available if None
+    @excludes: patterns of paths, relative to srcdir, to leave out
+    @workers: Number of threads compressing the archive, one per core if None
+    """
+    if compression is None:
+        compression = default_compression()
+    if compression not in COMPRESSORS:
+        raise ArchiveError("Unknown compression '{}'".format(compression))
+    logger.info("Archiving {} to {} with {}".format(srcdir, dest, compression))
+    # an index left by a previous archive of the same run is outdated
+    with ignored(FileNotFoundError):
+        os.remove(dest + INDEX_SUFFIX)
+
+    tmpdest = dest + ".partial"
+    try:
+        if compression in seekable_compressions():
+            (header, entries) = _create_seekable(srcdir, tmpdest, compression, excludes,
+                                                 workers or os.cpu_count() or 1)
+            os.replace(tmpdest, dest)
+            _write_index(dest + INDEX_SUFFIX, header, entries)
+            return
+
+        with open(tmpdest, "wb") as fout:
+            proc = subprocess.Popen(COMPRESSORS[compression][0],
+                                    stdin=subprocess.PIPE, stdout=fout)
+            try:
+                with _XattrTarFile.open(fileobj=proc.stdin, mode="w|",
+                                        bufsize=BUFSIZE) as tar:
+                    tar.add(srcdir, arcname=".", filter=_exclude_filter(excludes))
+            finally:
+                proc.stdin.close()
+                ret = proc.wait()
+        if ret != 0:
+            raise ArchiveError("{} failed with status {}".format(compression, ret))
+        os.replace(tmpdest, dest)
+    except BaseException:
+        with ignored(OSError):
+            os.remove(tmpdest)
+        raise
+
+
+def normalize_member(name):
+    """ Return the name of a member as written in the archives, like ./delta """
+    name = os.path.normpath("./" + name.lstrip("/"))
+    return "." if name == "." else "./" + name
+
+
+class ArchiveIndex(object):
+    """ Index of a seekable archive
+
+    It lists the members of the archive with the offset of their content in
+    the tar stream, and the frames of the archive, so a file is read by
+    decompressing only the frames holding it.
+    """
+
+    def __init__(self, path, header, entries):
+        self.path = path
+        self.compression = header["compression"]
+        self.frames = header["frames"]
+        self.entries = entries
+        self._frame_offsets = [frame[2] for frame in self.frames]
+
+    @classmethod
+    def load(cls, path):
+        """ Return the index of an archive
+
+        @path: Path to the archive
+
+        @return: the index, None if the archive has none or it is outdated
+        """
+        try:
+            with gzip.open(path + INDEX_SUFFIX, "rt") as f:
+                header = json.loads(f.readline())
+                entries = [json.loads(line) for line in f]
+            size = os.path.getsize(path)
+        except (OSError, EOFError, ValueError) as exc:
+            if not isinstance(exc, FileNotFoundError):
+                logger.warning("Ignoring the index of {}: {}".format(path, exc))
+            return None
+        if header.get("version") != INDEX_VERSION or header.get("archive_size") != size:
+            logger.warning("Ignoring the outdated index of {}".format(path))
+            return None
+        if header.get("compression") not in seekable_compressions():
+            logger.debug("Can't read {} archives in-process".format(
+                header.get("compression")))
+            return None
+        return cls(path, header, entries)
+
+    def find(self, name):
+        """ Return the entry of a member, following hard links
+
+        @name: path of the member, relative to the root of the archive
+        """
+        name = normalize_member(name)
+        entries = {normalize_member(e["path"]): e for e in self.entries}
+        entry = entries.get(name)
+        while entry is not None and entry["type"] == "hardlink":
+            entry = entries.get(normalize_member(entry["target"]))
+        if entry is None:
+            raise ArchiveError("No member {} in {}".format(name, self.path))
+        return entry
+
+    def _read_frame(self, fin, frame):
+        fin.seek(frame[0])
+        data = _decompress_frame(self.compression, fin.read(frame[1]))
+        if len(data) != frame[3]:
+            raise ArchiveError("Frame at {} of {} is corrupted".format(
+                frame[0], self.path))
+        return data
+
+    def read(self, entry, fout):
+        """ Write the content of a regular file of the archive to fout
+
+        Only the frames holding the file are decompressed, and its content
+        is checked against the checksum of the index.
+
+        @entry: entry of the file, from find()
+        @fout: binary file object
+        """
+        if entry["type"] != "file":
+            raise ArchiveError("{} is a {}, not a file".format(entry["path"],
+                                                               entry["type"]))
+        start = entry["offset"]
+        end = start + entry["size"]
+        sha256 = hashlib.sha256()
+        index = max(bisect.bisect_right(self._frame_offsets, start) - 1, 0)
+        with open(self.path, "rb") as fin:
+            while start < end:
+                frame = self.frames[index]
+                data = self._read_frame(fin, frame)
+                chunk = data[start - frame[2]:end - frame[2]]
+                sha256.update(chunk)
+                fout.write(chunk)
+                start += len(chunk)
+                index += 1
+        if sha256.hexdigest() != entry["sha256"]:
+            raise ArchiveError("Checksum mismatch of {} in {}".format(
+                entry["path"], self.path))
+
+    @contextmanager
+    def reader(self, workers=None):
+        """ Return a file object of the whole tar stream
+
+        The frames are decompressed ahead by a pool of workers.
+        """
+        workers = workers or os.cpu_count() or 1
+        with open(self.path, "rb") as fin, ThreadPoolExecutor(workers) as executor:
+            yield _FramedReader(self._decompressed(fin, executor, workers * 2))
+
+    def _decompressed(self, fin, executor, lookahead):
+        pending = collections.deque()
+        for frame in self.frames:
+            fin.seek(frame[0])
+            pending.append(executor.submit(_decompress_frame, self.compression,
+                                           fin.read(frame[1])))
+            if len(pending) > lookahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class _FramedReader(object):
+    """ Read-only file object over a sequence of decompressed frames """
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.buffer = b""
+        self.position = 0
+
+    def read(self, size=-1):
+        chunks = []
+        while size < 0 or size > 0:
+            if self.position == len(self.buffer):
+                self.buffer = next(self.frames, b"")
+                self.position = 0
+                if not self.buffer:
+                    break
+            end = len(self.buffer) if size < 0 else min(len(self.buffer),
+                                                        self.position + size)
+            chunks.append(self.buffer[self.position:end])
+            if size > 0:
+                size -= end - self.position
+            self.position = end
+        return b"".join(chunks)
+
+
+@contextmanager
+def open_archive(path):
+    """ Open an archive for sequential reading, whatever its compression
+
+    An archive with an index is decompressed in-process by a pool of
+    workers, the others are piped through their decompressor.
+
+    @path: Path to the archive
+
+    @return: a TarFile in stream mode
+    """
+    compression = detect_format(path)
+    if compression == "manifest":
+        raise ArchiveError("{} is a manifest of the chunk store, not a "
+                           "tarball".format(path))
+    index = ArchiveIndex.load(path)
+    if index is not None:
+        with index.reader() as fin, tarfile.open(fileobj=fin, mode="r|",
+                                                 bufsize=BUFSIZE) as tar:
+            yield tar
+        return
+
+    cmd = _decompressor(compression)
+    with open(path, "rb") as fin:
+        proc = subprocess.Popen(cmd, stdin=fin, stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode="r|",
+                              bufsize=BUFSIZE) as tar:
+                yield tar
+        finally:
+            proc.stdout.close()
+            ret = proc.wait()
+    # the process is killed by SIGPIPE if we stopped reading early
+    if ret > 0:
+        raise ArchiveError("{} failed with status {}".format(cmd[0], ret))
+
+
+def _member_entry(tarinfo):
+    """ Return the entry of the index of a member read from a stream """
+    entry = {"path": tarinfo.name, "type": MEMBER_TYPES.get(tarinfo.type, "other"),
+             "mode": tarinfo.mode, "uid": tarinfo.uid, "gid": tarinfo.gid,
+             "mtime": int(tarinfo.mtime * 10 ** 9)}
+    if tarinfo.isreg():
+        entry["size"] = tarinfo.size
+    elif tarinfo.issym() or tarinfo.islnk():
+        entry["target"] = tarinfo.linkname
+    return entry
+
+
+def list_members(path):
+    """ Return the entries of the members of an archive
+
+    They are read from the index if there is one, otherwise the whole
+    archive is decompressed.
+
+    @path: Path to the archive
+    """
+    index = ArchiveIndex.load(path)
+    if index is not None:
+        return index.entries
+    logger.debug("No index for {}, reading all of it".format(path))
+    with open_archive(path) as tar:
+        return [_member_entry(member) for member in tar]
+
+
+def read_member(path, name, fout):
+    """ Write the content of a file of an archive to fout
+
+    @path: Path to the archive
+    @name: path of the file, relative to the root of the archive
+    @fout: binary file object
+    """
+    index = ArchiveIndex.load(path)
+    if index is not None:
+        index.read(index.find(name), fout)
+        return
+    logger.debug("No index for {}, reading it up to {}".format(path, name))
+    name = normalize_member(name)
+    # a hard link comes after its target in the stream, which is read again
+    while True:
+        linkname = None
+        with open_archive(path) as tar:
+            for member in tar:
+                if normalize_member(member.name) != name:
+                    continue
+                if member.islnk():
+                    linkname = normalize_member(member.linkname)
+                    break
+                if not member.isreg():
+                    raise ArchiveError("{} is a {}, not a file".format(
+                        name, MEMBER_TYPES.get(member.type, "other")))
+                shutil.copyfileobj(tar.extractfile(member), fout, BUFSIZE)
+                return
+        if linkname is None:
+            raise ArchiveError("No member {} in {}".format(name, path))
+        name = linkname
+
+
+def entry_mode(entry):
+    """ Return the permissions of an entry like ls, -rw-r--r-- """
+    kind = {"dir": stat.S_IFDIR, "symlink": stat.S_IFLNK, "char": stat.S_IFCHR,
+            "block": stat.S_IFBLK, "fifo": stat.S_IFIFO}.get(entry["type"],
+                                                             stat.S_IFREG)
+    return stat.filemode(kind | entry["mode"])
+
+
+def check_member_path(name, destdir, symlinks, hardlink=None):
+    """ Refuse members which would be written outside of destdir
+
+    @name: path of the member, relative to destdir
+    @destdir: absolute path of the destination directory
+    @symlinks: names of the symbolic links extracted so far
+    @hardlink: target of the member if it is a hard link
+    """
+    target = os.path.abspath(os.path.join(destdir, name))
+    if os.path.commonpath([destdir, target]) != destdir:
+        raise ArchiveError("Attempted path traversal in archive: "
+                           "{}".format(name))
+    if hardlink is not None:
+        linktarget = os.path.abspath(os.path.join(destdir, hardlink))
+        if os.path.commonpath([destdir, linktarget]) != destdir:
+            raise ArchiveError("Attempted path traversal in archive: "
+                               "{} -> {}".format(name, hardlink))
+    # don't write through a symbolic link created by the archive itself
+    parent = os.path.dirname(os.path.normpath(name))
+    while parent not in ("", ".", "/"):
+        if parent in symlinks:
+            raise ArchiveError("Attempted write through a symbolic link in "
+                               "archive: {}".format(name))
+        parent = os.path.dirname(parent)
+
+
+def _set_attrs(tar, member, path):
+    """ Set xattrs, owner, times and permissions of an extracted member """
+    write_xattrs(path, member_xattrs(member))
+    try:
+        tar.chown(member, path, False)
+        tar.utime(member, path)
+        tar.chmod(member, path)
+    except tarfile.ExtractError as exc:
+        logger.warning("Can't restore attributes of {}: {}".format(path, exc))
+
+
+def _write_file(tar, member, path, data):
+    """ Write the content of a regular file and set its attributes """
+    with open(path, "wb") as f:
+        f.write(data)
+    _set_attrs(tar, member, path)
+
+
+def extract_archive(path, destdir, workers=None):
+    """ Extract an archive in a single pass
+
+    Each member is checked before being extracted so the archive is read and
+    decompressed only once. The main thread reads the stream while the
+    content of small files is written by a pool of workers; large files,
+    links and special files are extracted directly from the stream.
+
+    @path: Path to the archive
+    @destdir: Destination directory
+    @workers: Number of threads writing files, one per core if None
+    """
+    destdir = os.path.abspath(destdir)
+    os.makedirs(destdir, exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    # bounds the memory used by the files waiting to be written
+    slots = threading.BoundedSemaphore(workers * 4)
+    pending = {}
+    directories = []
+    symlinks = set()
+
+    def release(future):
+        slots.release()
+
+    with open_archive(path) as tar, ThreadPoolExecutor(workers) as executor:
+        for member in tar:
+            check_member_path(member.name, destdir, symlinks,
+                              member.linkname if member.islnk() else None)
+            name = os.path.normpath(member.name)
+            target = os.path.join(destdir, name)
+            if name in symlinks:
+                # a previous member was a symlink, don't write through it
+                symlinks.discard(name)
+                os.unlink(target)
+            if member.issym():
+                symlinks.add(name)
+
+            if member.isdir():
+                # permissions and times are set once the content is written
+                directories.append(member)
+                with ignored(FileExistsError):
+                    os.makedirs(target, 0o700)
+            elif member.isreg() and member.size <= THREADED_FILE_SIZE:
+                data = tar.extractfile(member).read()
+                slots.acquire()
+                future = executor.submit(_write_file, tar, member, target, data)
+                future.add_done_callback(release)
+                pending[name] = future
+            else:
+                if member.islnk():
+                    linked = pending.pop(os.path.normpath(member.linkname), None)
+                    if linked is not None:
+                        linked.result()
+                tar.extract(member, destdir, set_attrs=True,
+                            **_extract_kwargs())
+                write_xattrs(target, member_xattrs(member))
+        # raise the errors of the workers, if any
+        for future in pending.values():
+            future.result()
+
+        # deepest directories first, like TarFile.extractall()
+        directories.sort(key=lambda m: m.name, reverse=True)
+        for member in directories:
+            _set_attrs(tar, member, os.path.join(destdir, member.name))
+
+
+def _extract_kwargs():
+    """ Members are checked by check_member_path, keep them as they are
+
+    Python versions with extraction filters would otherwise strip setuid bits
+    and absolute symbolic links from the delta.
+    """
+    if hasattr(tarfile, "fully_trusted_filter"):
+        return {"filter": "fully_trusted"}
+    return {}
@@ -0,0 +1,507 @@
+"""
+cgroups of the containers: resources used and limits - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import fcntl
+import glob
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import time
+
+from . import const, errors, utils
+
+# Controllers read on a cgroup v1 hierarchy, cgroup v2 has a single one
+CONTROLLERS = ("memory", "cpuacct", "blkio")
+
+# Columns of the time series, the rates are per second since the previous
+# sample and cpu is in percent of one core
+COLUMNS = ("time", "memory", "cpu", "read_bps", "write_bps", "read_iops",
+           "write_iops")
+
+
+class CgroupError(errors.OttoError):
+    pass
+
+
+def _hierarchies():
+    """ Return the mount points of the cgroup hierarchies
+
+    @return: {controller: mount point}, the key of cgroup v2 is ""
+    """
+    hierarchies = {}
+    with open("/proc/self/mounts") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 4:
+                continue
+            if fields[2] == "cgroup2":
+                hierarchies.setdefault("", fields[1])
+            elif fields[2] == "cgroup":
+                for option in fields[3].split(","):
+                    if option in CONTROLLERS:
+                        hierarchies.setdefault(option, fields[1])
+    return hierarchies
+
+
+def _process_cgroups(pid):
+    """ Return the cgroups of a process as {controller: path} """
+    cgroups = {}
+    try:
+        with open("/proc/{}/cgroup".format(pid)) as f:
+            for line in f:
+                (hierarchy, controllers, path) = line.rstrip("\n").split(":", 2)
+                if hierarchy == "0" and not controllers:
+                    cgroups[""] = path
+                for controller in controllers.split(","):
+                    if controller in CONTROLLERS:
+                        cgroups[controller] = path
+    except (OSError, ValueError) as exc:
+        raise CgroupError("Can't read the cgroups of process {}: {}".format(pid, exc))
+    return cgroups
+
+
+def _container_path(path, name):
+    """ Return the cgroup of the container from the one of a process in it
+
+    The init of the container may be in a child cgroup (init.scope with
+    systemd), the counters of the whole container are in the cgroup named
+    after it: lxc/NAME or lxc.payload.NAME.
+    """
+    parts = path.split("/")
+    for (i, part) in enumerate(parts):
+        if part in (name, "lxc.payload." + name):
+            return "/".join(parts[:i + 1])
+    return path
+
+
+def _parse_keyed(content):
+    """ Parse a flat keyed file like cpu.stat: "key value" per line """
+    values = {}
+    for line in content.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            values[fields[0]] = fields[1]
+    return values
+
+
+def _int(value):
+    """ Return a counter as an int, None if it is "max" or unknown """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class _Counter(object):
+    """ A file of a cgroup, opened once and read again from the start """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        try:
+            self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        except FileNotFoundError:
+            logger.debug("{} not available".format(path))
+
+    def read(self):
+        """ Return the content of the file, None if it doesn't exist
+
+        Raises CgroupError when the cgroup is removed.
+        """
+        if self.fd is None:
+            return None
+        try:
+            return os.pread(self.fd, 64 * 1024, 0).decode()
+        except OSError as exc:
+            raise CgroupError("Can't read {}: {}".format(self.path, exc))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class Cgroup(object):
+    """ Counters of the cgroup of a container, on cgroup v1 or v2
+
+    The cgroup is found from a process of the container, usually its init.
+    """
+
+    def __init__(self, name, pid):
+        self.name = name
+        hierarchies = _hierarchies()
+        cgroups = _process_cgroups(pid)
+        self.dirs = {}
+        for controller in CONTROLLERS:
+            if controller in hierarchies and controller in cgroups:
+                root = hierarchies[controller]
+                path = cgroups[controller]
+            elif "" in hierarchies and "" in cgroups:
+                root = hierarchies[""]
+                path = cgroups[""]
+            else:
+                continue
+            self.dirs[controller] = os.path.join(
+                root, _container_path(path, name).lstrip("/"))
+        if not self.dirs:
+            raise CgroupError("No cgroup found for container '{}'".format(name))
+        self.version = 2 if os.path.exists(
+            os.path.join(next(iter(self.dirs.values())), "cgroup.controllers")) else 1
+        logger.debug("cgroup v{} of '{}': {}".format(self.version, name, self.dirs))
+
+        if self.version == 2:
+            files = {"memory": ("memory", "memory.current"),
+                     "memory_peak": ("memory", "memory.peak"),
+                     "memory_limit": ("memory", "memory.max"),
+                     "cpu": ("cpuacct", "cpu.stat"),
+                     "io": ("blkio", "io.stat")}
+        else:
+            files = {"memory": ("memory", "memory.usage_in_bytes"),
+                     "memory_peak": ("memory", "memory.max_usage_in_bytes"),
+                     "memory_limit": ("memory", "memory.limit_in_bytes"),
+                     "cpu": ("cpuacct", "cpuacct.usage"),
+                     "io_bytes": ("blkio", "blkio.throttle.io_service_bytes"),
+                     "io_ops": ("blkio", "blkio.throttle.io_serviced")}
+        self.counters = {}
+        for (key, (controller, filename)) in files.items():
+            if controller in self.dirs:
+                self.counters[key] = _Counter(os.path.join(self.dirs[controller], filename))
+
+    def _read(self, key):
+        counter = self.counters.get(key)
+        return counter.read() if counter is not None else None
+
+    def _read_io_v1(self):
+        """ Return (read bytes, write bytes, read ops, write ops) on cgroup v1 """
+        values = []
+        for key in ("io_bytes", "io_ops"):
+            totals = {"Read": 0, "Write": 0}
+            for line in (self._read(key) or "").splitlines():
+                fields = line.split()
+                if len(fields) == 3 and fields[1] in totals:
+                    totals[fields[1]] += int(fields[2])
+            values.extend([totals["Read"], totals["Write"]])
+        return (values[0], values[1], values[2], values[3])
+
+    def _read_io_v2(self):
+        """ Return (read bytes, write bytes, read ops, write ops) on cgroup v2 """
+        totals = {"rbytes": 0, "wbytes": 0, "rios": 0, "wios": 0}
+        for line in (self._read("io") or "").splitlines():
+            for field in line.split()[1:]:
+                (key, _, value) = field.partition("=")
+                if key in totals:
+                    totals[key] += int(value)
+        return (totals["rbytes"], totals["wbytes"], totals["rios"], totals["wios"])
+
+    def read(self):
+        """ Read the counters of the cgroup
+
+        @return: dictionary with the time of the sample, memory, memory_peak
+                 and memory_limit in bytes, cpu in seconds and the bytes and
+                 operations of io_read, io_write, io_read_ops, io_write_ops
+                 since the start of the container. Unavailable counters are
+                 None.
+        """
+        sample = {"time": time.time(),
+                  "memory": _int(self._read("memory")),
+                  "memory_peak": _int(self._read("memory_peak")),
+                  "memory_limit": _int(self._read("memory_limit"))}
+        if self.version == 2:
+            usec = _int(_parse_keyed(self._read("cpu") or "").get("usage_usec"))
+            sample["cpu"] = usec / 1e6 if usec is not None else None
+            io = self._read_io_v2()
+        else:
+            nsec = _int(self._read("cpu"))
+            sample["cpu"] = nsec / 1e9 if nsec is not None else None
+            io = self._read_io_v1()
+        (sample["io_read"], sample["io_write"],
+         sample["io_read_ops"], sample["io_write_ops"]) = io
+        return sample
+
+    def close(self):
+        for counter in self.counters.values():
+            counter.close()
+
+
+def format_size(size):
+    """ Return a size in bytes for humans, like 1.5G """
+    if size is None:
+        return "?"
+    for unit in ("T", "G", "M", "K"):
+        factor = 1024 ** ("KMGT".index(unit) + 1)
+        if size >= factor:
+            return "{:.1f}{}".format(size / factor, unit)
+    return str(size)
+
+
+class Sampler(object):
+    """ Write a time series of the resources used by a container
+
+    One CSV line per sample, with the counters turned into rates since the
+    previous sample, and a summary of the peaks and averages at the end.
+    """
+
+    def __init__(self, cgroup, output, interval=const.SAMPLE_INTERVAL):
+        self.cgroup = cgroup
+        self.output = output
+        self.interval = interval
+        self.first = None
+        self.last = None
+        self.samples = 0
+        self.memory_total = 0
+        self.memory_peak = 0
+        self.cpu_peak = 0.0
+
+    def _row(self, sample, previous):
+        """ Return the CSV line of a sample and update the statistics """
+        elapsed = sample["time"] - previous["time"] if previous else 0
+
+        def rate(key, scale=1):
+            if not elapsed or sample[key] is None or previous[key] is None:
+                return 0
+            return int(round((sample[key] - previous[key]) * scale / elapsed))
+
+        cpu = rate("cpu", 100)
+        memory = sample["memory"] or 0
+        self.samples += 1
+        self.memory_total += memory
+        self.memory_peak = max(self.memory_peak, memory, sample["memory_peak"] or 0)
+        self.cpu_peak = max(self.cpu_peak, cpu)
+        return "{:.1f},{},{},{},{},{},{}\n".format(
+            sample["time"] - self.first["time"], memory, cpu,
+            rate("io_read"), rate("io_write"), rate("io_read_ops"), rate("io_write_ops"))
+
+    def run(self, alive=None):
+        """ Sample the cgroup until it is removed or alive() returns False
+
+        @alive: callable telling if the sampling should go on
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(self.output)), exist_ok=True)
+        with open(self.output, "w") as f:
+            f.write(",".join(COLUMNS) + "\n")
+            deadline = time.monotonic()
+            while alive is None or alive():
+                try:
+                    sample = self.cgroup.read()
+                except CgroupError as exc:
+                    logger.debug("End of sampling: {}".format(exc))
+                    break
+                if self.first is None:
+                    self.first = sample
+                f.write(self._row(sample, self.last))
+                f.flush()
+                self.last = sample
+                deadline += self.interval
+                time.sleep(max(0, deadline - time.monotonic()))
+
+    def summary(self):
+        """ Return the summary line of the sampling for summary.log
+
+        The line never ends with ERROR, otto-run would take it for a failed
+        step.
+        """
+        if not self.samples:
+            return "resources: no sample"
+        duration = self.last["time"] - self.first["time"]
+        cpu_average = 0
+        if duration and self.last["cpu"] is not None and self.first["cpu"] is not None:
+            cpu_average = int(round((self.last["cpu"] - self.first["cpu"]) * 100 / duration))
+        limit = self.last["memory_limit"]
+        # no limit is reported as a huge number on cgroup v1
+        if limit is not None and limit >= 2 ** 60:
+            limit = None
+        return ("resources (memory peak/average/limit, cpu % peak/average, "
+                "io read/write): {}/{}/{}, {}/{}, {}/{}".format(
+                    format_size(self.memory_peak),
+                    format_size(self.memory_total // self.samples),
+                    format_size(limit) if limit is not None else "none",
+                    self.cpu_peak, cpu_average,
+                    format_size(self.last["io_read"] - self.first["io_read"]),
+                    format_size(self.last["io_write"] - self.first["io_write"])))
+
+
+def host_version():
+    """ Return the version of cgroup limiting the memory of the containers """
+    try:
+        return 1 if "memory" in _hierarchies() else 2
+    except OSError:
+        return 1
+
+
+def parse_cpulist(text):
+    """ Return the cpus of a list like 0-3,8 """
+    cpus = []
+    for item in text.strip().split(","):
+        if not item:
+            continue
+        (first, _, last) = item.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpulist(cpus):
+    """ Return the shortest list like 0-3,8 of cpus """
+    ranges = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(str(a) if a == b else "{}-{}".format(a, b) for (a, b) in ranges)
+
+
+def numa_nodes():
+    """ Return the cpus otto can use, by NUMA node
+
+    @return: {node: [cpus]}, a single node 0 without NUMA information
+    """
+    available = os.sched_getaffinity(0)
+    nodes = {}
+    for path in glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"):
+        node = int(os.path.basename(os.path.dirname(path))[4:])
+        with open(path) as f:
+            cpus = [cpu for cpu in parse_cpulist(f.read()) if cpu in available]
+        if cpus:
+            nodes[node] = cpus
+    if not nodes:
+        nodes[0] = sorted(available)
+    return nodes
+
+
+def settings(memory, swap, shares, weight, cpus=None, mems=None, version=None):
+    """ Return the cgroup settings of a container for its LXC config
+
+    @memory: memory limit in bytes
+    @swap: swap the container can use on top of memory, in bytes
+    @shares: cpu shares, 1024 for one core
+    @weight: blkio weight, from 10 to 1000
+    @cpus, @mems: cpus and NUMA nodes the container is pinned on, if any
+    @version: cgroup version of the host, detected if None
+
+    @return: list of (key, value) with the keys of lxc.cgroup or lxc.cgroup2
+    """
+    if version is None:
+        version = host_version()
+    weight = max(10, min(1000, weight))
+    if version == 1:
+        items = [("lxc.cgroup.memory.limit_in_bytes", memory),
+                 ("lxc.cgroup.memory.memsw.limit_in_bytes", memory + swap),
+                 ("lxc.cgroup.cpu.shares", shares),
+                 ("lxc.cgroup.blkio.weight", weight)]
+        prefix = "lxc.cgroup."
+    else:
+        # conversions of runc between the v1 and v2 ranges: cpu.shares 2-262144
+        # and blkio.weight 10-1000 are mapped linearly onto 1-10000
+        items = [("lxc.cgroup2.memory.max", memory),
+                 ("lxc.cgroup2.memory.swap.max", swap),
+                 ("lxc.cgroup2.cpu.weight",
+                  max(1, min(10000, 1 + (shares - 2) * 9999 // 262142))),
+                 ("lxc.cgroup2.io.weight", 1 + (weight - 10) * 9999 // 990)]
+        prefix = "lxc.cgroup2."
+    if cpus:
+        items.append((prefix + "cpuset.cpus", format_cpulist(cpus)))
+        items.append((prefix + "cpuset.mems", format_cpulist(mems or [0])))
+    return items
+
+
+class CpusetRegistry(object):
+    """ Cores the running containers are pinned on
+
+    The registry is shared by the otto processes of the host and locked
+    while a container is given its cores. A container is given the least
+    used cores of a single NUMA node when possible, so concurrent containers
+    are spread across the cores and nodes of the host.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or const.CPUSET_REGISTRY
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _locked(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lock = open(self.path + ".lock", "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def allocate(self, name, count, running, nodes=None):
+        """ Give count cores to a container
+
+        @name: name of the container
+        @count: number of cores
+        @running: callable telling if a container is running, the entries
+                  of the stopped containers are dropped once they had the
+                  time to start
+        @nodes: {node: [cpus]} of the host, numa_nodes() if None
+
+        @return: (cpus, NUMA nodes) of the container
+        """
+        if nodes is None:
+            nodes = numa_nodes()
+        with self._locked():
+            entries = self._load()
+            entries.pop(name, None)
+            for other in list(entries):
+                if (time.time() - entries[other]["time"] > const.START_TIMEOUT and
+                        not running(other)):
+                    logger.debug("Releasing the cores of stopped container '{}'".format(other))
+                    del entries[other]
+            usage = {}
+            for entry in entries.values():
+                for cpu in entry["cpus"]:
+                    usage[cpu] = usage.get(cpu, 0) + 1
+
+            def least_used(cpus):
+                return sorted(cpus, key=lambda cpu: (usage.get(cpu, 0), cpu))[:count]
+
+            def load(cpus):
+                return sum(usage.get(cpu, 0) for cpu in cpus)
+
+            # a single node when one is large enough: the one with the least
+            # used cores, then the least loaded one
+            candidates = [(load(least_used(cpus)), load(cpus), least_used(cpus))
+                          for cpus in nodes.values() if len(cpus) >= count]
+            if candidates:
+                cpus = min(candidates)[2]
+            else:
+                cpus = least_used([cpu for node in nodes.values() for cpu in node])
+            mems = sorted(node for (node, node_cpus) in nodes.items()
+                          if set(node_cpus) & set(cpus))
+            entries[name] = {"cpus": sorted(cpus), "mems": mems, "time": time.time()}
+            utils.write_file_atomic(self.path, json.dumps(entries, indent=2))
+        logger.info("Container '{}' pinned on cpus {} of nodes {}".format(
+            name, format_cpulist(cpus), format_cpulist(mems)))
+        return (sorted(cpus), mems)
+
+    def release(self, name):
+        """ Give back the cores of a container """
+        if not os.path.exists(self.path):
+            return
+        with self._locked():
+            entries = self._load()
+            if entries.pop(name, None) is not None:
+                utils.write_file_atomic(self.path, json.dumps(entries, indent=2))
@@ -0,0 +1,328 @@
+"""
+Deduplicating store for run archives - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Didier Roche <didier.roche@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import base64
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import fnmatch
+import gzip
+import hashlib
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import stat
+import threading
+import zlib
+
+from . import archive, errors
+from .utils import ignored
+
+BUFSIZE = 1024 * 1024
+# flock()ed shared by the archives and exclusively by prune
+LOCK_FILE = "lock"
+
+
+class ChunkStoreError(errors.OttoError):
+    pass
+
+
+def read_manifest(path):
+    """ Return the list of entries of a manifest
+
+    @path: Path to the manifest
+    """
+    with open(path, "rb") as f:
+        if f.read(len(archive.MANIFEST_MAGIC)) != archive.MANIFEST_MAGIC:
+            raise ChunkStoreError("{} is not a manifest".format(path))
+        with gzip.open(f, "rt") as fin:
+            return [json.loads(line) for line in fin]
+
+
+class ChunkStore(object):
+    """ Content-addressed store of files
+
+    Each file is stored once, compressed, under the sha256 of its content. A
+    run archive is a manifest listing the files of the run directory with
+    their metadata and the digest of their content, so consecutive runs only
+    add the files they changed to the store.
+    """
+
+    def __init__(self, path, workers=None):
+        self.path = path
+        self.objectsdir = os.path.join(path, "objects")
+        self.workers = workers or os.cpu_count() or 1
+
+    def _locked(self, operation):
+        """ Return the lock file of the store, locked with flock()
+
+        @operation: fcntl.LOCK_SH to add objects, fcntl.LOCK_EX to remove them
+        """
+        os.makedirs(self.path, exist_ok=True)
+        lock = open(os.path.join(self.path, LOCK_FILE), "w")
+        fcntl.flock(lock, operation)
+        return lock
+
+    def object_path(self, digest):
+        return os.path.join(self.objectsdir, digest[:2], digest[2:])
+
+    def has(self, digest):
+        return os.path.isfile(self.object_path(digest))
+
+    @staticmethod
+    def _hash_file(path):
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(BUFSIZE), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def _ingest(self, path):
+        """ Add a file to the store unless its content is already there
+
+        @return: (digest, number of bytes added to the store)
+        """
+        digest = self._hash_file(path)
+        objpath = self.object_path(digest)
+        if os.path.isfile(objpath):
+            return (digest, 0)
+        os.makedirs(os.path.dirname(objpath), exist_ok=True)
+        tmppath = "{}.{}.{}.tmp".format(objpath, os.getpid(),
+                                        threading.get_ident())
+        try:
+            with open(path, "rb") as fin, open(tmppath, "wb") as fout:
+                compressor = zlib.compressobj(1)
+                for chunk in iter(lambda: fin.read(BUFSIZE), b""):
+                    fout.write(compressor.compress(chunk))
+                fout.write(compressor.flush())
+            os.replace(tmppath, objpath)
+        except BaseException:
+            with ignored(OSError):
+                os.remove(tmppath)
+            raise
+        return (digest, os.path.getsize(objpath))
+
+    def _scan(self, srcdir, excludes):
+        """ Return the entries of a directory tree, parents first
+
+        @return: list of (path on disk, manifest entry)
+        """
+        entries = []
+        inodes = {}
+
+        def add(path):
+            relpath = os.path.relpath(path, srcdir)
+            arcname = "." if relpath == "." else "./" + relpath
+            if any(fnmatch.fnmatch(arcname, p) for p in excludes):
+                return False
+            stt = os.lstat(path)
+            entry = {"path": arcname, "mode": stat.S_IMODE(stt.st_mode),
+                     "uid": stt.st_uid, "gid": stt.st_gid,
+                     "mtime": stt.st_mtime_ns}
+            if stat.S_ISDIR(stt.st_mode):
+                entry["type"] = "dir"
+            elif stat.S_ISLNK(stt.st_mode):
+                entry["type"] = "symlink"
+                entry["target"] = os.readlink(path)
+            elif stat.S_ISREG(stt.st_mode):
+                inode = (stt.st_dev, stt.st_ino)
+                if stt.st_nlink > 1 and inode in inodes:
+                    entry["type"] = "hardlink"
+                    entry["target"] = inodes[inode]
+                else:
+                    inodes[inode] = arcname
+                    entry["type"] = "file"
+                    entry["size"] = stt.st_size
+            elif stat.S_ISCHR(stt.st_mode) or stat.S_ISBLK(stt.st_mode):
+                entry["type"] = "char" if stat.S_ISCHR(stt.st_mode) else "block"
+                entry["rdev"] = stt.st_rdev
+            elif stat.S_ISFIFO(stt.st_mode):
+                entry["type"] = "fifo"
+            else:
+                logger.debug("Skipping unsupported file {}".format(path))
+                return False
+            xattrs = archive.read_xattrs(path)
+            if xattrs:
+                entry["xattrs"] = {name: base64.b64encode(value).decode()
+                                   for (name, value) in xattrs.items()}
+            entries.append((path, entry))
+            return True
+
+        for (dirpath, dirnames, filenames) in os.walk(srcdir):
+            if not add(dirpath):
+                dirnames[:] = []
+                continue
+            dirnames.sort()
+            # symbolic links to directories are not walked into
+            links = [d for d in dirnames
+                     if os.path.islink(os.path.join(dirpath, d))]
+            for name in sorted(filenames) + links:
+                add(os.path.join(dirpath, name))
+        return entries
+
+    def archive(self, srcdir, dest, excludes=archive.EXCLUDES):
+        """ Store a directory tree and write its manifest to dest
+
+        @srcdir: directory to archive
+        @dest: path to the manifest
+        @excludes: patterns of paths, relative to srcdir, to leave out
+
+        @return: number of bytes added to the store
+        """
+        logger.info("Archiving {} to {} with store {}".format(srcdir, dest,
+                                                             self.path))
+        # prune doesn't remove the objects until the manifest is written
+        with self._locked(fcntl.LOCK_SH):
+            entries = self._scan(srcdir, excludes)
+            files = [(path, entry) for (path, entry) in entries
+                     if entry["type"] == "file"]
+            added = 0
+            with ThreadPoolExecutor(self.workers) as executor:
+                results = executor.map(lambda f: self._ingest(f[0]), files)
+                for ((path, entry), (digest, size)) in zip(files, results):
+                    entry["digest"] = digest
+                    added += size
+
+            tmpdest = dest + ".partial"
+            try:
+                with open(tmpdest, "wb") as f:
+                    f.write(archive.MANIFEST_MAGIC)
+                    with gzip.open(f, "wt") as fout:
+                        for (path, entry) in entries:
+                            fout.write(json.dumps(entry, sort_keys=True) + "\n")
+                os.replace(tmpdest, dest)
+            except BaseException:
+                with ignored(OSError):
+                    os.remove(tmpdest)
+                raise
+        logger.info("{} files archived, {} new bytes in the store".format(
+            len(files), added))
+        return added
+
+    def read_file(self, entry, fout):
+        """ Write the content of a file of a manifest to fout
+
+        @entry: entry of the file in the manifest
+        @fout: binary file object
+        """
+        objpath = self.object_path(entry["digest"])
+        try:
+            fin = open(objpath, "rb")
+        except FileNotFoundError:
+            raise ChunkStoreError("Object {} of {} missing from the "
+                                  "store".format(entry["digest"], entry["path"]))
+        with fin:
+            decompressor = zlib.decompressobj()
+            for chunk in iter(lambda: fin.read(BUFSIZE), b""):
+                fout.write(decompressor.decompress(chunk))
+            fout.write(decompressor.flush())
+
+    def _extract_file(self, entry, dest):
+        with open(dest, "wb") as fout:
+            self.read_file(entry, fout)
+
+    def restore(self, manifest, destdir):
+        """ Rebuild a directory tree from a manifest
+
+        @manifest: path to the manifest
+        @destdir: destination directory
+        """
+        destdir = os.path.abspath(destdir)
+        os.makedirs(destdir, exist_ok=True)
+        entries = read_manifest(manifest)
+        symlinks = set()
+        for entry in entries:
+            archive.check_member_path(
+                entry["path"], destdir, symlinks,
+                entry["target"] if entry["type"] == "hardlink" else None)
+            if entry["type"] == "symlink":
+                symlinks.add(os.path.normpath(entry["path"]))
+
+        def dest(entry):
+            return os.path.normpath(os.path.join(destdir, entry["path"]))
+
+        for entry in entries:
+            if entry["type"] == "dir":
+                os.makedirs(dest(entry), 0o700, exist_ok=True)
+
+        files = [entry for entry in entries if entry["type"] == "file"]
+        with ThreadPoolExecutor(self.workers) as executor:
+            # consume the results to raise the errors of the workers
+            list(executor.map(lambda e: self._extract_file(e, dest(e)), files))
+
+        for entry in entries:
+            path = dest(entry)
+            if entry["type"] == "symlink":
+                os.symlink(entry["target"], path)
+            elif entry["type"] == "hardlink":
+                os.link(os.path.join(destdir, entry["target"]), path)
+            elif entry["type"] in ("char", "block", "fifo"):
+                kind = {"char": stat.S_IFCHR, "block": stat.S_IFBLK,
+                        "fifo": stat.S_IFIFO}[entry["type"]]
+                os.mknod(path, kind | entry["mode"], entry.get("rdev", 0))
+
+        # attributes last, directories after their content, deepest first
+        files = [e for e in entries if e["type"] not in ("dir", "hardlink")]
+        directories = sorted([e for e in entries if e["type"] == "dir"],
+                             key=lambda e: e["path"], reverse=True)
+        for entry in files + directories:
+            path = dest(entry)
+            archive.write_xattrs(path, {name: base64.b64decode(value) for (name, value)
+                                        in entry.get("xattrs", {}).items()})
+            with ignored(OSError):
+                os.chown(path, entry["uid"], entry["gid"], follow_symlinks=False)
+            if entry["type"] != "symlink":
+                os.chmod(path, entry["mode"])
+            os.utime(path, ns=(entry["mtime"], entry["mtime"]),
+                     follow_symlinks=entry["type"] != "symlink")
+
+    def prune(self, manifests, dry_run=False):
+        """ Remove the objects which are not referenced by any manifest
+
+        The store is locked, so no archive adds objects meanwhile.
+
+        @manifests: function returning the paths of all the manifests using
+                    this store, called once the store is locked so the
+                    manifests written in the meantime are counted
+        @dry_run: only report what would be removed
+
+        @return: (number of objects, bytes) removed
+        """
+        count = size = 0
+        with self._locked(fcntl.LOCK_EX):
+            referenced = set()
+            for manifest in manifests():
+                for entry in read_manifest(manifest):
+                    if "digest" in entry:
+                        referenced.add(entry["digest"])
+            if not os.path.isdir(self.objectsdir):
+                return (count, size)
+            for prefix in os.listdir(self.objectsdir):
+                prefixdir = os.path.join(self.objectsdir, prefix)
+                for name in os.listdir(prefixdir):
+                    if prefix + name in referenced or name.endswith(".tmp"):
+                        continue
+                    objpath = os.path.join(prefixdir, name)
+                    count += 1
+                    size += os.path.getsize(objpath)
+                    if not dry_run:
+                        os.remove(objpath)
+        return (count, size)
@@ -0,0 +1,169 @@
+"""
+Collection of the results of a run - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import shutil
+import stat
+
+from . import errors, utils
+from .utils import ignored
+
+BUFSIZE = 1024 * 1024
+MANIFEST_FILE = "collected.json"
+
+
+class CollectorError(errors.OttoError):
+    pass
+
+
+class Collector(object):
+    """ Copy the results of a run out of the delta of a container
+
+    All the paths are gathered in one pass. Each file is reflinked if the
+    filesystem supports it and copied otherwise, never hardlinked: the next
+    run of the container would change the results through the delta. Copies
+    and checksums are done by a pool of workers. A manifest lists the size
+    and the sha256 of every collected file.
+    """
+
+    def __init__(self, root, dest, owner=None, workers=None):
+        """
+        @root: directory the paths are relative to, usually the delta
+        @dest: results directory
+        @owner: (uid, gid) owning the results, unchanged if None
+        @workers: number of threads copying files, one per core if None
+        """
+        self.root = root
+        self.dest = dest
+        self.owner = owner
+        self.workers = workers or os.cpu_count() or 1
+        self._files = []
+        self._directories = []
+
+    def _plan(self, path, destdir):
+        """ List what to copy for a path, with the semantics of rsync
+
+        A directory with a trailing slash is copied into destdir, without
+        it is copied as destdir/basename. Files are copied into destdir.
+        """
+        src = os.path.join(self.root, path.lstrip("/"))
+        if not os.path.lexists(src):
+            logger.debug("{} not found, not collected".format(path))
+            return
+        if not os.path.isdir(src) or os.path.islink(src):
+            self._files.append((src, os.path.join(destdir, os.path.basename(src))))
+            return
+        if not path.endswith("/"):
+            destdir = os.path.join(destdir, os.path.basename(os.path.normpath(src)))
+        for (dirpath, dirnames, filenames) in os.walk(src):
+            reldir = os.path.relpath(dirpath, src)
+            target = os.path.normpath(os.path.join(destdir, reldir))
+            self._directories.append(target)
+            links = [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+            dirnames[:] = [d for d in dirnames if d not in links]
+            for name in filenames + links:
+                self._files.append((os.path.join(dirpath, name),
+                                    os.path.join(target, name)))
+
+    def _needs_chown(self, stt):
+        return self.owner is not None and (stt.st_uid, stt.st_gid) != self.owner
+
+    def _collect_file(self, src, dst):
+        """ Collect a file
+
+        @return: manifest entry or None for unsupported files
+        """
+        srcstt = os.lstat(src)
+        with ignored(FileNotFoundError):
+            os.remove(dst)
+        entry = {"path": os.path.relpath(dst, self.dest), "size": srcstt.st_size}
+        if stat.S_ISLNK(srcstt.st_mode):
+            os.symlink(os.readlink(src), dst)
+            entry["target"] = os.readlink(src)
+            entry["method"] = "symlink"
+        elif not stat.S_ISREG(srcstt.st_mode):
+            logger.debug("Skipping special file {}".format(src))
+            return None
+        elif utils.reflink(src, dst):
+            entry["method"] = "reflink"
+        else:
+            # the checksum is computed while copying
+            sha = hashlib.sha256()
+            with open(src, "rb") as fin, open(dst, "wb") as fout:
+                for chunk in iter(lambda: fin.read(BUFSIZE), b""):
+                    sha.update(chunk)
+                    fout.write(chunk)
+            shutil.copystat(src, dst)
+            entry["method"] = "copy"
+            entry["sha256"] = sha.hexdigest()
+        if "sha256" not in entry and entry["method"] != "symlink":
+            entry["sha256"] = utils.file_digest(dst)
+        if self._needs_chown(srcstt):
+            os.chown(dst, self.owner[0], self.owner[1], follow_symlinks=False)
+        return entry
+
+    def collect(self, paths, logs=()):
+        """ Collect paths into the results directory and logs into its logs
+        subdirectory, then write the manifest
+
+        @return: list of the manifest entries
+        """
+        try:
+            self._plan_all(paths, logs)
+            directories = set([self.dest] + self._directories +
+                              [os.path.dirname(dst) for (_, dst) in self._files])
+            for directory in sorted(directories):
+                os.makedirs(directory, exist_ok=True)
+            with ThreadPoolExecutor(self.workers) as executor:
+                entries = list(executor.map(lambda f: self._collect_file(*f), self._files))
+            entries = [entry for entry in entries if entry is not None]
+
+            if self.owner is not None:
+                for directory in directories:
+                    with ignored(OSError):
+                        os.chown(directory, *self.owner)
+
+            manifest = os.path.join(self.dest, MANIFEST_FILE)
+            utils.write_file_atomic(manifest, json.dumps(
+                {"files": sorted(entries, key=lambda e: e["path"])}, indent=2))
+            if self.owner is not None:
+                os.chown(manifest, *self.owner)
+        except OSError as exc:
+            raise CollectorError("Can't collect the results in {}: {}".format(self.dest, exc))
+        methods = {}
+        for entry in entries:
+            methods[entry["method"]] = methods.get(entry["method"], 0) + 1
+        logger.info("{} files collected in {}: {}".format(len(entries), self.dest,
+                                                          methods))
+        return entries
+
+    def _plan_all(self, paths, logs):
+        self._files = []
+        self._directories = []
+        for path in paths:
+            self._plan(path, self.dest)
+        for path in logs:
+            self._plan(path, os.path.join(self.dest, "logs"))
@@ -20,14 +20,17 @@ Commands class - part of the project otto
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import argparse
+import json
 import logging
 logger = logging.getLogger(__name__)
 import os
+import pwd
 import subprocess
 import sys
+import time
 from textwrap import dedent
 
-from . import const, container, utils
+from . import archive, cgroup, collector, const, container, hostinfo, logstream, retention, scheduler, timing, utils
 from .container import ContainerError
 from .utils import ignored
 
@@ -85,6 +88,13 @@ class Commands(object):
         pdestroy.add_argument("name", help="name of the container")
         pdestroy.set_defaults(func=self.cmd_destroy)
 
+        pclone = subparser.add_parser("clone",
+                                      help="Create a container sharing the image and "
+                                           "the base deltas of another one")
+        pclone.add_argument("name", help="name of the source container")
+        pclone.add_argument("dest", help="name of the new container")
+        pclone.set_defaults(func=self.cmd_clone)
+
         pstart = subparser.add_parser("start", help="Start a container")
         pstart.add_argument("name", help="name of the container")
         pstart.add_argument("-C", "--custom-installation",
@@ -114,20 +124,209 @@ class Commands(object):
                             default=False,
                             help="Forcibly shutdown lightdm even if a session "
                                  "is running and a user might be connected.")
+        pstart.add_argument("--layer", action='store_true',
+                            help="Install the packages from a package layer, built on first use "
+                                 "and reused by the runs with the same image and package lists")
+        pstart.add_argument("--no-apt-cache", action='store_true',
+                            help="Don't share the apt cache of the host with the container, "
+                                 "download all the packages from the archive")
+        pstart.add_argument("--pin", action='store_true',
+                            help="Pin the container on its own cores, like CPU_PINNING=1 in "
+                                 "the config of the testsuite")
         pstart.set_defaults(func=self.cmd_start)
 
         pstop = subparser.add_parser("stop", help="Stop a container")
         pstop.add_argument("name", help="name of the container")
         pstop.set_defaults(func=self.cmd_stop)
 
+        pwarm = subparser.add_parser(
+            "warm", help="Boot containers and keep them ready for a job")
+        pwarm.add_argument("containers", nargs="+", metavar="name",
+                           help="name of the containers")
+        pwarm.add_argument("--no-apt-cache", action='store_true',
+                           help="Don't share the apt cache of the host with the containers")
+        pwarm.add_argument("-t", "--timeout", type=int, default=const.WARM_TIMEOUT,
+                           help="seconds to wait for the containers to be ready")
+        pwarm.set_defaults(func=self.cmd_warm)
+
+        pdispatch = subparser.add_parser(
+            "dispatch", help="Run a custom installation in a warm container")
+        pdispatch.add_argument("name", help="name of the container")
+        pdispatch.add_argument("-C", "--custom-installation", required=True,
+                               help="directory with the custom installation of the job")
+        pdispatch.add_argument("-s", "--archive", action='store_true',
+                               help="archive the run once the container stops")
+        pdispatch.set_defaults(func=self.cmd_dispatch)
+
+        parchive = subparser.add_parser("archive",
+                                        help="Manage archives of container runs")
+        archive_subparser = parchive.add_subparsers(title="archive commands",
+                                                    dest="archive_cmd")
+        pacreate = archive_subparser.add_parser(
+            "create", help="Archive the latest run of a container")
+        pacreate.add_argument("name", help="name of the container")
+        pacreate.add_argument("-c", "--compression", default=None,
+                              choices=sorted(archive.COMPRESSORS),
+                              help="compression of the archive (default: "
+                                   "the best seekable one, only zstd with "
+                                   "python3-zstandard and gzip are indexed)")
+        pacreate.add_argument("--dedup", action='store_true', default=False,
+                              help="store the files in the deduplicating store "
+                                   "of the container and only write a manifest")
+        pacreate.set_defaults(func=self.cmd_archive_create)
+        pals = archive_subparser.add_parser(
+            "ls", help="List the files of an archive")
+        pals.add_argument("name", help="name of the container")
+        pals.add_argument("archive", help="name of the archive in the archive "
+                                          "directory of the container, or its path")
+        pals.add_argument("path", nargs="?", default=None,
+                          help="only list this path of the run directory")
+        pals.set_defaults(func=self.cmd_archive_ls)
+        pacat = archive_subparser.add_parser(
+            "cat", help="Write a file of an archive to stdout")
+        pacat.add_argument("name", help="name of the container")
+        pacat.add_argument("archive", help="name of the archive in the archive "
+                                           "directory of the container, or its path")
+        pacat.add_argument("path", help="path of the file in the run directory, "
+                                        "like delta/var/log/syslog")
+        pacat.set_defaults(func=self.cmd_archive_cat)
+
+        prootfs = subparser.add_parser("rootfs",
+                                       help="Mount the rootfs of a container, used by its hooks")
+        rootfs_subparser = prootfs.add_subparsers(title="rootfs commands",
+                                                  dest="rootfs_cmd")
+        prmount = rootfs_subparser.add_parser(
+            "mount", help="Mount the branches of the run on the rootfs")
+        prmount.add_argument("name", help="name of the container")
+        prmount.add_argument("target", help="mount point of the rootfs")
+        prmount.set_defaults(func=self.cmd_rootfs_mount)
+        prumount = rootfs_subparser.add_parser(
+            "umount", help="Unmount the rootfs and release its loop devices")
+        prumount.add_argument("name", help="name of the container")
+        prumount.set_defaults(func=self.cmd_rootfs_umount)
+
+        phostinfo = subparser.add_parser("host-info",
+                                         help="Show the cached facts about the host")
+        phostinfo.add_argument("--refresh", action='store_true', default=False,
+                               help="probe the host again instead of using "
+                                    "the cache")
+        phostinfo.set_defaults(func=self.cmd_host_info)
+
+        ppool = subparser.add_parser("pool",
+                                     help="Run several testsuites in parallel")
+        ppool.add_argument("jobs", nargs="*", metavar="CONTAINER:TESTPATH",
+                           help="testsuite TESTPATH to run in container "
+                                "CONTAINER")
+        ppool.add_argument("-f", "--job-file", default=None,
+                           help="file with one job per line: CONTAINER "
+                                "TESTPATH")
+        ppool.add_argument("-j", "--slots", type=int, default=None,
+                           help="number of jobs to run at once (default: "
+                                "based on the number of cores and memory)")
+        ppool.add_argument("-o", "--results-dir",
+                           default="/tmp/otto_pool.{}".format(int(time.time())),
+                           help="directory where the results of each job are "
+                                "stored")
+        ppool.set_defaults(func=self.cmd_pool)
+
+        pcollect = subparser.add_parser(
+            "collect", help="Collect the results of the latest run of a container")
+        pcollect.add_argument("name", help="name of the container")
+        pcollect.add_argument("dest", help="results directory")
+        pcollect.add_argument("paths", nargs="*", metavar="path",
+                              help="file or directory of the container to collect, "
+                                   "the content of directories ending with / is "
+                                   "collected directly in the results directory")
+        pcollect.add_argument("-l", "--logs", nargs="*", default=[],
+                              help="log files to collect in the logs subdirectory")
+        pcollect.add_argument("-u", "--user", default=None,
+                              help="owner of the collected files")
+        pcollect.set_defaults(func=self.cmd_collect)
+
+        ptimings = subparser.add_parser(
+            "timings", help="Merge the timings of the phases of the latest run")
+        ptimings.add_argument("name", help="name of the container")
+        ptimings.add_argument("-o", "--output", default="timings.json",
+                              help="path of the merged timings (default: timings.json)")
+        ptimings.set_defaults(func=self.cmd_timings)
+
+        pstreamlogs = subparser.add_parser(
+            "stream-logs", help="Print the lines written to log files of a running "
+                                "container, prefixed with their name")
+        pstreamlogs.add_argument("name", help="name of the container")
+        pstreamlogs.add_argument("logfiles", nargs="+", metavar="logfile",
+                                 help="path of a log file in the container")
+        pstreamlogs.add_argument("-p", "--pid", type=int, default=None,
+                                 help="stop after process PID exits")
+        pstreamlogs.add_argument("-o", "--output", default=None,
+                                 help="also write the lines with a timestamp to this file")
+        pstreamlogs.set_defaults(func=self.cmd_stream_logs)
+
+        psample = subparser.add_parser(
+            "sample", help="Write the resources used by a running container "
+                           "until it stops")
+        psample.add_argument("name", help="name of the container")
+        psample.add_argument("-o", "--output", default="resources.csv",
+                             help="path of the time series (default: resources.csv)")
+        psample.add_argument("-i", "--interval", type=float,
+                             default=const.SAMPLE_INTERVAL,
+                             help="seconds between two samples (default: "
+                                  "{})".format(const.SAMPLE_INTERVAL))
+        psample.add_argument("-s", "--summary", default=None,
+                             help="append the peaks and averages to this file")
+        psample.add_argument("-p", "--pid", type=int, default=None,
+                             help="stop after process PID exits")
+        psample.set_defaults(func=self.cmd_sample)
+
+        pwaitpoststop = subparser.add_parser(
+            "wait-post-stop", help="Wait for the post-stop hook of a container "
+                                   "to finish")
+        pwaitpoststop.add_argument("name", help="name of the container")
+        pwaitpoststop.add_argument("-t", "--timeout", type=int,
+                                   default=const.POSTSTOP_TIMEOUT,
+                                   help="seconds to wait before failing")
+        pwaitpoststop.set_defaults(func=self.cmd_wait_post_stop)
+
+        pgc = subparser.add_parser(
+            "gc", help="Remove the oldest archives, bases and layers of the "
+                       "containers over their disk budget")
+        pgc.add_argument("names", nargs="*", metavar="name",
+                         help="containers to clean up (default: all)")
+        pgc.add_argument("-n", "--dry-run", action='store_true', default=False,
+                         help="only report what would be removed")
+        pgc.add_argument("--container-budget", default=None,
+                         help="disk used by each container, like 20G, or "
+                              "'none' (default: {})".format(
+                                  cgroup.format_size(const.GC_CONTAINER_BUDGET)))
+        pgc.add_argument("--host-budget", default=None,
+                         help="disk used by all the containers, or 'none' "
+                              "(default: none)")
+        pgc.add_argument("--min-free", default=None,
+                         help="space to keep available for the containers, or "
+                              "'none' (default: {})".format(
+                                  cgroup.format_size(const.GC_MIN_FREE)))
+        pgc.add_argument("--max-age", type=float, default=const.GC_MAX_AGE / 86400,
+                         help="days after which what isn't used is removed, "
+                              "0 to disable (default: %(default)s)")
+        pgc.add_argument("--post-stop", action='store_true', default=False,
+                         help="run by the post-stop hook of the containers, "
+                              "which are otherwise skipped until it finishes")
+        pgc.set_defaults(func=self.cmd_gc)
+
         phelp = subparser.add_parser("help",
                                      help="Get help on one of those commands")
         phelp.add_argument("command",
                            help="name of the command to get help on")
         phelp.set_defaults(help=self.cmd_stop)
 
-        cmd_parsers = {"create": pcreate, "destroy": pdestroy,
-                       "start": pstart, "stop": pstop, "help": phelp}
+        cmd_parsers = {"create": pcreate, "destroy": pdestroy, "clone": pclone,
+                       "start": pstart, "stop": pstop, "warm": pwarm,
+                       "dispatch": pdispatch, "archive": parchive,
+                       "rootfs": prootfs, "host-info": phostinfo, "pool": ppool,
+                       "collect": pcollect, "timings": ptimings,
+                       "stream-logs": pstreamlogs, "sample": psample,
+                       "wait-post-stop": pwaitpoststop, "gc": pgc,
+                       "help": phelp}
 
         self.args = parser.parse_args()
         utils.set_logging(self.args.debug)
@@ -143,6 +342,9 @@ class Commands(object):
             except:
                 self.run = None
                 parser.print_help()
+            # Some commands are not bound to a single container
+            if getattr(self.args, "name", None) is None:
+                return
             try:
                 self.container = container.Container(
                     self.args.name, create = self.args.cmd_name=="create")
@@ -191,6 +393,15 @@ class Commands(object):
             logger.error(e)
             return 1
 
+    def cmd_clone(self):
+        """ Clones a container """
+        try:
+            self.container.clone(self.args.dest)
+        except (ContainerError, OSError) as e:
+            logger.error("Can't clone '{}': {}".format(self.container.name, e))
+            return 1
+        return 0
+
     def cmd_start(self):
         """ Starts a container
 
@@ -211,6 +422,7 @@ class Commands(object):
             return 1
         if self.is_already_logged_user(self.args.force_disconnect):
             return 1
+        self.container.reset_timings()
 
         # Hack on the host system for people wanting to run lxc-start directly
         if not os.path.isfile("/etc/apparmor.d/disable/usr.bin.lxc-start"):
@@ -227,6 +439,9 @@ class Commands(object):
             except FileNotFoundError as e:
                 logger.error("Selected archive doesn't exist. Can't restore: {}.".format(e))
                 return 1
+            except ContainerError as e:
+                logger.error(e)
+                return 1
 
         # custom installation handling
         if self.args.new:
@@ -255,9 +470,25 @@ class Commands(object):
         # that enable us to overwrite the restored "archive" state from restore()
         # if we don't want to resave the restored run
         self.container.config.archive = self.args.archive
+        # for this start only, CPU_PINNING of the testsuite applies otherwise
+        self.container.config.pin = self.args.pin
+
+        # the delta of the previous run was made on top of its package layer
+        if self.args.keep_delta:
+            if self.args.layer:
+                logger.info("Keeping the package layer of the previous run")
+        elif self.args.layer:
+            try:
+                self.container.use_layer(apt_cache=not self.args.no_apt_cache)
+            except ContainerError as e:
+                logger.error(e)
+                return 1
+        else:
+            self.container.config.layerdir = ""
 
         try:
-            self.container.start(with_delta=self.args.keep_delta)
+            self.container.start(with_delta=self.args.keep_delta,
+                                 apt_cache=not self.args.no_apt_cache)
         except ContainerError as e:
             logger.error(e)
             return 1
@@ -289,6 +520,311 @@ class Commands(object):
             return 1
         return 0
 
+    def cmd_warm(self):
+        """ Boots containers up to the ready barrier
+
+        The containers are started one after the other and boot in
+        parallel.
+
+        @return: 0 if all the containers are ready, 1 otherwise
+        """
+        containers = []
+        for name in self.args.containers:
+            try:
+                c = container.Container(name)
+                if c.running:
+                    raise ContainerError("Container '{}' already running.".format(name))
+                c.warm(apt_cache=not self.args.no_apt_cache)
+            except ContainerError as e:
+                logger.error(e)
+                return 1
+            containers.append(c)
+
+        deadline = time.time() + self.args.timeout
+        rc = 0
+        for c in containers:
+            if c.wait_ready(max(0, deadline - time.time())):
+                logger.info("Container '{}' ready".format(c.name))
+            else:
+                logger.error("Container '{}' isn't ready after {}s".format(
+                    c.name, self.args.timeout))
+                rc = 1
+        return rc
+
+    def cmd_dispatch(self):
+        """ Gives a job to a warm container """
+        try:
+            self.container.dispatch(self.args.custom_installation,
+                                    archive=self.args.archive)
+        except (ContainerError, OSError) as e:
+            logger.error("Can't dispatch the job: {}".format(e))
+            return 1
+        return 0
+
+    def cmd_archive_create(self):
+        """ Archives the latest run of a container
+
+        This is called by the post-stop hook once the container is stopped.
+        """
+        try:
+            dest = self.container.archive(self.args.compression,
+                                          dedup=self.args.dedup)
+        except ContainerError as e:
+            logger.error(e)
+            return 1
+        logger.info("Run archived as {}".format(dest))
+        return 0
+
+    def cmd_archive_ls(self):
+        """ Lists the files of an archive, from its index when it has one """
+        try:
+            entries = self.container.archive_members(self.args.archive)
+        except (ContainerError, FileNotFoundError) as e:
+            logger.error(e)
+            return 1
+        prefix = None
+        if self.args.path is not None:
+            prefix = archive.normalize_member(self.args.path)
+        for entry in entries:
+            path = archive.normalize_member(entry["path"])
+            if prefix not in (None, ".", path) and not path.startswith(prefix + "/"):
+                continue
+            line = "{} {:>12} {} {}".format(
+                archive.entry_mode(entry), entry.get("size", 0),
+                time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["mtime"] / 10 ** 9)),
+                path)
+            if entry["type"] in ("symlink", "hardlink"):
+                line += " -> {}".format(entry["target"])
+            print(line)
+        return 0
+
+    def cmd_archive_cat(self):
+        """ Writes a file of an archive to stdout
+
+        Only the frames of the archive holding the file are decompressed if
+        the archive has an index.
+        """
+        try:
+            self.container.read_archive_member(self.args.archive, self.args.path,
+                                               sys.stdout.buffer)
+            sys.stdout.flush()
+        except (ContainerError, FileNotFoundError) as e:
+            logger.error(e)
+            return 1
+        return 0
+
+    def cmd_rootfs_mount(self):
+        """ Mounts the rootfs of a container, called by the pre-start hook """
+        try:
+            self.container.mount_rootfs(self.args.target)
+        except ContainerError as e:
+            logger.error(e)
+            return 1
+        return 0
+
+    def cmd_rootfs_umount(self):
+        """ Unmounts the rootfs of a container, called by the post-stop hook """
+        if not self.container.umount_rootfs():
+            logger.error("Some filesystems of '{}' are still mounted".format(
+                self.container.name))
+            return 1
+        return 0
+
+    def cmd_host_info(self):
+        """ Prints the facts about the host used to configure the containers """
+        facts = hostinfo.get_facts(refresh=self.args.refresh)
+        print(json.dumps(dict(facts, boot_id=hostinfo.boot_id()), indent=2,
+                         sort_keys=True))
+        return 0
+
+    def cmd_pool(self):
+        """ Runs a queue of testsuites in parallel in several containers
+
+        @return: 0 if all the jobs succeeded, 1 otherwise
+        """
+        jobs = []
+        for spec in self.args.jobs:
+            (name, sep, testpath) = spec.partition(":")
+            if not sep or not name or not testpath:
+                logger.error("Invalid job '{}', expected "
+                             "CONTAINER:TESTPATH".format(spec))
+                return 1
+            jobs.append((name, testpath))
+        if self.args.job_file:
+            try:
+                with open(self.args.job_file) as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line or line.startswith("#"):
+                            continue
+                        try:
+                            (name, testpath) = line.split()
+                        except ValueError:
+                            logger.error("Invalid line in job file: "
+                                         "{}".format(line))
+                            return 1
+                        jobs.append((name, testpath))
+            except OSError as e:
+                logger.error("Can't read job file: {}".format(e))
+                return 1
+
+        pool = scheduler.Scheduler(self.args.results_dir,
+                                   slots=self.args.slots,
+                                   debug=self.args.debug)
+        for (name, testpath) in jobs:
+            if not os.path.isdir(os.path.join(const.LXCBASE, name)):
+                logger.error("Container {} does not exist.".format(name))
+                return 1
+            if not os.path.isdir(testpath):
+                logger.error("Test directory '{}' not found.".format(testpath))
+                return 1
+            pool.add(scheduler.Job(name, testpath))
+
+        try:
+            pool.run()
+        except scheduler.SchedulerError as e:
+            logger.error(e)
+            return 1
+        logger.info("Results stored in {}".format(pool.resultsdir))
+        return 1 if pool.failed else 0
+
+    def cmd_gc(self):
+        """ Removes what exceeds the disk budgets of the containers """
+        budgets = {}
+        for (option, default) in (("container_budget", const.GC_CONTAINER_BUDGET),
+                                  ("host_budget", const.GC_HOST_BUDGET),
+                                  ("min_free", const.GC_MIN_FREE)):
+            value = getattr(self.args, option)
+            try:
+                if value is None:
+                    budgets[option] = default
+                elif value.lower() == "none":
+                    budgets[option] = None
+                else:
+                    budgets[option] = utils.parse_size(value)
+            except ValueError:
+                logger.error("Invalid size for --{}: {}".format(
+                    option.replace("_", "-"), value))
+                return 1
+        names = self.args.names
+        if not names:
+            names = sorted(name for name in os.listdir(const.LXCBASE)
+                           if os.path.isfile(os.path.join(const.LXCBASE, name, "config")))
+        for name in names:
+            if not os.path.isdir(os.path.join(const.LXCBASE, name)):
+                logger.error("Container {} does not exist.".format(name))
+                return 1
+        try:
+            containers = [container.Container(name) for name in names]
+        except ContainerError as e:
+            logger.error(e)
+            return 1
+        gc = retention.Retention(containers, max_age=self.args.max_age * 86400 or None,
+                                 post_stop=names if self.args.post_stop else (),
+                                 **budgets)
+        try:
+            (removed, objects, pruned) = gc.run(self.args.dry_run)
+        except retention.RetentionError as e:
+            logger.error(e)
+            return 1
+        logger.info("{} {} items of {} and {} objects of the stores of {}".format(
+            "Would remove" if self.args.dry_run else "Removed", len(removed),
+            cgroup.format_size(sum(item.size for item in removed)),
+            objects, cgroup.format_size(pruned)))
+        if self.args.dry_run:
+            for item in gc.items:
+                if item.protected:
+                    logger.info("Keeping {} {}: {}".format(item.kind, item.path,
+                                                           item.protected))
+        return 0
+
+    def cmd_collect(self):
+        """ Collects the results of a run from the delta of a container """
+        owner = None
+        if self.args.user:
+            try:
+                pw = pwd.getpwnam(self.args.user)
+            except KeyError:
+                logger.error("Unknown user '{}'".format(self.args.user))
+                return 1
+            owner = (pw.pw_uid, pw.pw_gid)
+        results = collector.Collector(os.path.join(self.container.rundir, "delta"),
+                                      self.args.dest, owner=owner)
+        try:
+            with timing.span("collect", self.container.timings):
+                results.collect(self.args.paths, self.args.logs)
+        except collector.CollectorError as e:
+            logger.error(e)
+            return 1
+        return 0
+
+    def cmd_timings(self):
+        """ Writes the timings of the latest run as JSON """
+        try:
+            timings = self.container.merge_timings(self.args.output)
+        except OSError as e:
+            logger.error("Can't write the timings: {}".format(e))
+            return 1
+        for (name, duration) in sorted(timings["totals"].items(),
+                                       key=lambda t: t[1], reverse=True):
+            logger.info("{:>10.1f}s {}".format(duration, name))
+        return 0
+
+    def cmd_stream_logs(self):
+        """ Streams log files from the delta of a running container """
+        streamer = logstream.LogStreamer(os.path.join(self.container.rundir, "delta"),
+                                         self.args.logfiles, combined=self.args.output)
+        try:
+            streamer.run(pid=self.args.pid)
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    def cmd_sample(self):
+        """ Samples the cgroup of a running container until it stops """
+        pid = self.container.container.init_pid
+        if not self.container.running or pid <= 0:
+            logger.error("Container '{}' isn't running".format(self.container.name))
+            return 1
+        try:
+            cg = cgroup.Cgroup(self.container.name, pid)
+        except (cgroup.CgroupError, OSError) as e:
+            logger.error("Can't sample container '{}': {}".format(self.container.name, e))
+            return 1
+
+        def alive():
+            if self.args.pid is not None and not logstream.pid_alive(self.args.pid):
+                return False
+            return self.container.running
+
+        sampler = cgroup.Sampler(cg, self.args.output, self.args.interval)
+        try:
+            sampler.run(alive)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            cg.close()
+        summary = sampler.summary()
+        logger.info(summary)
+        if self.args.summary:
+            try:
+                with open(self.args.summary, "a") as f:
+                    f.write(summary + "\n")
+            except OSError as e:
+                logger.warning("Can't write the summary of the resources: {}".format(e))
+        return 0
+
+    def cmd_wait_post_stop(self):
+        """ Waits for the post-stop hook of the container to finish
+
+        @return: 0 if it finished, 1 on timeout
+        """
+        if self.container.wait_post_stop(self.args.timeout):
+            return 0
+        logger.error("post-stop hook of '{}' didn't finish in {}s".format(
+            self.container.name, self.args.timeout))
+        return 1
+
     def is_already_logged_user(self, force_disconnect=False):
         """Return True if a user is already logged in and we don't shoot them"""
         # Don't shoot any logged in user
@@ -19,10 +19,12 @@ configgenerator - part of the project otto
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+from contextlib import contextmanager
 import logging
 logger = logging.getLogger(__name__)
 import os
 
+from . import utils
 from .utils import ignored
 
 
@@ -34,6 +36,9 @@ class ConfigGenerator(object):
     def __init__(self, config_file):
 
         self._config_file = config_file
+        self._batch_depth = 0
+        self._batch_fsync = False
+        self._dirty = False
 
         # if exists, load old parameters
         self._loading_from_file = False
@@ -51,18 +56,46 @@ class ConfigGenerator(object):
             return
         object.__setattr__(self, name, value)
         if not name.startswith("_") and not self._loading_from_file:
-            self.__write()
+            if self._batch_depth:
+                self._dirty = True
+            else:
+                self.__write()
 
-    def __write(self):
-        """Collect all overriden values and generate the override file"""
+    @contextmanager
+    def batch(self, fsync=False):
+        """Group changes and write the config file once at the end
+
+        The file is written when leaving the outermost batch, even on error,
+        so it always matches the attributes of the object.
+
+        @fsync: flush the config file to disk when writing it
+        """
+        self._batch_depth += 1
+        self._batch_fsync = self._batch_fsync or fsync
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                fsync = self._batch_fsync
+                self._batch_fsync = False
+                if self._dirty:
+                    self._dirty = False
+                    self.__write(fsync)
+
+    def __write(self, fsync=False):
+        """Collect all overriden values and generate the override file
+
+        The file is replaced atomically so the hooks sourcing it never see a
+        partial file."""
         config = self.get_config()
         logger.debug("Save otto configuration file with {}".format(config))
         # ensure we have a rundir
         with ignored(OSError):
             os.makedirs(os.path.dirname(self._config_file))
-        with open(self._config_file, 'w') as f:
-            for key in config:
-                f.write("{}={}\n".format(key.upper(), config[key]))
+        content = "".join("{}={}\n".format(key.upper(), config[key])
+                          for key in config)
+        utils.write_file_atomic(self._config_file, content, fsync)
 
     def __load_parameters_from_file(self, filepath):
         """ Load and set parameters from file """
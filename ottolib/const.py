@@ -23,11 +23,78 @@ LXCBASE = "/var/lib/lxc"
 RUNDIR = "run"
 ARCHIVEDIR = "archive"
 BASESDIR = "bases"
+LAYERSDIR = "layers"
+STOREDIR = "store"
+
+CACHEDIR = "/var/cache/otto"
+IMAGE_CACHE_FILE = "images.json"
+IMAGE_CACHE_SIZE = 64
+HOST_CACHE_FILE = "host.json"
+# apt archives and lists shared by the containers
+APT_CACHE_DIR = CACHEDIR + "/apt"
+APT_CACHE_SIZE = 8 * 1024 ** 3
+
+POSTSTOP_FLAG = ".post-stop.done"
+# Mounts and loop devices of the rootfs of the running container
+ROOTFS_STATE_FILE = ".rootfs.json"
+# Work directory of overlayfs, in the run directory
+UNIONFS_WORKDIR = ".work"
+# Union filesystem of the containers created before it was configurable
+LEGACY_UNIONFS = "aufs"
+# Directory of otto in the guest
+GUEST_OTTODIR = "var/local/otto"
+# Written in the guest by otto-setup once a package layer is complete
+LAYER_MARKER = GUEST_OTTODIR + "/.layer"
+# Barrier of the warm containers, in GUEST_OTTODIR: otto-setup creates the
+# ready flag and waits for otto to create the release flag
+READY_FLAG = ".ready"
+RELEASE_FLAG = ".release"
+# Package lists read by otto-setup
+PACKAGE_LISTS = (".repo", ".pkgs", ".strict")
 
 CONFIG_FILE = "config"
 LOCAL_CONFIG_FILE = "config.local"
+CUSTOM_MANIFEST_FILE = ".custom-installation.manifest"
+CUSTOM_DIGEST_FILE = ".custom-installation.digest"
+# Timing spans of the run, recorded on the host and in the guest
+TIMINGS_FILE = "timings.jsonl"
+# Entries of the run directory which don't come from the custom installation
+RUN_RESERVED = ("config", "delta", TIMINGS_FILE)
 
 START_TIMEOUT = 60
 UPGRADE_TIMEOUT = 15*60
 STOP_TIMEOUT = 30
 TEST_TIMEOUT = 2 * 3600
+POSTSTOP_TIMEOUT = 30 * 60
+# Boot of a warm container up to the ready barrier
+WARM_TIMEOUT = 10 * 60
+# Seconds between two checks of the state of a container
+STATE_POLL_INTERVAL = 0.2
+# Seconds between two samples of the resources used by a container
+SAMPLE_INTERVAL = 1.0
+
+# Disk budgets of otto gc, in bytes, None for no limit: data of each
+# container, data of all of them and space left on their filesystem
+GC_CONTAINER_BUDGET = 50 * 1024 ** 3
+GC_HOST_BUDGET = None
+GC_MIN_FREE = 20 * 1024 ** 3
+# Seconds after which an archive, a base delta or a layer not used is removed
+GC_MAX_AGE = 30 * 86400
+
+# Resources of a run when the testsuite doesn't request any
+MEMORY_LIMIT = 2 * 1024 ** 3
+SWAP_LIMIT = 512 * 1024 ** 2
+CPU_SHARES = 1024
+BLKIO_WEIGHT = 500
+# Memory of the host never given to a container
+HOST_MEMORY_RESERVE = 1024 ** 3
+# Settings of the config of a testsuite read by otto, the other ones are
+# only used by otto-run
+SUITE_LIMITS = ("MEMORY_LIMIT", "SWAP_LIMIT", "CPUS", "CPU_SHARES",
+                "BLKIO_WEIGHT", "CPU_PINNING")
+# Runtime state shared by the otto processes of the host
+RUNTIME_DIR = "/run/otto"
+CPUSET_REGISTRY = RUNTIME_DIR + "/cpusets.json"
+
+# Memory needed by one parallel run, matches the memory limit of the container
+POOL_MEMORY_PER_SLOT = MEMORY_LIMIT
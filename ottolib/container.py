@@ -19,16 +19,17 @@ Class to manage LXC - part of the project otto
 # this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import hashlib
 import logging
 logger = logging.getLogger(__name__)
 import lxc
 import os
 import shutil
 import subprocess
-import tarfile
 import time
 
-from . import const, errors, utils
+from . import archive as archive_mod
+from . import aptcache, cgroup, chunkstore, const, errors, hostinfo, imagecache, inotify, timing, unionfs, utils
 from .configgenerator import ConfigGenerator
 from .utils import ignored
 
@@ -48,8 +49,10 @@ class Container(object):
         self.wait = self.container.wait
         self.containerpath = os.path.join(const.LXCBASE, name)
         self.rundir = os.path.join(self.containerpath, const.RUNDIR)
+        self.storepath = os.path.join(self.containerpath, const.STOREDIR)
+        self.timings = os.path.join(self.rundir, const.TIMINGS_FILE)
 
-        self.arch = utils.host_arch()
+        self.arch = hostinfo.get_facts()["arch"]
 
         # Create root tree
         if create:
@@ -65,6 +68,10 @@ class Container(object):
     def running(self):
         return self.container.running
 
+    @property
+    def state(self):
+        return self.container.state
+
     def create(self, imagepath, upgrade=False, local_config=None):
         """Creates a new container
 
@@ -103,6 +110,13 @@ class Container(object):
 
         self._mountiso(container_imagepath)
 
+        # the deltas only work with the filesystem which created them
+        try:
+            self.config.unionfs = unionfs.default_backend().name
+        except unionfs.UnionFSError as e:
+            shutil.rmtree(self.containerpath)
+            raise ContainerError(e)
+
         if local_config:
             self.setup_local_config(local_config)
 
@@ -120,6 +134,63 @@ class Container(object):
 
         logger.debug("Creation done")
 
+    def clone(self, name):
+        """Create a new container sharing the image and the bases of this one
+
+        The image is hardlinked like in create(), base deltas and package
+        layers are reflinked or hardlinked as they are never modified, and
+        the tools are generated for the new container. Only the settings of
+        the container are copied, the clone starts without any run.
+
+        @name: name of the new container
+        @return: the new Container
+        """
+        if self.config.command:
+            raise ContainerError("Container '{}' is running a {}, can't clone it".format(
+                self.name, self.config.command))
+        clone = Container(name, create=True)
+        logger.info("Cloning container '{}' to '{}'".format(self.name, name))
+        try:
+            os.makedirs(clone.containerpath)
+            image = os.path.join(self.containerpath, self.config.image)
+            clone_image = os.path.join(clone.containerpath, self.config.image)
+            if os.path.islink(image):
+                os.symlink(os.readlink(image), clone_image)
+            else:
+                try:
+                    os.link(image, clone_image)
+                except OSError:
+                    os.symlink(os.path.realpath(image), clone_image)
+
+            for directory in (const.BASESDIR, const.LAYERSDIR):
+                src = os.path.join(self.containerpath, directory)
+                with ignored(FileNotFoundError):
+                    for entry in os.listdir(src):
+                        # unfinished builds of layers
+                        if entry.endswith(".build"):
+                            continue
+                        methods = utils.clone_tree(os.path.join(src, entry),
+                                                   os.path.join(clone.containerpath, directory, entry))
+                        logger.debug("{}/{} cloned: {}".format(directory, entry, methods))
+
+            with clone.config.batch():
+                clone._mountiso(clone_image)
+                clone.config.unionfs = self.config.unionfs or const.LEGACY_UNIONFS
+                clone.config.basedeltadir = self.config.basedeltadir
+            local_config = os.path.join(self.rundir, const.LOCAL_CONFIG_FILE)
+            if os.path.isfile(local_config):
+                clone.setup_local_config(local_config)
+
+            os.makedirs(os.path.join(clone.containerpath, "rootfs"))
+            os.makedirs(os.path.join(clone.containerpath, "tools"))
+            clone._copy_otto_files()
+            clone.container.load_config()
+        except BaseException:
+            with ignored(OSError):
+                shutil.rmtree(clone.containerpath)
+            raise
+        return clone
+
     def destroy(self):
         """Destroys a container
 
@@ -144,71 +215,209 @@ class Container(object):
 
     def upgrade(self):
         """Run and store a dist-upgrade in the container."""
-        self.config.basedeltadir = os.path.join(const.BASESDIR, time.strftime("base_%Y.%m.%d-%Hh%Mm%S"))
+        basedelta = self._prepare_upgrade()
+        self.start()
+        self.container.wait('STOPPED', const.UPGRADE_TIMEOUT)
+        self._finish_upgrade(basedelta)
+
+    def _prepare_upgrade(self):
+        """Create a new base delta and switch the container to upgrade mode
+
+        @return: path to the base delta"""
+        with self.config.batch():
+            self.config.basedeltadir = os.path.join(const.BASESDIR, time.strftime("base_%Y.%m.%d-%Hh%Mm%S"))
+            self.config.command = "upgrade"
         logger.debug("Upgrading the container to create a base in {}".format(self.config.basedeltadir))
         basedelta = os.path.join(self.containerpath, self.config.basedeltadir)
         os.makedirs(basedelta)
-        self.config.command = "upgrade"
-        self.start()
-        self.container.wait('STOPPED', const.UPGRADE_TIMEOUT)
+        return basedelta
+
+    def _finish_upgrade(self, basedelta):
+        """Check that the upgrade stored in basedelta succeeded"""
         if self.running:
             raise ContainerError("The container didn't stop successfully")
         self.config.command = ""
         if os.path.isfile(os.path.join(basedelta, '.upgrade')):
             raise ContainerError("The upgrade didn't finish successfully")
 
-    def start(self, with_delta=False):
+    def layer_key(self):
+        """Return the key of the package layer of the next run
+
+        The layer depends on the image, the base delta and the package lists
+        the guest will see.
+        """
+        # the drivers package list is generated with the tools
+        self._copy_otto_files()
+        (isoid, release, _) = self._mountiso(
+            os.path.join(self.containerpath, self.config.image))
+        # same order as the copies of the pre-mount hook
+        listdirs = [os.path.join(self.containerpath, "tools", "guest", "var",
+                                 "local", "otto", "config"),
+                    os.path.join(self.rundir, "packages"),
+                    os.path.join(self.rundir, "packages", release)]
+        lists = {}
+        for listdir in listdirs:
+            with ignored(FileNotFoundError):
+                for name in os.listdir(listdir):
+                    path = os.path.join(listdir, name)
+                    if name.endswith(const.PACKAGE_LISTS) and os.path.isfile(path):
+                        lists[name] = utils.file_digest(path)
+
+        sha = hashlib.sha256()
+        sha.update("{}\n{}\n".format(isoid, self.config.basedeltadir or "").encode())
+        for name in sorted(lists):
+            sha.update("{} {}\n".format(name, lists[name]).encode())
+        return "{}-{}".format(isoid, sha.hexdigest()[:16])
+
+    def use_layer(self, apt_cache=True):
+        """Run on top of the package layer matching this run
+
+        The layer is built first if it doesn't exist yet.
+
+        @apt_cache: share the apt cache of the host while building the layer
+        """
+        layerdir = os.path.join(const.LAYERSDIR, self.layer_key())
+        if os.path.isdir(os.path.join(self.containerpath, layerdir)):
+            logger.info("Reusing package layer {}".format(layerdir))
+        else:
+            self.build_layer(layerdir, apt_cache)
+        self.config.layerdir = layerdir
+
+    def build_layer(self, layerdir, apt_cache=True):
+        """Install the packages of the run in a new package layer
+
+        The container runs the package setup only, like an upgrade, and
+        stores the result in layerdir.
+        """
+        logger.info("Building package layer {}".format(layerdir))
+        builddir = os.path.join(self.containerpath, layerdir + ".build")
+        with ignored(FileNotFoundError):
+            shutil.rmtree(builddir)
+        os.makedirs(builddir)
+        with self.config.batch():
+            self.config.layerdir = layerdir + ".build"
+            self.config.command = "layer"
+        try:
+            with timing.span("layer.build", self.timings):
+                self.start(apt_cache=apt_cache)
+                self.container.wait('STOPPED', const.UPGRADE_TIMEOUT)
+                if self.running:
+                    raise ContainerError("The container didn't stop successfully")
+                self.wait_post_stop()
+                # the run on top of the layer waits for its own post-stop
+                self._clear_post_stop()
+            if (os.path.isfile(os.path.join(builddir, '.layer')) or
+                    not os.path.isfile(os.path.join(builddir, const.LAYER_MARKER))):
+                raise ContainerError("The package layer couldn't be built, check "
+                                     "the logs of otto-setup")
+            os.rename(builddir, os.path.join(self.containerpath, layerdir))
+        except BaseException:
+            with ignored(FileNotFoundError):
+                shutil.rmtree(builddir)
+            raise
+        finally:
+            with self.config.batch():
+                self.config.command = ""
+                self.config.layerdir = ""
+
+    def start(self, with_delta=False, apt_cache=True, warm=False):
         """Starts a container.
 
         This method refresh with starts a container and wait for START_TIMEOUT before
         aborting.
+
+        @with_delta: keep the delta of the previous run
+        @apt_cache: share the apt cache of the host with the container
+        @warm: stop the boot at the ready barrier to wait for a job
         """
+        self._launch(with_delta, apt_cache, warm)
+
+        # Wait for the container to start
+        with timing.span("start.wait-running", self.timings):
+            self.container.wait('RUNNING', const.START_TIMEOUT)
+        logger.info("Container '{}' started".format(self.name))
+        if not self.running:
+            raise ContainerError("The container didn't start successfully")
+
+    def _launch(self, with_delta=False, apt_cache=True, warm=False):
+        """Prepare the run and ask LXC to start the container without waiting
+        for it to run"""
         if self.running:
             raise ContainerError("Container '{}' already running.".format(self.name))
 
-        self._mountiso(os.path.join(self.containerpath, self.config.image))
-        # check that the container is coherent with our deltas
-        (isoid, release, arch) = utils.extract_cd_info(self.config.isomount)
-        if self.config.command != "upgrade" and self.config.iso is not None:
-            logger.debug("Checking that the container is compatible with the iso.")
-            if not (self.config.isoid == isoid and
-                    self.config.release == release and
-                    self.config.arch == arch):
-                raise ContainerError("Can't reuse a previous run delta: the previous run was used with "
-                             "{deltaisoid}, {deltarelease}, {deltaarch} and {imagepath} is for "
-                             "{isoid}, {release}, {arch}. config use a compatible container."
-                             "".format(deltaisoid=self.config.isoid,
-                                       deltarelease=self.config.release,
-                                       deltaarch=self.config.arch,
-                                       isoid=isoid, release=release, arch=arch,
-                                       imagepath=self.config.image))
-            if self.config.basedeltadir:
-                logger.debug("Check that the delta has a compatible base delta in the container")
-                if not os.path.isdir(os.path.join(self.containerpath, self.config.basedeltadir)):
-                    raise ContainerError("No base delta found as {}. This means that we can't reuse "
-                                         "this previous run with it. Please use a compatible container "
-                                         "or restore this base delta.".format(self.config.basedeltadir))
-        self.config.isoid = isoid
-        self.config.release = release
-        self.config.arch = arch
-
-        # regenerate a new runid, even if restarting an old run
-        self.config.runid = int(time.time())
-
-        self.config.archivedir = const.ARCHIVEDIR
+        # all the settings of the run are written at once
+        with self.config.batch(fsync=True):
+            # check that the container is coherent with our deltas
+            with timing.span("start.mount-iso", self.timings):
+                (isoid, release, arch) = self._mountiso(
+                    os.path.join(self.containerpath, self.config.image))
+            if self.config.command != "upgrade" and self.config.iso is not None:
+                logger.debug("Checking that the container is compatible with the iso.")
+                if not (self.config.isoid == isoid and
+                        self.config.release == release and
+                        self.config.arch == arch):
+                    raise ContainerError("Can't reuse a previous run delta: the previous run was used with "
+                                 "{deltaisoid}, {deltarelease}, {deltaarch} and {imagepath} is for "
+                                 "{isoid}, {release}, {arch}. config use a compatible container."
+                                 "".format(deltaisoid=self.config.isoid,
+                                           deltarelease=self.config.release,
+                                           deltaarch=self.config.arch,
+                                           isoid=isoid, release=release, arch=arch,
+                                           imagepath=self.config.image))
+                if self.config.layerdir:
+                    if not os.path.isdir(os.path.join(self.containerpath, self.config.layerdir)):
+                        raise ContainerError("No package layer found as {}. This means that we can't "
+                                             "reuse this previous run with it.".format(self.config.layerdir))
+                if self.config.basedeltadir:
+                    logger.debug("Check that the delta has a compatible base delta in the container")
+                    if not os.path.isdir(os.path.join(self.containerpath, self.config.basedeltadir)):
+                        raise ContainerError("No base delta found as {}. This means that we can't reuse "
+                                             "this previous run with it. Please use a compatible container "
+                                             "or restore this base delta.".format(self.config.basedeltadir))
+            self.config.isoid = isoid
+            self.config.release = release
+            self.config.arch = arch
+
+            # regenerate a new runid, even if restarting an old run
+            self.config.runid = int(time.time())
+
+            self.config.archivedir = const.ARCHIVEDIR
+            # used by the hooks to call back otto
+            self.config.ottodir = utils.get_base_dir()
+            self.config.aptcache = const.APT_CACHE_DIR if apt_cache else ""
+            self.config.warm = warm
+
+            # spread the pinned containers over the cores of the host
+            if any(str(value).lower() in ("1", "true", "yes")
+                   for value in (self.config.pin, self.config.cpupinning)):
+                (cpus, mems) = cgroup.CpusetRegistry().allocate(
+                    self.name, max(1, self._requested_cpus()),
+                    lambda name: lxc.Container(name).running)
+                self.config.cpuset = cgroup.format_cpulist(cpus)
+                self.config.cpusetmems = cgroup.format_cpulist(mems)
+            else:
+                self.config.cpuset = ""
+                self.config.cpusetmems = ""
+
+        if self.config.aptcache:
+            with timing.span("start.apt-cache", self.timings):
+                cache = aptcache.AptCache(self.config.aptcache)
+                try:
+                    cache.prepare()
+                    cache.evict()
+                except aptcache.AptCacheError as e:
+                    raise ContainerError(e)
 
         # tools and default config from otto
-        self._copy_otto_files()
+        with timing.span("start.copy-otto-files", self.timings):
+            self._copy_otto_files()
 
+        # wait_post_stop() must not return on the flag of a previous run
+        self._clear_post_stop()
         logger.info("Starting container '{}'".format(self.name))
-        if not self.container.start():
-            raise ContainerError("Can't start lxc container")
-
-        # Wait for the container to start
-        self.container.wait('RUNNING', const.START_TIMEOUT)
-        logger.info("Container '{}' started".format(self.name))
-        if not self.running:
-            raise ContainerError("The container didn't start successfully")
+        with timing.span("start.lxc-start", self.timings):
+            if not self.container.start():
+                raise ContainerError("Can't start lxc container")
 
     def stop(self):
         """Stops a container
@@ -216,18 +425,193 @@ class Container(object):
         This method stops a container and wait for STOP_TIMEOUT before
         aborting.
         """
-        if not self.running:
-            raise ContainerError("Container '{}' already stopped.".format(self.name))
-
-        logger.info("Stopping container '{}'".format(self.name))
-        if not self.container.stop():
-            raise ContainerError("The lxc command returned an error")
+        self._request_stop()
 
         # Wait for the container to stop
         self.container.wait('STOPPED', const.STOP_TIMEOUT)
         logger.info("Container '{}' stopped".format(self.name))
         if self.running:
             raise ContainerError("The container didn't stop successfully")
+        if self.config.cpuset:
+            cgroup.CpusetRegistry().release(self.name)
+
+    def warm(self, apt_cache=True):
+        """Boot the container up to the ready barrier of otto-setup
+
+        The container is mounted, prepared by the pre-mount hook and booted
+        without custom installation, then waits for a job given by
+        dispatch().
+        """
+        self.reset_timings()
+        self.remove_custom_installation()
+        self.remove_delta()
+        with self.config.batch():
+            self.config.layerdir = ""
+            self.config.archive = False
+        self.start(apt_cache=apt_cache, warm=True)
+
+    def wait_ready(self, timeout=const.WARM_TIMEOUT):
+        """Wait for a warm container to reach the ready barrier
+
+        @return: True if the container is ready, False on timeout
+        """
+        return inotify.wait_for_file(self._guest_path(const.READY_FLAG), timeout)
+
+    @property
+    def ready(self):
+        """True if the container is warm and waiting for a job"""
+        return (self.running and os.path.isfile(self._guest_path(const.READY_FLAG))
+                and not os.path.exists(self._guest_path(const.RELEASE_FLAG)))
+
+    def dispatch(self, custom_installation, archive=False):
+        """Give a job to a warm container and release its barrier
+
+        The custom installation is staged in the run directory and copied
+        in the rootfs like the pre-mount hook does, then otto-setup carries
+        on with the package setup and the tests.
+
+        @custom_installation: path of the custom installation of the job
+        @archive: archive the run once the container stops
+        """
+        if not self.ready:
+            raise ContainerError("Container '{}' isn't waiting for a job".format(self.name))
+        logger.info("Dispatching {} to container '{}'".format(custom_installation, self.name))
+        self.install_custom_installation(custom_installation)
+        rootfs = os.path.join(self.containerpath, "rootfs")
+        target_override = os.path.join(self.rundir, "target-override")
+        if os.path.isdir(target_override):
+            # owners and hard links are kept, like pre-mount
+            try:
+                subprocess.check_call(["rsync", "-aH", target_override + "/", rootfs + "/"])
+            except (OSError, subprocess.CalledProcessError) as exc:
+                raise ContainerError("Can't copy {} to the rootfs of '{}': {}".format(
+                    target_override, self.name, exc))
+        listdir = self._guest_path("config")
+        os.makedirs(listdir, exist_ok=True)
+        packages = os.path.join(self.rundir, "packages")
+        # the lists specific to the release override the generic ones
+        for srcdir in (packages, os.path.join(packages, self.config.release)):
+            with ignored(FileNotFoundError):
+                for name in os.listdir(srcdir):
+                    path = os.path.join(srcdir, name)
+                    if os.path.isfile(path):
+                        shutil.copy2(path, listdir)
+        with ignored(FileNotFoundError):
+            shutil.copy2(os.path.join(self.rundir, const.CUSTOM_DIGEST_FILE),
+                         self._guest_path(const.CUSTOM_DIGEST_FILE))
+
+        with self.config.batch():
+            self.config.warm = False
+            self.config.archive = archive
+        open(self._guest_path(const.RELEASE_FLAG), "w").close()
+
+    def _timings_files(self):
+        """Return the timings files of the host and of the guest"""
+        return [self.timings, os.path.join(self.rundir, "delta", const.GUEST_OTTODIR,
+                                           const.TIMINGS_FILE)]
+
+    def reset_timings(self):
+        """Forget the timing spans of the previous run"""
+        for path in self._timings_files():
+            timing.reset(path)
+
+    def merge_timings(self, dest):
+        """Merge the timing spans of the host and the guest in dest
+
+        @return: the merged timings
+        """
+        return timing.merge(self._timings_files(), dest)
+
+    def _guest_path(self, path):
+        """Return the path on the host of a file of otto in the guest"""
+        return os.path.join(self.containerpath, "rootfs", const.GUEST_OTTODIR, path)
+
+    def _clear_post_stop(self):
+        """Remove the flag of the post-stop hook of the previous run"""
+        with ignored(FileNotFoundError):
+            os.remove(os.path.join(self.containerpath, const.POSTSTOP_FLAG))
+
+    def wait_post_stop(self, timeout=const.POSTSTOP_TIMEOUT):
+        """Wait for the post-stop hook to finish
+
+        The hook creates a flag file once the filesystems are unmounted and
+        the run archived. This returns as soon as it is created.
+
+        @return: True if the hook finished, False on timeout
+        """
+        return inotify.wait_for_file(
+            os.path.join(self.containerpath, const.POSTSTOP_FLAG), timeout)
+
+    def mount_rootfs(self, target):
+        """Mount the rootfs of the run on target
+
+        This is called by the pre-start hook. The branches are, from top to
+        bottom: the run delta, the package layer, the base delta and the
+        squashfs. Upgrades write to the base delta and layer builds to the
+        package layer.
+        """
+        if self.config.isomount:
+            utils.mount_iso(os.path.join(self.containerpath, self.config.image),
+                            self.config.isomount)
+        if not self.config.squashfs or not os.path.isfile(self.config.squashfs):
+            raise ContainerError("File doesn't exist '{}'".format(self.config.squashfs))
+
+        basedelta = layer = None
+        if self.config.basedeltadir:
+            basedelta = os.path.join(self.containerpath, self.config.basedeltadir)
+        if self.config.layerdir:
+            layer = os.path.join(self.containerpath, self.config.layerdir)
+        if self.config.command == "upgrade":
+            (upper, lowers) = (basedelta, [])
+        elif self.config.command == "layer":
+            (upper, lowers) = (layer, [basedelta])
+        else:
+            upper = os.path.join(self.rundir, "delta")
+            os.makedirs(upper, exist_ok=True)
+            lowers = [layer, basedelta]
+        lowers = [branch for branch in lowers if branch]
+        # the least recently used bases and layers are removed first by otto gc
+        for branch in lowers:
+            with ignored(OSError):
+                os.utime(branch)
+
+        try:
+            backend = unionfs.get_backend(self.config.unionfs or const.LEGACY_UNIONFS)
+            self._rootfs().mount(backend, self.config.squashfs,
+                                 os.path.join(self.containerpath, "squashfs"),
+                                 upper, lowers, target,
+                                 os.path.join(self.rundir, const.UNIONFS_WORKDIR))
+        except unionfs.UnionFSError as e:
+            self.umount_rootfs()
+            raise ContainerError("Can't mount the rootfs: {}".format(e))
+
+        # tells otto-setup what to do
+        if self.config.command == "upgrade":
+            open(os.path.join(target, ".upgrade"), "w").close()
+        elif self.config.command == "layer":
+            open(os.path.join(target, ".layer"), "w").close()
+
+    def umount_rootfs(self):
+        """Unmount the rootfs and release its loop devices
+
+        This is called by the post-stop hook.
+
+        @return: True if everything was unmounted
+        """
+        return not self._rootfs().umount()
+
+    def _rootfs(self):
+        return unionfs.RootFS(os.path.join(self.containerpath,
+                                           const.ROOTFS_STATE_FILE))
+
+    def _request_stop(self):
+        """Ask LXC to stop the container without waiting for it"""
+        if not self.running:
+            raise ContainerError("Container '{}' already stopped.".format(self.name))
+
+        logger.info("Stopping container '{}'".format(self.name))
+        if not self.container.stop():
+            raise ContainerError("The lxc command returned an error")
 
     def _refreshconfig(self):
         """Force recreate new config objects attached to the content of
@@ -241,46 +625,57 @@ class Container(object):
         This enables to refresh with the latest files from the tree"""
 
         # Copy files used by the container
+        # Only the files which changed are written, so starting a container
+        # again doesn't touch its tools.
         # Substitute name of the container in the configuration file.
         lxcdefaults = os.path.join(utils.get_base_dir(), "lxc.defaults")
+        lines = []
         with open(os.path.join(lxcdefaults, "config"), 'r') as fin:
-            with open(os.path.join(self.containerpath, "config"), 'w') as fout:
-                for line in fin:
-                    lineout = line
-                    if "${NAME}" in line:
-                        lineout = line.replace("${NAME}", self.name)
-                    elif "${ARCH}" in line:
-                        lineout = line.replace("${ARCH}", self.arch)
-                    fout.write(lineout)
-
-        dri_exists = os.path.exists("/dev/dri")
-        vga_device = utils.find_vga_device()
+            for line in fin:
+                lineout = line
+                if "${NAME}" in line:
+                    lineout = line.replace("${NAME}", self.name)
+                elif "${ARCH}" in line:
+                    lineout = line.replace("${ARCH}", self.arch)
+                elif "${HWADDR}" in line:
+                    lineout = line.replace("${HWADDR}",
+                                           utils.container_hwaddr(self.name))
+                lines.append(lineout)
+        lines.append("\n# Resources of the run, from the testsuite and the host\n")
+        lines.extend("{} = {}\n".format(key, value) for (key, value) in self._cgroup_settings())
+        utils.write_if_changed(os.path.join(self.containerpath, "config"),
+                               "".join(lines))
+
+        facts = hostinfo.get_facts()
+        dri_exists = facts["dri_exists"]
+        vga_device = facts["vga_device"]
+        lines = []
         with open(os.path.join(lxcdefaults, "fstab"), 'r') as fin:
-            with open(os.path.join(self.containerpath, "fstab"), 'w') as fout:
-                for line in fin:
-                    if line.startswith("/dev/dri") and not dri_exists:
-                        lineout = "# /dev/dri not found, entry disabled ("\
-                                "do you use nvidia or fglrx graphics "\
-                                "drivers?)\n"
-                        lineout += "#" + line
-                    else:
-                        lineout = line
-                    fout.write(lineout)
+            for line in fin:
+                if line.startswith("/dev/dri") and not dri_exists:
+                    lineout = "# /dev/dri not found, entry disabled ("\
+                            "do you use nvidia or fglrx graphics "\
+                            "drivers?)\n"
+                    lineout += "#" + line
+                else:
+                    lineout = line
+                lines.append(lineout)
+        if self.config.aptcache:
+            lines.append("\n# apt cache shared with the host\n")
+            lines.extend(aptcache.AptCache(self.config.aptcache).fstab_entries())
+        utils.write_if_changed(os.path.join(self.containerpath, "fstab"),
+                               "".join(lines))
 
         src = os.path.join(lxcdefaults, "scripts")
         dst = os.path.join(self.containerpath, "tools", "scripts")
-        with ignored(OSError):
-            shutil.rmtree(dst)
-        shutil.copytree(src, dst)
+        utils.sync_tree(src, dst)
         utils.set_executable(os.path.join(dst, "pre-start.sh"))
         utils.set_executable(os.path.join(dst, "pre-mount.sh"))
         utils.set_executable(os.path.join(dst, "post-stop.sh"))
 
         src = os.path.join(lxcdefaults, "guest")
         dst = os.path.join(self.containerpath, "tools", "guest")
-        with ignored(OSError):
-            shutil.rmtree(dst)
-        shutil.copytree(src, dst)
+        utils.sync_tree(src, dst)
 
         # Some graphics need a proprietary driver
         # driver -> packages to install
@@ -289,51 +684,127 @@ class Container(object):
             "fglrx_pci": "fglrx",
             "nvidia": "nvidia-current"
         }
-        if vga_device is not None and "Driver" in vga_device:
-            if vga_device["Driver"] in drivers:
-                logging.info("Installing additional drivers for graphics "
-                             "card {}".format(vga_device["Device"]))
-                # l-h-g must be installed to compile additional modules
-                pkgs = "linux-headers-generic {}\n".format(
-                    drivers[vga_device["Driver"]])
-                # TODO: this shouldn't be in the guest directory
-                pkgsdir = os.path.join(self.containerpath, "tools", "guest", "var", "local", "otto", "config")
-                if not os.path.exists(pkgsdir):
-                    os.makedirs(pkgsdir)
-                with open(os.path.join(pkgsdir, "00drivers.pkgs"), 'w') as fpkgs:
-                    logging.debug("Custom drivers written to {}".format(
-                        os.path.join(pkgsdir, "00drivers.pkgs")))
-                    fpkgs.write(pkgs)
+        # TODO: this shouldn't be in the guest directory
+        pkgsdir = os.path.join(self.containerpath, "tools", "guest", "var", "local", "otto", "config")
+        driverspkgs = os.path.join(pkgsdir, "00drivers.pkgs")
+        if vga_device is not None and vga_device.get("Driver") in drivers:
+            logging.info("Installing additional drivers for graphics "
+                         "card {}".format(vga_device["Device"]))
+            # l-h-g must be installed to compile additional modules
+            pkgs = "linux-headers-generic {}\n".format(
+                drivers[vga_device["Driver"]])
+            if not os.path.exists(pkgsdir):
+                os.makedirs(pkgsdir)
+            if utils.write_if_changed(driverspkgs, pkgs):
+                logging.debug("Custom drivers written to {}".format(driverspkgs))
+        else:
+            with ignored(OSError):
+                os.remove(driverspkgs)
+
+    def _requested_cpus(self):
+        """Return the number of cores requested by the testsuite, 0 if none"""
+        try:
+            return min(int(self.config.cpus or 0), os.cpu_count() or 1)
+        except ValueError:
+            raise ContainerError("Invalid CPUS in the testsuite config: {}".format(self.config.cpus))
+
+    def _cgroup_settings(self):
+        """Return the cgroup settings of the run for the LXC config
+
+        The limits requested by the testsuite are capped by the capacity of
+        the host, the defaults are the ones of a run of a desktop session.
+        """
+        try:
+            memory = utils.parse_size(self.config.memorylimit or const.MEMORY_LIMIT)
+            swap = utils.parse_size(self.config.swaplimit or const.SWAP_LIMIT)
+            weight = int(self.config.blkioweight or const.BLKIO_WEIGHT)
+            shares = int(self.config.cpushares or 0)
+        except ValueError as e:
+            raise ContainerError("Invalid resource in the testsuite config: {}".format(e))
+        cpus = self._requested_cpus()
+        if not shares:
+            shares = const.CPU_SHARES * max(1, cpus)
+        host_memory = hostinfo.get_facts().get("memory")
+        if host_memory:
+            available = max(const.HOST_MEMORY_RESERVE, host_memory - const.HOST_MEMORY_RESERVE)
+            if memory > available:
+                logger.warning("The host only has {} bytes of memory for the container, "
+                               "{} requested".format(available, memory))
+                memory = available
+        pinned = cgroup.parse_cpulist(self.config.cpuset) if self.config.cpuset else None
+        mems = cgroup.parse_cpulist(self.config.cpusetmems) if self.config.cpusetmems else None
+        return cgroup.settings(memory, swap, shares, weight, pinned, mems)
 
     def install_custom_installation(self, path):
         """Install a new custom installation, removing previous one if present.
 
-        Return False if any error"""
+        The files are staged in the run directory with reflinks or hardlinks
+        when possible and the files identical to the previous installation
+        are kept as they are. The digest of the installation is written for
+        the pre-mount hook to skip copying it again into the rootfs."""
 
         logger.info("Customizing container from '{}'".format(path))
         if not os.path.isdir(path):
-            return ContainerError("You provided a wrong custom installation path.")
+            raise ContainerError("You provided a wrong custom installation path.")
 
-        self.remove_custom_installation()
-        for candidate in os.listdir(path):
-            src = os.path.join(path, candidate)
-            dst = os.path.join(self.rundir, candidate)
-            if os.path.isdir(src):
-                shutil.copytree(src, dst)
-            else:
-                shutil.copy(src, dst)
+        manifest = os.path.join(self.rundir, const.CUSTOM_MANIFEST_FILE)
+        if not os.path.isfile(manifest):
+            # unknown content, start from a clean run directory
+            self.remove_custom_installation()
+        else:
+            # top-level entries which aren't part of the new installation
+            for candidate in os.listdir(self.rundir):
+                if candidate.startswith(".") or candidate in const.RUN_RESERVED:
+                    continue
+                if not os.path.lexists(os.path.join(path, candidate)):
+                    self._remove_run_entry(candidate)
+        with timing.span("start.custom-installation", self.timings):
+            digest = utils.stage_tree(path, self.rundir, manifest,
+                                      exclude=const.RUN_RESERVED)
+        utils.write_if_changed(os.path.join(self.rundir, const.CUSTOM_DIGEST_FILE),
+                               digest + "\n")
+        self._load_suite_limits(os.path.join(path, "config"))
+
+    def _load_suite_limits(self, path):
+        """Store the resources requested by the config of a testsuite
+
+        Only the simple KEY=VALUE lines of SUITE_LIMITS are read, the
+        settings which aren't in the file are reset to the defaults.
+
+        @path: config of the testsuite, None to reset all the settings
+        """
+        values = {}
+        if path is not None:
+            with ignored(FileNotFoundError):
+                with open(path) as f:
+                    for line in f:
+                        line = line.strip()
+                        if line.startswith("export "):
+                            line = line[len("export "):].strip()
+                        (key, sep, value) = line.partition("=")
+                        if sep and key in const.SUITE_LIMITS:
+                            values[key] = value.split("#")[0].strip().strip("\"'")
+        with self.config.batch():
+            for key in const.SUITE_LIMITS:
+                setattr(self.config, key.lower().replace("_", ""), values.get(key, ""))
 
     def remove_custom_installation(self):
         """Delete custom installation content from latest run"""
 
         logger.info("Removing old customization")
-        for candidate in os.listdir(self.rundir):
-            if candidate not in ("config", "delta"):
-                candidate = os.path.join(self.rundir, candidate)
-                try:
-                    shutil.rmtree(candidate)
-                except NotADirectoryError:
-                    os.remove(candidate)
+        with ignored(OSError):
+            for candidate in os.listdir(self.rundir):
+                if candidate not in const.RUN_RESERVED:
+                    self._remove_run_entry(candidate)
+        self._load_suite_limits(None)
+
+    def _remove_run_entry(self, candidate):
+        """Remove a file or directory of the run directory"""
+        candidate = os.path.join(self.rundir, candidate)
+        try:
+            shutil.rmtree(candidate)
+        except NotADirectoryError:
+            os.remove(candidate)
 
     def setup_local_config(self, file_path):
         """Setup a custom local config"""
@@ -354,44 +825,102 @@ class Container(object):
         with ignored(OSError):
             shutil.rmtree(os.path.join(self.rundir, "delta"))
 
+    def archive_path(self, archive):
+        """Return the path of an archive of the container
+
+        @archive: name of the archive in the archive directory, or its path"""
+        if os.path.isabs(archive):
+            path = archive
+        else:
+            path = os.path.join(self.containerpath, const.ARCHIVEDIR, archive)
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        return path
+
+    def archive_members(self, archive):
+        """Return the entries of the members of an archive of the container
+
+        They are read from the index of the archive or from its manifest if
+        it is deduplicated, the archive is only decompressed without them."""
+        path = self.archive_path(archive)
+        try:
+            if archive_mod.detect_format(path) == "manifest":
+                return chunkstore.read_manifest(path)
+            return archive_mod.list_members(path)
+        except (archive_mod.ArchiveError, chunkstore.ChunkStoreError) as e:
+            raise ContainerError("Can't read {}: {}".format(path, e))
+
+    def read_archive_member(self, archive, name, fout):
+        """Write the content of a file of an archive of the container to fout
+
+        @archive: name of the archive in the archive directory, or its path
+        @name: path of the file in the run directory, like delta/var/log/syslog
+        @fout: binary file object"""
+        path = self.archive_path(archive)
+        try:
+            if archive_mod.detect_format(path) != "manifest":
+                archive_mod.read_member(path, name, fout)
+                return
+            entries = {archive_mod.normalize_member(e["path"]): e
+                       for e in chunkstore.read_manifest(path)}
+            entry = entries.get(archive_mod.normalize_member(name))
+            if entry is not None and entry["type"] == "hardlink":
+                entry = entries.get(archive_mod.normalize_member(entry["target"]))
+            if entry is None or entry["type"] != "file":
+                raise ContainerError("No file {} in {}".format(name, path))
+            chunkstore.ChunkStore(self.storepath).read_file(entry, fout)
+        except (archive_mod.ArchiveError, chunkstore.ChunkStoreError) as e:
+            raise ContainerError("Can't read {} from {}: {}".format(name, path, e))
+
     def restore(self, archive):
         """Restore an old container run"""
         logger.info("Restoring an old archive run from {}".format(archive))
-        if os.path.isabs(archive):
-            restorefile = archive
-        else:
-            restorefile = os.path.join(self.containerpath, const.ARCHIVEDIR, archive)
+        restorefile = self.archive_path(archive)
         with ignored(OSError):
             shutil.rmtree(os.path.join(self.rundir))
-        with tarfile.open(restorefile, "r:gz") as f:
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(f, self.rundir)
+        try:
+            if archive_mod.detect_format(restorefile) == "manifest":
+                chunkstore.ChunkStore(self.storepath).restore(restorefile, self.rundir)
+            else:
+                archive_mod.extract_archive(restorefile, self.rundir)
+        except (archive_mod.ArchiveError, chunkstore.ChunkStoreError) as e:
+            raise ContainerError("Can't restore {}: {}".format(restorefile, e))
         self._refreshconfig()
 
+    def archive(self, compression=None, dedup=False):
+        """Archive the current run in the archive directory of the container
+
+        With dedup, the files are added to the chunk store of the container
+        and the archive is only a manifest referencing them.
+
+        @return: path to the archive"""
+        if self.config.isoid is None or self.config.runid is None:
+            raise ContainerError("No run to archive, the container never started")
+        archivedir = os.path.join(self.containerpath,
+                                  self.config.archivedir or const.ARCHIVEDIR)
+        os.makedirs(archivedir, exist_ok=True)
+        dest = os.path.join(archivedir, "{}.{}.otto".format(self.config.isoid,
+                                                            self.config.runid))
+        try:
+            if dedup:
+                with ignored(FileNotFoundError):
+                    os.remove(dest + archive_mod.INDEX_SUFFIX)
+                chunkstore.ChunkStore(self.storepath).archive(self.rundir, dest)
+            else:
+                archive_mod.create_archive(self.rundir, dest, compression)
+        except (archive_mod.ArchiveError, chunkstore.ChunkStoreError, OSError) as e:
+            raise ContainerError("Can't archive the run: {}".format(e))
+        return dest
+
     def _mountiso(self, container_imagepath):
-        """Mount iso from container_imagepath"""
-        (isomount, squashfs) = utils.get_iso_and_squashfs(container_imagepath)
-        if isomount is None or squashfs is None:
+        """Mount iso from container_imagepath
+
+        @return: (isoid, release, arch) of the image"""
+        probe = imagecache.probe_image(container_imagepath)
+        if probe is None:
             shutil.rmtree(self.containerpath)
             raise ContainerError("Couldn't mount or extract squashfs from {}".format(container_imagepath))
+        (isomount, squashfs, isoid, release, arch) = probe
 
         self.config.isomount = isomount
         self.config.squashfs = squashfs
@@ -399,6 +928,7 @@ class Container(object):
 
         logger.debug("selected iso is {}, and squashfs is: {}".format(self.config.isomount,
                                                                       self.config.squashfs))
+        return (isoid, release, arch)
 
     def unmountiso(self):
         """Enable unmouting the iso (used in case of failure)"""
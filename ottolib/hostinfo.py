@@ -0,0 +1,95 @@
+"""
+Cached facts about the host - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+
+from . import const, utils
+
+# The facts are probed again if one of these paths changes: dpkg for the
+# architecture, devices for the graphics card and its driver
+WATCHED_PATHS = ("/usr/bin/dpkg", "/dev/dri", "/sys/bus/pci/devices")
+
+
+def boot_id():
+    """ Return the identifier of the current boot of the host """
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _fingerprint():
+    """ Return what must not change for the cached facts to be valid """
+    mtimes = {}
+    for path in WATCHED_PATHS:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return {"boot_id": boot_id(), "mtimes": mtimes}
+
+
+def _probe():
+    """ Collect the facts with the external tools """
+    logger.debug("Probing host facts")
+    return {"arch": utils.host_arch(),
+            "vga_device": utils.find_vga_device(),
+            "dri_exists": os.path.exists("/dev/dri"),
+            "memory": utils.host_memory(),
+            "cpus": os.cpu_count()}
+
+
+def get_facts(refresh=False, path=None):
+    """ Return the facts about the host, probing them only when needed
+
+    The facts are cached until the next reboot or until one of the
+    WATCHED_PATHS changes.
+
+    @refresh: ignore the cache and probe again
+    @path: path to the cache file
+
+    @return: dictionnary with arch, vga_device, dri_exists, memory and cpus
+    """
+    if path is None:
+        path = os.path.join(const.CACHEDIR, const.HOST_CACHE_FILE)
+    fingerprint = _fingerprint()
+    if not refresh:
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+            if cache.get("fingerprint") == fingerprint:
+                return cache["facts"]
+            logger.debug("Host facts are outdated")
+        except (OSError, ValueError, KeyError):
+            pass
+
+    facts = _probe()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        utils.write_file_atomic(path, json.dumps({"fingerprint": fingerprint,
+                                                  "facts": facts}, indent=2))
+    except OSError as exc:
+        logger.warning("Can't write host facts cache {}: {}".format(path, exc))
+    return facts
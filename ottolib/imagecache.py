@@ -0,0 +1,129 @@
+"""
+Cache of image metadata - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import fcntl
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import time
+
+from . import const, utils
+
+
+class ImageCache(object):
+    """ Persistent cache of the metadata of ISO images
+
+    Entries are keyed by device, inode, size and mtime of the image so a
+    new image (or a modified one) is probed again, while the hardlinks of
+    an image shared by several containers share the same entry.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.join(const.CACHEDIR, const.IMAGE_CACHE_FILE)
+        self.path = path
+
+    @staticmethod
+    def key(image):
+        """ Return the cache key of an image or None if it doesn't exist """
+        try:
+            stt = os.stat(image)
+        except OSError:
+            return None
+        return "{}:{}:{}:{}".format(stt.st_dev, stt.st_ino, stt.st_size,
+                                    stt.st_mtime_ns)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, image):
+        """ Return the cached metadata of an image or None """
+        key = self.key(image)
+        if key is None:
+            return None
+        return self._load().get(key)
+
+    def set(self, image, info):
+        """ Store the metadata of an image
+
+        The least recently stored entries are dropped when the cache is full.
+        """
+        key = self.key(image)
+        if key is None:
+            return
+        info = dict(info, stored=time.time())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entries = self._load()
+                entries[key] = info
+                if len(entries) > const.IMAGE_CACHE_SIZE:
+                    for old in sorted(entries, key=lambda k: entries[k].get("stored", 0)
+                                      )[:len(entries) - const.IMAGE_CACHE_SIZE]:
+                        del entries[old]
+                utils.write_file_atomic(self.path, json.dumps(entries, indent=2))
+        except OSError as exc:
+            logger.warning("Can't write image cache {}: {}".format(self.path, exc))
+
+
+def probe_image(image, cache=None):
+    """ Mount an image and return its metadata
+
+    On a cache hit with the image already mounted, no command is executed and
+    no file is read from the image.
+
+    @image: path to an iso9660 image
+    @cache: ImageCache to use, the default one if None
+
+    @return: (iso_mount, squashfs_path, isoid, release, arch) or None if the
+             image can't be used
+    """
+    if cache is None:
+        cache = ImageCache()
+    info = cache.get(image)
+    if info is not None:
+        iso_mount = utils.iso_mount_path(image)
+        squashfs_path = os.path.join(iso_mount, info["squashfs"])
+        if not os.path.isfile(squashfs_path):
+            utils.mount_iso(image, iso_mount)
+        if os.path.isfile(squashfs_path):
+            logger.debug("Image metadata of {} found in cache".format(image))
+            return (iso_mount, squashfs_path, info["isoid"], info["release"],
+                    info["arch"])
+        logger.debug("Cached squashfs not found in {}, probing "
+                     "again".format(image))
+
+    (iso_mount, squashfs_path) = utils.get_iso_and_squashfs(image)
+    if iso_mount is None or squashfs_path is None:
+        return None
+    (isoid, release, arch) = utils.extract_cd_info(iso_mount)
+    cache.set(image, {"type": "iso9660",
+                      "squashfs": os.path.relpath(squashfs_path, iso_mount),
+                      "isoid": isoid,
+                      "release": release,
+                      "arch": arch})
+    return (iso_mount, squashfs_path, isoid, release, arch)
@@ -0,0 +1,176 @@
+"""
+Minimal inotify binding - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import ctypes
+import ctypes.util
+import logging
+logger = logging.getLogger(__name__)
+import os
+import select
+import struct
+import time
+
+# Events, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                            use_errno=True)
+    return _libc
+
+
+class InotifyError(OSError):
+    pass
+
+
+class Inotify(object):
+    """ Watch files and directories with inotify
+
+    Only what otto needs: add watches and wait for events with a timeout.
+    """
+
+    def __init__(self):
+        try:
+            libc = _get_libc()
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as exc:
+            raise InotifyError("inotify is not available: {}".format(exc))
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise InotifyError(errno, "inotify_init1: " + os.strerror(errno))
+        self.watches = {}
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """ Watch path for the events in mask
+
+        @return: watch descriptor
+        """
+        wd = _get_libc().inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise InotifyError(errno, "inotify_add_watch {}: {}".format(
+                path, os.strerror(errno)))
+        self.watches[wd] = path
+        return wd
+
+    def rm_watch(self, wd):
+        _get_libc().inotify_rm_watch(self.fd, wd)
+        self.watches.pop(wd, None)
+
+    def read(self, timeout=None):
+        """ Wait for events
+
+        @timeout: seconds to wait, forever if None
+
+        @return: list of (watched path, mask, name), empty on timeout
+        """
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            path = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+            events.append((path, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def wait_for_file(path, timeout=None, poll_interval=0.2):
+    """ Wait until path exists
+
+    The parent directory of path must exist. inotify is used when available
+    so this returns as soon as the file is created, otherwise the path is
+    polled every poll_interval seconds.
+
+    @path: path of the file to wait for
+    @timeout: seconds to wait, forever if None
+
+    @return: True if the file exists, False on timeout
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def remaining():
+        if deadline is None:
+            return None
+        return max(0, deadline - time.monotonic())
+
+    try:
+        watcher = Inotify()
+    except InotifyError as exc:
+        logger.debug("Polling for {}: {}".format(path, exc))
+        while not os.path.exists(path):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(poll_interval if deadline is None
+                       else min(poll_interval, remaining()))
+        return True
+
+    with watcher:
+        watcher.add_watch(os.path.dirname(path) or ".",
+                          IN_CREATE | IN_MOVED_TO | IN_ATTRIB)
+        # the file may have been created before the watch was set up
+        while not os.path.exists(path):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            watcher.read(remaining())
+    return True
@@ -0,0 +1,226 @@
+"""
+Streaming of the logs of a running container - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import errno
+import logging
+logger = logging.getLogger(__name__)
+import os
+import sys
+import time
+
+from . import inotify
+
+# Bytes read from a file at once, the next files are read before reading
+# more from it
+CHUNK_SIZE = 64 * 1024
+# Lines longer than this are split
+MAX_LINE = 64 * 1024
+# Seconds between two checks of the files when no event is received
+POLL_INTERVAL = 1.0
+
+_DIR_EVENTS = (inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE | inotify.IN_CREATE |
+               inotify.IN_MOVED_TO | inotify.IN_DELETE | inotify.IN_DELETE_SELF |
+               inotify.IN_MOVE_SELF)
+
+
+def pid_alive(pid):
+    """ Return True if the process pid exists """
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM
+    return True
+
+
+class _LogFile(object):
+    """ A followed file, reopened when it is created, rotated or truncated """
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.f = None
+        self.inode = None
+        self.partial = b""
+
+    def open(self, from_end):
+        """ Open the file if it exists or was replaced
+
+        @from_end: only stream the content written from now on
+        """
+        try:
+            stt = os.stat(self.path)
+        except OSError:
+            return
+        inode = (stt.st_dev, stt.st_ino)
+        if self.f is not None:
+            if inode == self.inode:
+                if stt.st_size < self.f.tell():
+                    # truncated
+                    self.f.seek(0)
+                return
+            self.close()
+        try:
+            self.f = open(self.path, "rb")
+        except OSError:
+            return
+        self.inode = inode
+        if from_end:
+            self.f.seek(0, os.SEEK_END)
+
+    def read(self):
+        """ Read the next chunk of the file
+
+        @return: (complete lines, True if there may be more to read)
+        """
+        if self.f is None:
+            return ([], False)
+        data = self.f.read(CHUNK_SIZE)
+        if not data:
+            return ([], False)
+        data = self.partial + data
+        lines = data.split(b"\n")
+        self.partial = lines.pop()
+        if len(self.partial) > MAX_LINE:
+            lines.append(self.partial)
+            self.partial = b""
+        return (lines, len(data) >= CHUNK_SIZE)
+
+    def flush(self):
+        """ Return what is left of an unterminated line """
+        (partial, self.partial) = (self.partial, b"")
+        return [partial] if partial else []
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class LogStreamer(object):
+    """ Follow several files with a single process, like tail -F
+
+    The files are followed relative to root, usually the delta of a
+    container, and don't have to exist yet. Each line is printed prefixed by
+    the name of its file and, if a combined log is requested, written to it
+    with a timestamp.
+
+    The parent directories of the files are watched with inotify, or polled
+    if it isn't available. Files are read by chunks, one after the other, and
+    the lines are written before reading more, so a slow reader of the
+    output slows down the streamer instead of filling its memory.
+    """
+
+    def __init__(self, root, logfiles, output=None, combined=None):
+        self.root = root
+        self.files = [_LogFile(name, os.path.join(root, name.lstrip("/")))
+                      for name in logfiles]
+        self.output = output or sys.stdout.buffer
+        self.combined = combined
+        self._combined_file = None
+        self._watcher = None
+        self._watched = set()
+
+    def _watch(self):
+        """ Watch the parent directory of each file, or its closest ancestor
+        until it is created """
+        if self._watcher is None:
+            return
+        for logfile in self.files:
+            directory = os.path.dirname(logfile.path)
+            while not os.path.isdir(directory) and directory != self.root:
+                directory = os.path.dirname(directory)
+            if directory in self._watched:
+                continue
+            try:
+                self._watcher.add_watch(directory, _DIR_EVENTS)
+                self._watched.add(directory)
+            except inotify.InotifyError as exc:
+                logger.debug("Can't watch {}: {}".format(directory, exc))
+
+    def _write(self, logfile, lines):
+        prefix = logfile.name.encode() + b": "
+        self.output.write(b"".join(prefix + line + b"\n" for line in lines))
+        self.output.flush()
+        if self._combined_file is not None:
+            stamp = time.strftime("%Y-%m-%dT%H:%M:%S").encode() + b" "
+            self._combined_file.write(
+                b"".join(stamp + prefix + line + b"\n" for line in lines))
+            self._combined_file.flush()
+
+    def _read_all(self, from_end=False):
+        """ Stream everything written to the files so far """
+        more = True
+        while more:
+            more = False
+            for logfile in self.files:
+                logfile.open(from_end)
+                (lines, pending) = logfile.read()
+                if lines:
+                    self._write(logfile, lines)
+                more = more or pending
+
+    def run(self, pid=None, timeout=None):
+        """ Stream the files until pid exits or timeout expires
+
+        @pid: stop after this process exits, never if None
+        @timeout: seconds to stream, forever if None
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.combined:
+            os.makedirs(os.path.dirname(os.path.abspath(self.combined)),
+                        exist_ok=True)
+            self._combined_file = open(self.combined, "ab")
+        try:
+            self._watcher = inotify.Inotify()
+        except inotify.InotifyError as exc:
+            logger.debug("Polling the logs: {}".format(exc))
+        try:
+            self._watch()
+            # like tail -n0, only what is written from now on
+            for logfile in self.files:
+                logfile.open(from_end=True)
+            while True:
+                if pid is not None and not pid_alive(pid):
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                if self._watcher is None:
+                    time.sleep(POLL_INTERVAL)
+                else:
+                    events = self._watcher.read(POLL_INTERVAL)
+                    if any(mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO |
+                                   inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF)
+                           for (_, mask, _) in events):
+                        self._watched.intersection_update(self._watcher.watches.values())
+                        self._watch()
+                self._read_all()
+            self._read_all()
+            for logfile in self.files:
+                lines = logfile.flush()
+                if lines:
+                    self._write(logfile, lines)
+        finally:
+            for logfile in self.files:
+                logfile.close()
+            if self._watcher is not None:
+                self._watcher.close()
+            if self._combined_file is not None:
+                self._combined_file.close()
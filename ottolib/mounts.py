@@ -0,0 +1,233 @@
+"""
+Probing and mounting of images without external commands - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+# The callers fall back to file, mountpoint, losetup and mount when these
+# raise MountError, for example without /dev/loop-control in a container.
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+logger = logging.getLogger(__name__)
+import os
+import re
+import struct
+
+MOUNTINFO = "/proc/self/mountinfo"
+
+# Signatures of the images: primary volume descriptor of ISO 9660 in sector
+# 16, hybrid images start with a boot sector, and the superblock of squashfs
+ISO9660_MAGIC = (16 * 2048 + 1, b"CD001")
+SQUASHFS_MAGIC = (0, b"hsqs")
+
+# ioctls of the loop devices, see loop(4)
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_AUTOCLEAR = 4
+LOOP_CONTROL = "/dev/loop-control"
+# struct loop_info64
+_LOOP_INFO64 = struct.Struct("=5Q4I64s64s32s2Q")
+# Attempts to grab a free loop device, another process can take it first
+LOOP_ATTEMPTS = 5
+
+# mount(2) and umount2(2) flags
+MS_RDONLY = 1
+MNT_DETACH = 2
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                            use_errno=True)
+    return _libc
+
+
+class MountError(OSError):
+    pass
+
+
+def image_type(path):
+    """ Return the type of an image from its signature
+
+    @path: Path to the image, symbolic links are followed
+
+    @return: "iso9660", "squashfs" or "unknown"
+    """
+    with open(path, "rb") as f:
+        for (imgtype, (offset, magic)) in (("squashfs", SQUASHFS_MAGIC),
+                                           ("iso9660", ISO9660_MAGIC)):
+            f.seek(offset)
+            if f.read(len(magic)) == magic:
+                return imgtype
+    return "unknown"
+
+
+def _unescape(field):
+    """ Decode the spaces and special characters of a field of mountinfo """
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), field)
+
+
+def mountinfo(path=MOUNTINFO):
+    """ Return the mounts of the mount namespace of otto
+
+    @return: list of dicts with the mountpoint, root, fstype, source and
+             options of each mount, in the order they were mounted
+    """
+    mounts = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            separator = fields.index("-", 6)
+            mounts.append({"mountpoint": _unescape(fields[4]),
+                           "root": _unescape(fields[3]),
+                           "options": fields[5],
+                           "fstype": fields[separator + 1],
+                           "source": _unescape(fields[separator + 2])})
+    return mounts
+
+
+def mountpoints():
+    """ Return the set of the mount points, to check many paths at once """
+    return {mount["mountpoint"] for mount in mountinfo()}
+
+
+def is_mountpoint(path, mounted=None):
+    """ Return True if a filesystem is mounted on path
+
+    @path: directory, symbolic links are resolved
+    @mounted: result of mountpoints(), read again if None
+    """
+    if mounted is None:
+        mounted = mountpoints()
+    return os.path.realpath(path) in mounted
+
+
+def _attach(path, autoclear):
+    """ Attach a file to a free read-only loop device with the loop ioctls
+
+    @autoclear: detach the device once it is unmounted, like mount -o loop
+
+    @return: (path of the loop device, open descriptor of the device), the
+             device is released when the descriptor is closed with autoclear
+             if nothing else uses it
+    """
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        ctl = os.open(LOOP_CONTROL, os.O_RDWR | os.O_CLOEXEC)
+        try:
+            for attempt in range(LOOP_ATTEMPTS):
+                device = "/dev/loop{}".format(fcntl.ioctl(ctl, LOOP_CTL_GET_FREE))
+                loop = os.open(device, os.O_RDONLY | os.O_CLOEXEC)
+                try:
+                    fcntl.ioctl(loop, LOOP_SET_FD, fd)
+                    break
+                except OSError as exc:
+                    os.close(loop)
+                    if exc.errno != errno.EBUSY:
+                        raise
+            else:
+                raise MountError(errno.EBUSY, "No free loop device for {}".format(path))
+        finally:
+            os.close(ctl)
+        info = _LOOP_INFO64.pack(0, 0, 0, 0, 0, 0, 0, 0,
+                                 LO_FLAGS_AUTOCLEAR if autoclear else 0,
+                                 os.fsencode(os.path.abspath(path))[:63], b"", b"", 0, 0)
+        try:
+            fcntl.ioctl(loop, LOOP_SET_STATUS64, info)
+        except OSError:
+            fcntl.ioctl(loop, LOOP_CLR_FD)
+            os.close(loop)
+            raise
+    except MountError:
+        raise
+    except OSError as exc:
+        raise MountError(exc.errno, "Can't attach {} to a loop device: {}".format(
+            path, exc.strerror))
+    finally:
+        os.close(fd)
+    logger.debug("{} attached to {}".format(path, device))
+    return (device, loop)
+
+
+def attach_loop(path):
+    """ Attach a file to a free read-only loop device
+
+    @return: path of the loop device
+    """
+    (device, loop) = _attach(path, False)
+    os.close(loop)
+    return device
+
+
+def detach_loop(device):
+    """ Detach a loop device, once unused if it is still mounted """
+    try:
+        loop = os.open(device, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            fcntl.ioctl(loop, LOOP_CLR_FD)
+        finally:
+            os.close(loop)
+    except OSError as exc:
+        raise MountError(exc.errno, "Can't detach {}: {}".format(device, exc.strerror))
+
+
+def mount(source, target, fstype, flags=0, options=None):
+    """ Mount a filesystem with mount(2)
+
+    @options: comma-separated options of the filesystem
+    """
+    ret = _get_libc().mount(os.fsencode(source), os.fsencode(target),
+                            fstype.encode(), ctypes.c_ulong(flags),
+                            options.encode() if options else None)
+    if ret != 0:
+        err = ctypes.get_errno()
+        raise MountError(err, "Can't mount {} on {}: {}".format(
+            source, target, os.strerror(err)))
+
+
+def umount(target, lazy=False):
+    """ Unmount a filesystem with umount2(2)
+
+    @lazy: detach it now and clean up once it isn't busy anymore
+    """
+    ret = _get_libc().umount2(os.fsencode(target), MNT_DETACH if lazy else 0)
+    if ret != 0:
+        err = ctypes.get_errno()
+        raise MountError(err, "Can't unmount {}: {}".format(target, os.strerror(err)))
+
+
+def loop_mount(image, target, fstype):
+    """ Mount an image read-only like mount -o loop,ro
+
+    The loop device is released when the image is unmounted.
+    """
+    (device, loop) = _attach(image, True)
+    try:
+        mount(device, target, fstype, MS_RDONLY)
+    finally:
+        # the mount holds the device from now on
+        os.close(loop)
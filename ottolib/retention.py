@@ -0,0 +1,427 @@
+"""
+Disk budgets of the runs, bases and layers of the containers - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import collections
+import io
+import logging
+logger = logging.getLogger(__name__)
+import os
+import shutil
+import time
+
+from . import archive, chunkstore, const, errors
+from .utils import ignored
+
+
+class RetentionError(errors.OttoError):
+    pass
+
+
+def disk_usage(path, seen):
+    """ Return the bytes used on disk by a file or a directory tree
+
+    @path: file or directory
+    @seen: (device, inode) of the files already counted, files hardlinked
+           between the trees are only counted the first time
+    """
+    total = 0
+    paths = [path]
+    while paths:
+        current = paths.pop()
+        try:
+            stt = os.lstat(current)
+        except FileNotFoundError:
+            continue
+        if (stt.st_dev, stt.st_ino) not in seen:
+            seen.add((stt.st_dev, stt.st_ino))
+            total += stt.st_blocks * 512
+        if os.path.isdir(current) and not os.path.islink(current):
+            with ignored(OSError):
+                paths.extend(os.path.join(current, name) for name in os.listdir(current))
+    return total
+
+
+class Item(object):
+    """ Something of a container which can be removed to free space
+
+    kind is one of:
+      archive: an archive of a run, with its index
+      delta: the delta of the latest run, once it is archived
+      base: a base delta created by an upgrade
+      layer: a package layer
+      build: an unfinished build of a package layer
+    """
+
+    # removed first: copies of an archive and leftovers of failed builds
+    DISPOSABLE = ("delta", "build")
+
+    def __init__(self, container, kind, path, size, last_used, protected=None):
+        self.container = container
+        self.kind = kind
+        self.path = path
+        self.size = size
+        self.last_used = last_used
+        # why the item is kept whatever the budgets, None if it can go
+        self.protected = protected
+        # why the item is removed, set by the plan
+        self.reason = None
+        # objects of the chunk store used by a manifest
+        self.digests = set()
+        # archives whose run is on top of a base delta or a layer
+        self.users = []
+
+    @property
+    def in_use(self):
+        """ True if an archive which is kept was made on top of the item """
+        return any(user.reason is None for user in self.users)
+
+    @property
+    def sort_key(self):
+        return (self.kind not in self.DISPOSABLE, self.last_used)
+
+    def remove(self):
+        if self.kind == "archive":
+            os.remove(self.path)
+            with ignored(FileNotFoundError):
+                os.remove(self.path + archive.INDEX_SUFFIX)
+        else:
+            shutil.rmtree(self.path)
+
+
+class Retention(object):
+    """ Keep the disk used by containers within budgets
+
+    The archives, base deltas and package layers of a container, and the
+    delta of its latest run once it is archived, are removed least recently
+    used first:
+      - whatever the budgets if they weren't used for max_age seconds,
+      - until the container uses less than container_budget,
+      - until all the containers use less than host_budget and the
+        filesystem of the containers has min_free bytes available.
+    The base delta and the package layer of the configuration of the
+    container are never removed, nor those of the archives which are kept,
+    nor the delta and the unfinished layers of
+    a container which is running or being upgraded. The chunk store is pruned of the objects the
+    remaining manifests don't use.
+
+    Base deltas and layers are marked used each time a container mounts
+    them. Blocks shared by clones of a container are only counted for the
+    first container scanned. An object of a chunk store counts until the
+    last manifest using it is removed. The containers stopped before their
+    post-stop hook finished, which may still be archiving the run, are left
+    alone.
+    """
+
+    def __init__(self, containers, container_budget=const.GC_CONTAINER_BUDGET,
+                 host_budget=const.GC_HOST_BUDGET, min_free=const.GC_MIN_FREE,
+                 max_age=const.GC_MAX_AGE, post_stop=()):
+        """
+        @containers: list of Container
+        @container_budget, host_budget, min_free: bytes, no limit if None
+        @max_age: seconds, no limit if None
+        @post_stop: names of the containers whose post-stop hook runs the
+                    clean up, they are scanned even though it isn't finished
+        """
+        self.containers = containers
+        self.container_budget = container_budget
+        self.host_budget = host_budget
+        self.min_free = min_free
+        self.max_age = max_age
+        self.post_stop = set(post_stop)
+        # containers cleaned up, the others are in their post-stop hook
+        self.scanned = []
+        self.items = []
+        # bytes of the objects of the chunk store of each container used by
+        # the manifests which are kept
+        self.stores = {}
+        # for each container, number of manifests using each object and
+        # bytes of each object
+        self.refs = {}
+        self.objects = {}
+        # bytes of the objects no manifest uses, removed by the prune
+        self.unused = 0
+
+    def _archivedir(self, container):
+        return os.path.join(container.containerpath,
+                            container.config.archivedir or const.ARCHIVEDIR)
+
+    def _archives(self, container):
+        """ Return the paths of the archives of a container """
+        archivedir = self._archivedir(container)
+        with ignored(FileNotFoundError):
+            return [os.path.join(archivedir, name)
+                    for name in sorted(os.listdir(archivedir)) if name.endswith(".otto")]
+        return []
+
+    def _archive_layers(self, container, path):
+        """ Return the base delta and the layer the run of an archive used
+
+        @return: set of their paths, relative to the container
+        """
+        content = io.BytesIO()
+        try:
+            container.read_archive_member(path, "config", content)
+        except (errors.OttoError, OSError) as exc:
+            logger.warning("Can't read the configuration of {}, its base delta and "
+                           "layer aren't known: {}".format(path, exc))
+            return set()
+        layers = set()
+        # KEY=value lines, like ConfigGenerator writes them
+        for line in content.getvalue().decode(errors="replace").splitlines():
+            fields = line.split("=")
+            if (len(fields) == 2 and fields[0].strip().lower() in
+                    ("basedeltadir", "layerdir") and fields[1].strip()):
+                layers.add(os.path.normpath(fields[1].strip()))
+        return layers
+
+    def _in_post_stop(self, container):
+        """ Return True if the container stopped but its post-stop hook
+        hasn't finished archiving the run """
+        if container.name in self.post_stop or container.config.runid is None:
+            return False
+        return not container.running and not os.path.exists(
+            os.path.join(container.containerpath, const.POSTSTOP_FLAG))
+
+    def _scan_container(self, container, seen):
+        """ Return the items of a container """
+        config = container.config
+        busy = None
+        if container.running:
+            busy = "container running"
+        if config.command:
+            # an upgrade or a layer build writes to bases or layers
+            busy = "{} in progress".format(config.command)
+        items = []
+
+        def add(kind, path, protected=None):
+            try:
+                last_used = os.stat(path).st_mtime
+            except FileNotFoundError:
+                return
+            size = disk_usage(path, seen)
+            if kind == "archive":
+                size += disk_usage(path + archive.INDEX_SUFFIX, seen)
+            items.append(Item(container, kind, path, size, last_used, protected))
+
+        archivedir = self._archivedir(container)
+        for path in self._archives(container):
+            add("archive", path)
+
+        # the delta is only a copy once the run is archived
+        delta = os.path.join(container.rundir, "delta")
+        protected = busy
+        if not protected and not os.path.isfile(os.path.join(
+                archivedir, "{}.{}.otto".format(config.isoid, config.runid))):
+            protected = "run not archived"
+        add("delta", delta, protected)
+
+        current = {os.path.normpath(d) for d in (config.basedeltadir, config.layerdir) if d}
+        for directory in (const.BASESDIR, const.LAYERSDIR):
+            with ignored(FileNotFoundError):
+                for name in sorted(os.listdir(os.path.join(container.containerpath,
+                                                           directory))):
+                    relpath = os.path.join(directory, name)
+                    kind = "base" if directory == const.BASESDIR else "layer"
+                    if name.endswith(".build"):
+                        kind = "build"
+                    protected = busy if kind == "build" else None
+                    if relpath in current:
+                        protected = "used by the configuration"
+                    add(kind, os.path.join(container.containerpath, relpath), protected)
+
+        # a restored archive needs the base delta and layer of its run
+        layers = {os.path.relpath(item.path, container.containerpath): item
+                  for item in items if item.kind in ("base", "layer")}
+        for item in items:
+            if item.kind == "archive":
+                for relpath in self._archive_layers(container, item.path):
+                    if relpath in layers:
+                        layers[relpath].users.append(item)
+
+        refs = collections.Counter()
+        objects = {}
+        store = chunkstore.ChunkStore(container.storepath)
+        for item in items:
+            if item.kind != "archive":
+                continue
+            try:
+                if archive.detect_format(item.path) != "manifest":
+                    continue
+                item.digests = {entry["digest"]
+                                for entry in chunkstore.read_manifest(item.path)
+                                if "digest" in entry}
+            except (archive.ArchiveError, chunkstore.ChunkStoreError, OSError) as exc:
+                raise RetentionError("Can't read the manifest {}: {}".format(item.path, exc))
+            refs.update(item.digests)
+        for digest in refs:
+            objects[digest] = disk_usage(store.object_path(digest), seen)
+        self.refs[container.name] = refs
+        self.objects[container.name] = objects
+        self.stores[container.name] = sum(objects.values())
+        with ignored(FileNotFoundError):
+            for prefix in os.listdir(store.objectsdir):
+                for name in os.listdir(os.path.join(store.objectsdir, prefix)):
+                    if prefix + name not in refs and not name.endswith(".tmp"):
+                        self.unused += disk_usage(os.path.join(store.objectsdir, prefix,
+                                                               name), seen)
+        return items
+
+    def scan(self):
+        """ Find the items of all the containers and the space they use """
+        seen = set()
+        self.scanned = []
+        self.items = []
+        self.stores = {}
+        self.refs = {}
+        self.objects = {}
+        self.unused = 0
+        for container in self.containers:
+            if self._in_post_stop(container):
+                logger.info("Skipping container {}: its post-stop hook hasn't "
+                            "finished".format(container.name))
+                continue
+            self.scanned.append(container)
+            self.items.extend(self._scan_container(container, seen))
+
+    def _release(self, item):
+        """ Drop the objects of a manifest which no kept manifest uses
+
+        @return: bytes of the objects which are freed
+        """
+        name = item.container.name
+        freed = 0
+        for digest in item.digests:
+            self.refs[name][digest] -= 1
+            if self.refs[name][digest] == 0:
+                freed += self.objects[name][digest]
+        self.stores[name] -= freed
+        return freed
+
+    def _usage(self, items, names):
+        return (sum(item.size for item in items if item.reason is None) +
+                sum(self.stores[name] for name in names))
+
+    def plan(self, now=None):
+        """ Choose the items to remove, their reason is set
+
+        Called once after scan().
+
+        @return: the items to remove, in the order they will be removed
+        """
+        now = now or time.time()
+        # a base delta or a layer comes after the archives made on top of it,
+        # it can only go once they are removed
+        candidates = sorted((item for item in self.items if item.protected is None),
+                            key=lambda item: max([item.sort_key] +
+                                                 [user.sort_key for user in item.users]))
+        selected = []
+        # the objects no manifest uses are pruned whatever is removed
+        freed = self.unused
+
+        def select(item, reason):
+            """ @return: bytes freed by removing the item """
+            item.reason = reason
+            selected.append(item)
+            return item.size + self._release(item)
+
+        if self.max_age is not None:
+            for item in candidates:
+                if now - item.last_used > self.max_age and not item.in_use:
+                    freed += select(item, "unused for {} days".format(
+                        int((now - item.last_used) // 86400)))
+
+        if self.container_budget is not None:
+            for container in self.scanned:
+                items = [item for item in self.items if item.container is container]
+                for item in candidates:
+                    if self._usage(items, [container.name]) <= self.container_budget:
+                        break
+                    if (item.container is container and item.reason is None and
+                            not item.in_use):
+                        freed += select(item, "over the budget of the container")
+                usage = self._usage(items, [container.name])
+                if usage > self.container_budget:
+                    logger.warning("Container {} still uses {} bytes, over its budget of "
+                                   "{}".format(container.name, usage, self.container_budget))
+
+        free = None
+        if self.min_free is not None:
+            stv = os.statvfs(const.LXCBASE)
+            free = stv.f_bavail * stv.f_frsize + freed
+        for item in candidates:
+            if item.reason is not None or item.in_use:
+                continue
+            if (self.host_budget is not None and
+                    self._usage(self.items, self.stores) > self.host_budget):
+                reason = "over the budget of the host"
+            elif free is not None and free < self.min_free:
+                reason = "less than {} bytes free".format(self.min_free)
+            else:
+                break
+            released = select(item, reason)
+            if free is not None:
+                free += released
+        return selected
+
+    def run(self, dry_run=False):
+        """ Remove the items over the budgets and prune the chunk stores
+
+        @dry_run: only report what would be removed
+
+        @return: (items removed, objects pruned, bytes of the objects)
+        """
+        self.scan()
+        selected = self.plan()
+        removed = []
+        for item in selected:
+            logger.info("{} {} {} ({} bytes): {}".format(
+                "Would remove" if dry_run else "Removing", item.kind, item.path,
+                item.size, item.reason))
+            if dry_run:
+                removed.append(item)
+                continue
+            try:
+                item.remove()
+            except OSError as exc:
+                logger.warning("Can't remove {}: {}".format(item.path, exc))
+                continue
+            removed.append(item)
+
+        objects = pruned = 0
+        gone = {item.path for item in removed}
+        for container in self.scanned:
+            if not os.path.isdir(container.storepath):
+                continue
+
+            def manifests(container=container):
+                # listed again, archives may have been written since the scan
+                return [path for path in self._archives(container)
+                        if path not in gone and archive.detect_format(path) == "manifest"]
+
+            try:
+                (count, size) = chunkstore.ChunkStore(container.storepath).prune(
+                    manifests, dry_run=dry_run)
+            except (archive.ArchiveError, chunkstore.ChunkStoreError, OSError) as exc:
+                raise RetentionError("Can't prune the store of {}: {}".format(
+                    container.name, exc))
+            objects += count
+            pruned += size
+        return (removed, objects, pruned)
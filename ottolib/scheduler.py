@@ -0,0 +1,198 @@
+"""
+Scheduler to run several testsuites in parallel - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import subprocess
+import threading
+import time
+
+from . import const, errors, utils
+
+
+class SchedulerError(errors.OttoError):
+    pass
+
+
+def default_slots():
+    """ Number of jobs that can run at once on this host
+
+    A slot needs a core and enough memory for the memory limit set in the
+    container configuration.
+
+    @return: number of slots, at least 1
+    """
+    cpus = os.cpu_count() or 1
+    memory = utils.host_memory()
+    if memory is None:
+        return cpus
+    return max(1, min(cpus, memory // const.POOL_MEMORY_PER_SLOT))
+
+
+class Job(object):
+    """ A testsuite to run in a container """
+
+    def __init__(self, container, testpath):
+        self.container = container
+        self.testpath = os.path.abspath(testpath)
+        self.index = None
+        self.resultsdir = None
+        self.logfile = None
+        self.returncode = None
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def name(self):
+        return "{:03d}-{}-{}".format(self.index, self.container,
+                                     os.path.basename(self.testpath.rstrip("/")))
+
+    @property
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def as_dict(self):
+        """Return a dictionnary describing the job and its result"""
+        return {"container": self.container,
+                "testpath": self.testpath,
+                "resultsdir": self.resultsdir,
+                "logfile": self.logfile,
+                "returncode": self.returncode,
+                "start": self.start_time,
+                "end": self.end_time,
+                "duration": self.duration}
+
+
+class Scheduler(object):
+    """ Run a queue of jobs with a fixed number of slots
+
+    Each job is a full otto-run cycle (start, wait, archive and collect)
+    running in its own process. A container only runs one job at a time, so
+    jobs sharing a container are serialized while the others run in parallel.
+    """
+
+    def __init__(self, resultsdir, slots=None, debug=False):
+        self.resultsdir = os.path.abspath(resultsdir)
+        self.slots = slots if slots else default_slots()
+        self.debug = debug
+        self.jobs = []
+        self._pending = []
+        self._busy = set()
+        self._lock = threading.Condition()
+
+    def add(self, job):
+        """ Queue a new job """
+        job.index = len(self.jobs)
+        self.jobs.append(job)
+        self._pending.append(job)
+
+    def run(self):
+        """ Run all the queued jobs and block until they are done
+
+        @return: list of jobs
+        """
+        if not self.jobs:
+            raise SchedulerError("No job to run")
+        os.makedirs(self.resultsdir, exist_ok=True)
+        nworkers = min(self.slots, len(self.jobs))
+        logger.info("Running {} jobs with {} slots".format(len(self.jobs),
+                                                          nworkers))
+        workers = [threading.Thread(target=self._worker,
+                                    name="slot-{}".format(i))
+                   for i in range(nworkers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.write_report()
+        return self.jobs
+
+    def _next_job(self):
+        """ Pop the first pending job whose container is idle
+
+        @return: a job or None if the queue is empty
+        """
+        with self._lock:
+            while self._pending:
+                for job in self._pending:
+                    if job.container not in self._busy:
+                        self._pending.remove(job)
+                        self._busy.add(job.container)
+                        return job
+                self._lock.wait()
+        return None
+
+    def _release(self, job):
+        with self._lock:
+            self._busy.discard(job.container)
+            self._lock.notify_all()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                self._run_job(job)
+            finally:
+                self._release(job)
+
+    def _run_job(self, job):
+        """ Run a job with otto-run and record its result """
+        job.resultsdir = os.path.join(self.resultsdir, job.name)
+        job.logfile = job.resultsdir + ".log"
+        cmd = [os.path.join(utils.get_base_dir(), "bin", "otto-run")]
+        if self.debug:
+            cmd.append("-d")
+        cmd.extend([job.container, job.testpath])
+        env = dict(os.environ, RESULTSDIR=job.resultsdir + "/")
+
+        logger.info("Starting job {}".format(job.name))
+        job.start_time = time.time()
+        with open(job.logfile, "w") as flog:
+            try:
+                job.returncode = subprocess.call(cmd, env=env, stdout=flog,
+                                                 stderr=subprocess.STDOUT)
+            except OSError as exc:
+                logger.error("Can't run job {}: {}".format(job.name, exc))
+                job.returncode = -1
+        job.end_time = time.time()
+        logger.info("Job {} finished with code {} in {:.0f}s".format(
+            job.name, job.returncode, job.duration))
+
+    def write_report(self):
+        """ Log a summary of the jobs and save it as pool.json """
+        for job in self.jobs:
+            logger.info("{}: {}".format(
+                job.name, "PASS" if job.returncode == 0 else
+                "ERROR ({})".format(job.returncode)))
+        with open(os.path.join(self.resultsdir, "pool.json"), "w") as f:
+            json.dump({"slots": self.slots,
+                       "jobs": [job.as_dict() for job in self.jobs]},
+                      f, indent=2)
+
+    @property
+    def failed(self):
+        return [job for job in self.jobs if job.returncode != 0]
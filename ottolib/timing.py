@@ -0,0 +1,111 @@
+"""
+Timing spans of the phases of a run - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+from contextlib import contextmanager
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import time
+
+from . import utils
+from .utils import ignored
+
+
+def record(path, name, start, end, source="otto", status=0):
+    """ Append a span to a timings file
+
+    The format is the one of timing.sh, one JSON object per line. Timings
+    never make a run fail, errors are only logged.
+
+    @path: timings file, nothing is recorded if None
+    @name: name of the phase
+    @start, @end: times since the epoch
+    @status: exit status of the phase
+    """
+    if path is None:
+        return
+    line = json.dumps({"name": name, "source": source, "start": start,
+                       "end": end, "duration": round(end - start, 3),
+                       "status": status}) + "\n"
+    try:
+        # a single write in append mode, so concurrent writers don't mix
+        # their lines
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+    except OSError as exc:
+        logger.debug("Can't record timing of {}: {}".format(name, exc))
+
+
+@contextmanager
+def span(name, path, source="otto"):
+    """ Record the duration of the block as a span """
+    start = time.time()
+    status = 0
+    try:
+        yield
+    except BaseException:
+        status = 1
+        raise
+    finally:
+        record(path, name, start, time.time(), source, status)
+
+
+def reset(path):
+    """ Remove the spans of the previous run """
+    with ignored(FileNotFoundError):
+        os.remove(path)
+
+
+def read(path):
+    """ Return the spans of a timings file, skipping broken lines """
+    spans = []
+    with ignored(FileNotFoundError):
+        with open(path) as f:
+            for line in f:
+                with ignored(ValueError):
+                    spans.append(json.loads(line))
+    return spans
+
+
+def merge(paths, dest):
+    """ Merge timings files into a single JSON document
+
+    @paths: timings files of the host and the guest
+    @dest: path of timings.json
+
+    @return: the merged document
+    """
+    spans = sorted((s for path in paths for s in read(path)),
+                   key=lambda s: s["start"])
+    totals = {}
+    for s in spans:
+        totals[s["name"]] = round(totals.get(s["name"], 0) + s["duration"], 3)
+    timings = {"spans": spans, "totals": totals}
+    if spans:
+        timings["start"] = spans[0]["start"]
+        timings["end"] = max(s["end"] for s in spans)
+        timings["duration"] = round(timings["end"] - timings["start"], 3)
+    utils.write_file_atomic(dest, json.dumps(timings, indent=2))
+    return timings
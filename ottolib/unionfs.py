@@ -0,0 +1,268 @@
+"""
+Union filesystems for the rootfs of the containers - part of the project otto
+"""
+
+# Copyright (C) 2013 Canonical
+#
+# Authors: Jean-Baptiste Lallement <jean-baptiste.lallement@canonical.com>
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; version 3.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import json
+import logging
+logger = logging.getLogger(__name__)
+import os
+import shutil
+import subprocess
+
+from . import errors, mounts, utils
+from .utils import ignored
+
+
+class UnionFSError(errors.OttoError):
+    pass
+
+
+def _filesystems():
+    """ Return the filesystems supported by the running kernel """
+    with open("/proc/filesystems") as f:
+        return [line.split()[-1] for line in f if line.strip()]
+
+
+def _run(cmd):
+    """ Run a mount command and raise UnionFSError on failure
+
+    @return: output of the command
+    """
+    logger.debug("Running {}".format(" ".join(cmd)))
+    try:
+        return subprocess.check_output(cmd, stderr=subprocess.STDOUT,
+                                       universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError) as exc:
+        output = getattr(exc, "output", None) or exc
+        raise UnionFSError("{} failed: {}".format(" ".join(cmd), output))
+
+
+class UnionFS(object):
+    """ Stack a writable branch over read-only branches
+
+    Each backend sets name and module and implements
+    mount(upper, lowers, target, workdir), which mounts the union of the
+    branches on target:
+      upper: writable branch
+      lowers: read-only branches, from top to bottom
+      workdir: empty directory on the filesystem of upper, used by the
+               backends needing one
+    """
+
+    name = None
+    # kernel module providing the filesystem
+    module = None
+
+    @classmethod
+    def available(cls):
+        """ Return True if the running kernel supports this filesystem """
+        if cls.module not in _filesystems():
+            subprocess.call(["modprobe", "-q", cls.module])
+        return cls.module in _filesystems()
+
+    def umount(self, target):
+        umount(target)
+
+
+class OverlayFS(UnionFS):
+    """ overlayfs, part of the mainline kernel since 3.18 """
+
+    name = "overlay"
+    module = "overlay"
+
+    def mount(self, upper, lowers, target, workdir):
+        # the kernel refuses a workdir left over by a previous mount
+        with ignored(FileNotFoundError):
+            shutil.rmtree(workdir)
+        os.makedirs(workdir)
+        options = "lowerdir={},upperdir={},workdir={}".format(
+            ":".join(lowers), upper, workdir)
+        _run(["mount", "-n", "-t", "overlay", "-o", options, "overlay", target])
+
+
+class AUFS(UnionFS):
+    """ aufs, only available on kernels with the out-of-tree patches """
+
+    name = "aufs"
+    module = "aufs"
+
+    def mount(self, upper, lowers, target, workdir):
+        branches = ["{}=rw".format(upper)] + ["{}=ro".format(l) for l in lowers]
+        _run(["mount", "-n", "-t", "aufs", "-o", "br=" + ":".join(branches),
+              "aufs", target])
+
+    def umount(self, target):
+        if shutil.which("umount.aufs"):
+            _run(["umount.aufs", target])
+        else:
+            super(AUFS, self).umount(target)
+
+
+BACKENDS = {backend.name: backend for backend in (OverlayFS, AUFS)}
+# Backends tried in this order for new containers
+PREFERRED_BACKENDS = ("overlay", "aufs")
+
+
+def get_backend(name):
+    """ Return the backend called name """
+    try:
+        return BACKENDS[name]()
+    except KeyError:
+        raise UnionFSError("Unknown union filesystem '{}'".format(name))
+
+
+def default_backend():
+    """ Return the best union filesystem supported by the host """
+    for name in PREFERRED_BACKENDS:
+        if BACKENDS[name].available():
+            return BACKENDS[name]()
+    raise UnionFSError("No union filesystem available, overlay or aufs is "
+                       "required")
+
+
+def attach_loop(path):
+    """ Attach a file to a free read-only loop device
+
+    The loop ioctls are used, losetup only if they fail.
+
+    @return: path of the loop device
+    """
+    try:
+        return mounts.attach_loop(path)
+    except OSError as exc:
+        logger.debug("{}, falling back to losetup".format(exc))
+    return _run(["losetup", "--find", "--show", "--read-only", path]).strip()
+
+
+def detach_loop(device):
+    """ Detach a loop device, once unused if it is still mounted """
+    try:
+        mounts.detach_loop(device)
+        return
+    except OSError as exc:
+        logger.debug("{}, falling back to losetup".format(exc))
+    with ignored(UnionFSError):
+        _run(["losetup", "--detach", device])
+
+
+def mount_ro(source, target, fstype):
+    """ Mount a filesystem read-only, with mount only if mount(2) fails """
+    try:
+        mounts.mount(source, target, fstype, mounts.MS_RDONLY)
+        return
+    except OSError as exc:
+        logger.debug("{}, falling back to mount".format(exc))
+    _run(["mount", "-n", "-t", fstype, "-o", "ro", source, target])
+
+
+def umount(target, lazy=False):
+    """ Unmount a filesystem, with umount only if umount2(2) fails """
+    try:
+        mounts.umount(target, lazy)
+        return
+    except OSError as exc:
+        logger.debug("{}, falling back to umount".format(exc))
+    _run(["umount"] + (["-l"] if lazy else []) + [target])
+
+
+def is_mounted(path, mounted=None):
+    """ Return True if a filesystem is mounted on path
+
+    @mounted: result of mounts.mountpoints(), read again if None
+    """
+    return mounts.is_mountpoint(path, mounted)
+
+
+class RootFS(object):
+    """ Mounts of the rootfs of a container
+
+    The squashfs of the image is attached to a loop device and mounted, then
+    the union of the branches of the run is mounted on the rootfs. Mounts
+    and loop devices are recorded in a state file so they are all released
+    when the container stops, even if the mount failed midway.
+    """
+
+    def __init__(self, statefile):
+        self.statefile = statefile
+
+    def _load(self):
+        try:
+            with open(self.statefile) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"mounts": [], "loops": []}
+
+    def _save(self, state):
+        utils.write_file_atomic(self.statefile, json.dumps(state, indent=2))
+
+    def mount(self, backend, squashfs, squashfs_dir, upper, lowers, target,
+              workdir):
+        """ Mount squashfs on squashfs_dir and the union on target
+
+        @backend: UnionFS to use
+        @lowers: read-only branches over the squashfs, from top to bottom
+        """
+        state = self._load()
+        if state["mounts"]:
+            logger.warning("Releasing the mounts of a previous run")
+            self.umount()
+            state = self._load()
+
+        os.makedirs(squashfs_dir, exist_ok=True)
+        device = attach_loop(squashfs)
+        state["loops"].append(device)
+        self._save(state)
+        mount_ro(device, squashfs_dir, "squashfs")
+        state["mounts"].append({"path": squashfs_dir, "backend": None})
+        self._save(state)
+
+        backend.mount(upper, lowers + [squashfs_dir], target, workdir)
+        state["mounts"].append({"path": target, "backend": backend.name})
+        self._save(state)
+        logger.info("Mounted {} on {} with {}".format(
+            ":".join([upper] + lowers + [squashfs_dir]), target, backend.name))
+
+    def umount(self):
+        """ Unmount everything mounted by mount() and detach the loops
+
+        @return: list of the paths which couldn't be unmounted
+        """
+        state = self._load()
+        failed = []
+        mounted = mounts.mountpoints()
+        for entry in reversed(state["mounts"]):
+            if not is_mounted(entry["path"], mounted):
+                continue
+            try:
+                if entry["backend"]:
+                    get_backend(entry["backend"]).umount(entry["path"])
+                else:
+                    umount(entry["path"])
+            except UnionFSError as exc:
+                logger.warning(exc)
+                # the loop devices are released once the mounts are gone
+                with ignored(UnionFSError):
+                    umount(entry["path"], lazy=True)
+                failed.append(entry["path"])
+        for device in state["loops"]:
+            detach_loop(device)
+        with ignored(FileNotFoundError):
+            os.remove(self.statefile)
+        return failed
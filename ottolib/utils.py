@@ -20,6 +20,9 @@ Utilities - part of the project otto
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 from contextlib import contextmanager
+import fcntl
+import hashlib
+import json
 import logging
 logger = logging.getLogger(__name__)
 import os
@@ -27,6 +30,12 @@ import shutil
 import stat
 import subprocess
 import sys
+import threading
+
+from . import mounts
+
+# ioctl to clone a file, see ioctl_ficlone(2)
+FICLONE = 0x40049409
 
 
 def set_logging(debugmode=False):
@@ -44,7 +53,292 @@ def set_logging(debugmode=False):
 def set_executable(path):
     """ Set executable bit on a file """
     stt = os.stat(path)
-    os.chmod(path, stt.st_mode | stat.S_IEXEC)
+    if not stt.st_mode & stat.S_IEXEC:
+        os.chmod(path, stt.st_mode | stat.S_IEXEC)
+
+
+def write_if_changed(path, content):
+    """ Write content to a file only if it is different
+
+    @path: Path to the file
+    @content: String to write
+
+    @return: True if the file was written
+    """
+    try:
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    write_file_atomic(path, content)
+    return True
+
+
+def file_digest(path):
+    """ Returns the sha256 of the content of a file """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def sync_tree(src, dst):
+    """ Make dst a copy of src, only writing the files which changed
+
+    A manifest next to dst records the digest of each source file and the
+    size and mtime of its copy. Sources are only hashed again when their
+    size or mtime changed and a file is copied when its digest changed or
+    its copy was modified. Files copied by a previous sync and removed from
+    src are deleted; other files in dst are left alone.
+
+    @src: source directory
+    @dst: destination directory
+
+    @return: number of files copied
+    """
+    manifest_path = dst.rstrip("/") + ".manifest"
+    try:
+        with open(manifest_path) as f:
+            old = json.load(f)
+    except (OSError, ValueError):
+        old = {}
+
+    new = {}
+    copied = 0
+    for (dirpath, dirnames, filenames) in os.walk(src):
+        reldir = os.path.relpath(dirpath, src)
+        os.makedirs(os.path.normpath(os.path.join(dst, reldir)), exist_ok=True)
+        for name in filenames:
+            relpath = os.path.normpath(os.path.join(reldir, name))
+            srcpath = os.path.join(src, relpath)
+            dstpath = os.path.join(dst, relpath)
+            srcstt = os.stat(srcpath)
+            entry = old.get(relpath, {})
+            if (entry.get("size") == srcstt.st_size and
+                    entry.get("mtime") == srcstt.st_mtime_ns):
+                digest = entry["digest"]
+            else:
+                digest = file_digest(srcpath)
+            try:
+                dststt = os.stat(dstpath)
+                uptodate = (entry.get("digest") == digest and
+                            entry.get("dst") == [dststt.st_size,
+                                                 dststt.st_mtime_ns] and
+                            stat.S_IMODE(dststt.st_mode) ==
+                            stat.S_IMODE(srcstt.st_mode))
+            except OSError:
+                uptodate = False
+            if not uptodate:
+                tmppath = "{}.{}.tmp".format(dstpath, os.getpid())
+                shutil.copy2(srcpath, tmppath)
+                os.replace(tmppath, dstpath)
+                dststt = os.stat(dstpath)
+                copied += 1
+            new[relpath] = {"size": srcstt.st_size,
+                            "mtime": srcstt.st_mtime_ns,
+                            "digest": digest,
+                            "dst": [dststt.st_size, dststt.st_mtime_ns]}
+
+    for relpath in set(old) - set(new):
+        with ignored(OSError):
+            os.remove(os.path.join(dst, relpath))
+    if new != old:
+        write_file_atomic(manifest_path, json.dumps(new, indent=1, sort_keys=True))
+    logger.debug("{} files updated from {} to {}".format(copied, src, dst))
+    return copied
+
+
+def write_file_atomic(path, content, fsync=False):
+    """ Write content to a file with write-to-temp and rename
+
+    Readers either see the previous content or the new one, never a partial
+    file.
+
+    @path: Path to the file
+    @content: String to write
+    @fsync: Flush the file to disk before renaming it
+    """
+    tmppath = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    with open(tmppath, 'w') as f:
+        f.write(content)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmppath, path)
+
+
+def reflink(src, dst):
+    """ Create dst as a copy-on-write clone of src
+
+    Only works on filesystems supporting it (btrfs, xfs...).
+
+    @return: True on success
+    """
+    try:
+        with open(src, "rb") as fin, open(dst, "wb") as fout:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+    except OSError:
+        with ignored(OSError):
+            os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def link_or_copy(src, dst, hardlink=True):
+    """ Make dst a copy of src as cheaply as possible
+
+    A reflink is tried first, then a hardlink when allowed, then a copy.
+
+    @return: "reflink", "hardlink" or "copy"
+    """
+    if reflink(src, dst):
+        return "reflink"
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def clone_tree(src, dst):
+    """ Copy a read-only tree as cheaply as possible
+
+    Files are reflinked or hardlinked, so the copy must never be modified in
+    place. Directories are created with the attributes and the extended
+    attributes (like the opaque flag of overlayfs) of the source.
+
+    @return: count of each method used, see link_or_copy()
+    """
+    methods = {}
+    directories = []
+    for (dirpath, dirnames, filenames) in os.walk(src):
+        reldir = os.path.relpath(dirpath, src)
+        dstdir = os.path.normpath(os.path.join(dst, reldir))
+        os.makedirs(dstdir, exist_ok=True)
+        directories.append((dirpath, dstdir))
+        links = [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+        dirnames[:] = [d for d in dirnames if d not in links]
+        for name in filenames + links:
+            srcpath = os.path.join(dirpath, name)
+            dstpath = os.path.join(dstdir, name)
+            srcstt = os.lstat(srcpath)
+            if stat.S_ISREG(srcstt.st_mode):
+                method = link_or_copy(srcpath, dstpath)
+            elif stat.S_ISLNK(srcstt.st_mode):
+                os.symlink(os.readlink(srcpath), dstpath)
+                method = "symlink"
+            else:
+                # whiteouts of overlayfs are character devices
+                os.mknod(dstpath, srcstt.st_mode, srcstt.st_rdev)
+                method = "mknod"
+            if method != "hardlink":
+                with ignored(OSError):
+                    os.chown(dstpath, srcstt.st_uid, srcstt.st_gid,
+                             follow_symlinks=False)
+                if method != "symlink":
+                    shutil.copystat(srcpath, dstpath, follow_symlinks=False)
+            methods[method] = methods.get(method, 0) + 1
+
+    # after their content, so the times are kept
+    for (srcdir, dstdir) in reversed(directories):
+        srcstt = os.lstat(srcdir)
+        with ignored(OSError):
+            os.chown(dstdir, srcstt.st_uid, srcstt.st_gid)
+        shutil.copystat(srcdir, dstdir)
+    return methods
+
+
+def stage_tree(src, dst, manifest_path, exclude=()):
+    """ Make dst a copy of src, reusing the files staged previously
+
+    Files are reflinked from src when possible and copied otherwise, never
+    hardlinked: the staged files belong to otto, not to the owner of src,
+    and the run never shares inodes with src. The manifest
+    records the digest of each staged file and the stat of its copy, so
+    files which didn't change since the previous staging are not touched,
+    and files of the previous staging missing from src are removed.
+
+    @src: source directory
+    @dst: destination directory
+    @manifest_path: where the manifest is stored
+    @exclude: top-level names of src which are not staged
+
+    @return: digest of the whole staged tree
+    """
+    try:
+        with open(manifest_path) as f:
+            old = json.load(f)
+    except (OSError, ValueError):
+        old = {}
+
+    new = {}
+    methods = {}
+    for (dirpath, dirnames, filenames) in os.walk(src):
+        reldir = os.path.normpath(os.path.relpath(dirpath, src))
+        if reldir == ".":
+            dirnames[:] = [d for d in dirnames if d not in exclude]
+            filenames = [f for f in filenames if f not in exclude]
+        os.makedirs(os.path.join(dst, reldir), exist_ok=True)
+        # symlinks to directories are staged as symlinks
+        links = [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]
+        dirnames[:] = [d for d in dirnames if d not in links]
+        for name in filenames + links:
+            relpath = os.path.normpath(os.path.join(reldir, name))
+            srcpath = os.path.join(src, relpath)
+            dstpath = os.path.join(dst, relpath)
+            entry = old.get(relpath, {})
+            srcstt = os.lstat(srcpath)
+            if stat.S_ISLNK(srcstt.st_mode):
+                digest = "symlink:" + os.readlink(srcpath)
+            elif (entry.get("size") == srcstt.st_size and
+                    entry.get("mtime") == srcstt.st_mtime_ns and
+                    entry.get("ino") == srcstt.st_ino):
+                digest = entry["digest"]
+            else:
+                digest = file_digest(srcpath)
+            try:
+                dststt = os.lstat(dstpath)
+                # hardlinks made by previous versions are staged again
+                uptodate = (entry.get("digest") == digest and
+                            entry.get("dst") == [dststt.st_ino, dststt.st_size,
+                                                 dststt.st_mtime_ns] and
+                            dststt.st_ino != srcstt.st_ino)
+            except OSError:
+                uptodate = False
+            if not uptodate:
+                with ignored(FileNotFoundError):
+                    os.remove(dstpath)
+                if stat.S_ISLNK(srcstt.st_mode):
+                    os.symlink(os.readlink(srcpath), dstpath)
+                    method = "symlink"
+                else:
+                    method = link_or_copy(srcpath, dstpath, hardlink=False)
+                methods[method] = methods.get(method, 0) + 1
+                dststt = os.lstat(dstpath)
+            new[relpath] = {"size": srcstt.st_size,
+                            "mtime": srcstt.st_mtime_ns,
+                            "ino": srcstt.st_ino,
+                            "digest": digest,
+                            "dst": [dststt.st_ino, dststt.st_size,
+                                    dststt.st_mtime_ns]}
+
+    for relpath in set(old) - set(new):
+        with ignored(OSError):
+            os.remove(os.path.join(dst, relpath))
+    write_file_atomic(manifest_path, json.dumps(new, indent=1, sort_keys=True))
+    logger.debug("Staged {} to {}: {} files unchanged, {}".format(
+        src, dst, len(new) - sum(methods.values()), methods))
+
+    sha = hashlib.sha256()
+    for relpath in sorted(new):
+        sha.update("{} {}\n".format(relpath, new[relpath]["digest"]).encode())
+    return sha.hexdigest()
 
 
 def service_start(service):
@@ -160,36 +454,58 @@ def service_start_stop(service, start):
 def get_image_type(path):
     """ Returns the types of an image passed in argument
 
+    The type is read from the signature of the image, without running file.
+
     @path: Path to the image
 
-    @return: one of the type in the 'types' dictionary, 'unknown' if the type
-    is not in the dictionary or 'error'
+    @return: 'iso9660', 'squashfs', 'unknown' if it is none of them or
+    'error'
     """
-    # signature -> type
-    imgtypes = {
-        "# ISO 9660 CD-ROM filesystem": "iso9660",
-        "x86 boot sector": "iso9660",
-        "DOS/MBR boot sector": "iso9660",
-        "Squashfs filesystem": "squashfs"
-    }
     if not os.path.isfile(path):
         logger.warning("File '%s' does not exist!", path)
         return "error"
 
-    cmd = ["file", "-L", "-b", path]
-
     try:
-        msg = subprocess.check_output(cmd, universal_newlines=True)
-    except subprocess.CalledProcessError as cpe:
-        logger.error("'{}' failed with status %d:\n{}".format(
-            cmd, cpe.returncode, cpe.output))
+        imgtype = mounts.image_type(path)
+    except OSError as exc:
+        logger.error("Can't read image '%s': %s", path, exc)
         return "error"
+    logger.debug("Found type '%s' for file '%s'", imgtype, path)
+    return imgtype
+
+
+def iso_mount_path(image):
+    """ Returns the path where an image is loop-mounted
+
+    @image: path to an iso9660 image
+    @return: mount point of the image
+    """
+    return "/run/otto/iso/" + image.replace("/", "_")
 
-    for sig, imgtype in imgtypes.items():
-        if msg.lower().startswith(sig.lower()):
-            logger.debug("Found type '%s' for file '%s'", imgtype, path)
-            return imgtype
-    return "unknown"
+
+def mount_iso(image, iso_mount):
+    """ Loop-mount an image unless it is already mounted
+
+    @image: path to an iso9660 image
+    @iso_mount: mount point
+    """
+    if not mounts.is_mountpoint(iso_mount):
+        logger.debug("%s not mounted yet, creating and mounting", iso_mount)
+        try:
+            os.makedirs(iso_mount)
+        except OSError:
+            pass
+        try:
+            mounts.loop_mount(image, iso_mount, "iso9660")
+            return
+        except OSError as exc:
+            logger.debug("%s, falling back to mount", exc)
+        try:
+            subprocess.check_call(["mount", "-n", "-o", "loop", image, iso_mount])
+        except subprocess.CalledProcessError as cpe:
+            logger.error(
+                "mounting iso failed with status %d:\n{}".format(
+                    cpe.returncode, cpe.output))
 
 
 def get_iso_and_squashfs(image):
@@ -204,23 +520,12 @@ def get_iso_and_squashfs(image):
 
     if get_image_type(image) != "iso9660":
         logger.error("image '%s' is not an iso9660", image)
-        return None
+        return (None, None)
 
     # mount the ISO, unless it is already
-    iso_mount = "/run/otto/iso/" + image.replace("/", "_")
+    iso_mount = iso_mount_path(image)
     squashfs_path = os.path.join(iso_mount, "casper", "filesystem.squashfs")
-    if subprocess.call(["mountpoint", "-q", iso_mount]) != 0:
-        logger.debug("%s not mounted yet, creating and mounting", iso_mount)
-        try:
-            os.makedirs(iso_mount)
-        except OSError:
-            pass
-        try:
-            subprocess.check_call(["mount", "-n", "-o", "loop", image, iso_mount])
-        except subprocess.CalledProcessError as cpe:
-            logger.error(
-                "mounting iso failed with status %d:\n{}".format(
-                    cpe.returncode, cpe.output))
+    mount_iso(image, iso_mount)
 
     if not os.path.isfile(squashfs_path):
         logger.error("'%s' does not contain /casper/filesystem.squashfs", image)
@@ -287,6 +592,51 @@ def host_arch():
         return None
 
 
+def host_memory():
+    """ Returns the total amount of memory of the host
+
+    @return: memory in bytes or None if it can't be read
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError) as exc:
+        logger.warning("Can't read host memory: {}".format(exc))
+    return None
+
+
+def parse_size(value):
+    """ Returns the number of bytes of a size like 2G or 2560M
+
+    @value: a number of bytes, optionally followed by K, M, G or T
+
+    @return: size in bytes, raises ValueError if value isn't a size
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    value = str(value).strip().upper()
+    if value.endswith("B"):
+        value = value[:-1]
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def container_hwaddr(name):
+    """ Returns a MAC address for the network interface of a container
+
+    The address is derived from the name of the container so it is stable
+    between runs and containers running in parallel don't share the same one.
+
+    @name: Name of the container
+
+    @return: MAC address in the range of LXC (00:16:3e:xx:xx:xx)
+    """
+    digest = hashlib.md5(name.encode()).digest()
+    return "00:16:3e:{:02x}:{:02x}:{:02x}".format(*digest[:3])
+
+
 def find_vga_device():
     """ Find VGA device on the host. lspci is used to collect information
     about devices on the host. It populates a dictionary with the devices